@@ -4,21 +4,44 @@ import pandas
 from datetime import datetime
 from alinea.astk.TimeControl import *
 
-def evaluation_sequence(delays, eval_time='start'):
+def iter_evaluation_sequence(delays, eval_time='start'):
+    """ Generate evaluation filter from sequence of delays, one step at a time
+    """
+    if eval_time not in ('start', 'end'):
+        raise ValueError("eval_time should be 'start' or 'end'")
+    return _evaluation_steps(delays, eval_time)
+
+def _evaluation_steps(delays, eval_time):
+    for d in delays:
+        d = int(d)
+        for i in range(d):
+            yield i == (0 if eval_time == 'start' else d-1)
+
+def evaluation_sequence(delays, eval_time='start', as_array=False):
     """ retrieve evaluation filter from sequence of delays
+
+    If as_array, the filter is returned as a numpy array of booleans.
     """
+    if not as_array:
+        return list(iter_evaluation_sequence(delays, eval_time))
+    if eval_time not in ('start', 'end'):
+        raise ValueError("eval_time should be 'start' or 'end'")
+    delays = numpy.maximum(numpy.array([int(d) for d in delays], dtype=int), 0)
+    stops = numpy.cumsum(delays)
+    seq = numpy.zeros(stops[-1] if len(stops) > 0 else 0, dtype=bool)
+    evaluated = delays > 0
     if eval_time == 'start':
-        seq = [[True if i == 0 else False for i in range(int(d))] for d in delays]
-    elif eval_time == 'end':
-        seq = [[True if i == int(d)-1 else False for i in range(int(d))] for d in delays]
-    return reduce(lambda x,y: x + y, seq)
+        seq[(stops - delays)[evaluated]] = True
+    else:
+        seq[(stops - 1)[evaluated]] = True
+    return seq
 
 class CustomIterWithDelays(IterWithDelays):
 
     def __init__(self, values = [None], delays = [1], eval_time='start'):
         super(CustomIterWithDelays, self).__init__(values=values, delays=delays)
         self.eval_time = eval_time
-        self._evalseq = iter(evaluation_sequence(delays, eval_time))
+        self._evalseq = iter_evaluation_sequence(delays, eval_time)
         self.count = 0.
 
     def __iter__(self):
@@ -38,6 +61,109 @@ class CustomIterWithDelays(IterWithDelays):
             self.dt = None
         return EvalValue(self.ev, self.val, self.dt)
 
+    def evaluation_array(self):
+        """ Get the whole evaluation filter as a numpy array of booleans. """
+        return evaluation_sequence(self.delays, self.eval_time, as_array=True)
+        
+def timing_evaluations(timing):
+    """ Get values and delays of the evaluations of a timing.
+
+    Raise ValueError for null delays, that IterWithDelays and CustomIterWithDelays
+    do not iterate in the same way (e.g. timing built from a filter evaluating
+    each step of the sequence by 'time_control' has none).
+    """
+    delays = [int(d) for d in timing.delays]
+    if any(d <= 0 for d in delays):
+        raise ValueError("timings with null delays can not be compiled, use a loop on timings")
+    return list(timing.values), delays
+
+class WindowEvalValue(EvalValue):
+    """ Evaluation of a timing knowing the offsets of its delay in the sequence. """
+    def __init__(self, eval, value, dt, start, stop):
+        EvalValue.__init__(self, eval, value, dt)
+        self.start = start
+        self.stop = stop
+
+class WeatherWindows(object):
+    """ Columns of weather data as contiguous numpy arrays.
+
+    Weather of an evaluation of a timing is given as views of these columns
+    between the offsets of its delay, without any indexing in pandas.
+    """
+    def __init__(self, data, names=None):
+        """ Store columns 'names' of data (all columns if None).
+
+        Parameters
+        ----------
+        data: pandas DataFrame
+            Weather data of the sequence of the timings (see 'from_timing')
+        names: list of str
+            Names of columns to store
+        """
+        if names is None:
+            names = data.columns
+        self.index = data.index
+        self.columns = {name:numpy.ascontiguousarray(data[name].values) for name in names}
+
+    @classmethod
+    def from_timing(cls, timing, names=None):
+        """ Store weather of the values of a timing (delays not null, as in EventSchedule). """
+        values, delays = timing_evaluations(timing)
+        return cls(pandas.concat(values), names=names)
+
+    def get(self, name, start, stop):
+        """ Get view on column 'name' between offsets start and stop. """
+        return self.columns[name][start:stop]
+
+    def window(self, evaluation, *names):
+        """ Get views on columns 'names' for the delay of a WindowEvalValue. """
+        if len(names) == 0:
+            names = self.columns.keys()
+        return {name:self.get(name, evaluation.start, evaluation.stop) for name in names}
+
+class EventSchedule(object):
+    """ Table of the steps where at least one of the timings is evaluated.
+
+    Timings (IterWithDelays evaluated at the start of their delays, or 
+    CustomIterWithDelays) are compiled once into the sorted steps where they
+    are evaluated. Iterating on the schedule gives only these steps with the
+    evaluations due at each of them, instead of all the steps of the sequence.
+    As for timings, the value of an evaluation holds the weather of its whole
+    delay, so the weather of skipped steps is not lost. Evaluations also know
+    the offsets of their delay in the sequence (see WeatherWindows).
+
+    Timings may cover sequences of different lengths, e.g. when their filter
+    does not evaluate the first step. As when zipping timings in a loop, the
+    schedule then stops with the shortest timing: evaluations of the others
+    beyond its last step are dropped. 'nb_steps' gives this number of steps.
+    """
+    def __init__(self, **timings):
+        self.names = sorted(timings.keys())
+        nb_steps = None
+        events = {}
+        for name, timing in timings.iteritems():
+            eval_time = getattr(timing, 'eval_time', 'start')
+            values, delays = timing_evaluations(timing)
+            steps = numpy.flatnonzero(evaluation_sequence(delays, eval_time, as_array=True))
+            stops = numpy.cumsum(delays)
+            for step, value, dt, stop in zip(steps, values, delays, stops):
+                events.setdefault(step, {})[name] = WindowEvalValue(True, value, dt,
+                                                                    int(stop - dt), int(stop))
+            total = sum(delays)
+            nb_steps = total if nb_steps is None else min(nb_steps, total)
+        # Stop with the shortest timing, as when zipping timings
+        self.steps = [step for step in sorted(events) if step < nb_steps]
+        self.events = events
+        self.nb_steps = nb_steps
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        """ Iterate on (step, dict of evaluations due at step by name of timing) """
+        for step in self.steps:
+            yield step, self.events[step]
+
 def add_notation_dates(data, notation_dates_file):
     import re
     if data.index[-1].year != int(re.findall(r'\d+', notation_dates_file)[0]):
@@ -48,8 +174,54 @@ def add_notation_dates(data, notation_dates_file):
     df2.ix[dates, :] = 1
     return df2.values == 1
     
+def _event_changes(flags):
+    """ Mark the first step of each event and the first step after its end. """
+    previous = numpy.concatenate(([False], flags[:-1]))
+    return flags != previous
+
+def _wet_spells(flags):
+    """ Run-length encoding of a sequence of booleans.
+
+    Returns
+    -------
+    starts, stops: arrays
+        Index of first step of each spell and of the step after its end
+    """
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], flags.astype(int), [0]))))
+    return edges[::2], edges[1::2]
+
+def _degree_days_events(events, ddays, delay):
+    """ Mark the step before each accumulation of 'delay' degree days.
+
+    Accumulation restarts at each event and after each marked step. Sums are
+    computed with cumsum from the start of accumulation and searched with 
+    searchsorted, so only steps where an accumulation ends are visited.
+    """
+    filt = events.copy()
+    nb_steps = len(filt)
+    starts = numpy.union1d([0], numpy.flatnonzero(events))
+    stops = numpy.append(starts[1:], nb_steps)
+    for start, stop in zip(starts, stops):
+        while start < stop:
+            reached = numpy.maximum.accumulate(numpy.cumsum(ddays[start:stop]))
+            ind = numpy.searchsorted(reached, delay)
+            if start + ind == 0:
+                # First step of the sequence is not marked and does not restart accumulation
+                ind = 1 + numpy.searchsorted(reached[1:], delay)
+            if ind >= len(reached):
+                break
+            filt[start + ind - 1] = True
+            start += ind + 1
+    return filt
+
 def septoria_filter_wetness(seq, weather, degree_days=10., base_temp = 0., 
                         Tmin = 10., Tmax = 30., WDmin = 10., rain_min = 0.2, start_date=None):
+    """ Filter of evaluation for septoria on an hourly sequence.
+
+    Steps are evaluated at the start and at the end of wet periods with risk
+    of infection, at the start and after the end of rain events, and when
+    'degree_days' have been accumulated since last evaluation.
+    """
     if not 'septo_infection_risk_with_event' in weather.data.columns:
         from alinea.alep.alep_weather import add_septoria_risk_with_event
         weather.check(varnames=['septo_infection_risk_with_event'], 
@@ -59,74 +231,47 @@ def septoria_filter_wetness(seq, weather, degree_days=10., base_temp = 0.,
         from alinea.alep.alep_weather import linear_degree_days
         weather.check(varnames=['septo_degree_days'], models={'septo_degree_days':linear_degree_days}, start_date=start_date, base_temp=base_temp)
     wetness = weather.data.wetness[seq]
-    temperature = weather.data.temperature_air[seq]
-    rain = weather.data.rain[seq]
-    rain[rain <= rain_min] = 0
-    cond_inf = weather.data.septo_infection_risk_with_event[seq]
-    ddays = weather.data.degree_days[seq].diff()
-    ddays.ix[0] = 0.
-    count_wet = 0.
-    count_rain = 0.
-    count_ddays = 0.
-    df = pandas.Series([False for i in range(len(wetness))], index = wetness.index)
-    for i, row in df.iteritems():
-        if wetness[i] and Tmin <= temperature[i] < Tmax:
-            if count_wet == 0. and i < df.index[-1]-9 and cond_inf[i+9] == True:
-                df[i] = True
-            count_wet += 1.
-        else:
-            if i > df.index[0] and count_wet >= WDmin and cond_inf[i-1] == True:
-                df[i - 1] = True
-            count_wet = 0.
-    
-    for i, row in df.iteritems():
-        if rain[i] > 0:
-            if count_rain == 0.:
-                df[i] = True
-            count_rain += 1
-        else:
-            if count_rain > 0.:
-                df[i] = True
-            count_rain = 0.
-
-    for i, row in df.iteritems():
-        if row == True:
-            count_ddays = 0.
-        count_ddays += ddays[i]
-        if count_ddays >= degree_days and i > df.index[0]:
-            df[i - 1] = True
-            count_ddays = 0.
-    df[df.index[0]] = True
-    return df
+    temperature = weather.data.temperature_air[seq].values
+    rain = weather.data.rain[seq].values
+    cond_inf = weather.data.septo_infection_risk_with_event[seq].values == True
+    ddays = weather.data.degree_days[seq].diff().values
+    ddays[0] = 0.
+    nb_steps = len(wetness)
+    filt = numpy.zeros(nb_steps, dtype=bool)
+
+    # Start and end of wet spells with risk of infection
+    wet = wetness.values.astype(bool) & (Tmin <= temperature) & (temperature < Tmax)
+    starts, stops = _wet_spells(wet)
+    first = starts[starts < nb_steps - 10]
+    filt[first[cond_inf[first + 9]]] = True
+    ended = (stops < nb_steps) & (stops - starts >= WDmin)
+    last = stops[ended] - 1
+    filt[last[cond_inf[last]]] = True
+
+    # Start and end of rain events
+    filt |= _event_changes((rain > rain_min) & (rain > 0))
+
+    # Accumulation of degree days
+    filt = _degree_days_events(filt, ddays, degree_days)
+    filt[0] = True
+    return pandas.Series(filt, index = wetness.index)
     
 def septoria_filter_ddays(seq, weather, delay=10., base_temp = 0., 
                           rain_min = 0.2, start_date=None):
+    """ Filter of evaluation for septoria on an hourly sequence.
+
+    Steps are evaluated at the start and after the end of rain events, and 
+    when 'delay' degree days have been accumulated since last evaluation.
+    """
     if not 'septo_degree_days' in weather.data.columns:
         from alinea.alep.alep_weather import linear_degree_days
         weather.check(varnames=['septo_degree_days'], models={'septo_degree_days':linear_degree_days}, start_date=start_date, base_temp=base_temp)
-    rain = weather.data.rain[seq]
-    rain[rain <= rain_min] = 0
+    rain = weather.data.rain[seq].values
     ddays = weather.data.degree_days[seq].diff()
-    ddays.ix[0] = 0.
-    count_rain = 0.
-    count_ddays = 0.
-    df = pandas.Series([False for i in range(len(ddays))], index = ddays.index)
-    for i, row in df.iteritems():
-        if rain[i] > 0:
-            if count_rain == 0.:
-                df[i] = True
-            count_rain += 1
-        else:
-            if count_rain > 0.:
-                df[i] = True
-            count_rain = 0.
-
-    for i, row in df.iteritems():
-        if row == True:
-            count_ddays = 0.
-        count_ddays += ddays[i]
-        if count_ddays >= delay and i > df.index[0]:
-            df[i - 1] = True
-            count_ddays = 0.
-    df[df.index[0]] = True
-    return df
\ No newline at end of file
+    index = ddays.index
+    ddays = ddays.values
+    ddays[0] = 0.
+    filt = _event_changes((rain > rain_min) & (rain > 0))
+    filt = _degree_days_events(filt, ddays, delay)
+    filt[0] = True
+    return pandas.Series(filt, index = index)
\ No newline at end of file
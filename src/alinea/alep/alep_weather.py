@@ -8,7 +8,8 @@ import numpy
 from alinea.weather.global_weather import *
 from alinea.weather.mini_models import leaf_wetness_rapilly
 from matplotlib.ticker import FuncFormatter
-from datetime import timedelta, date
+from datetime import timedelta, date, datetime
+import os
 
 def is_raining(rain_eval):
     """ Check if it is raining or not
@@ -112,20 +113,11 @@ def add_septoria_infection_risk(data, wetness_duration_min = 10., temp_min=10, t
     """
     temp1 = data.temperature_air>=temp_min
     temp2 = data.temperature_air<=temp_max
-    infect_cond = data.wetness & temp1 & temp2
-    septo_infection_risk = np.zeros(len(data))
-    counter = 0.
-    for i_line in range(len(data)):
-        if infect_cond[i_line]==True:
-            counter += 1.
-            if counter >= wetness_duration_min:
-                septo_infection_risk[i_line] = True
-            else:
-                septo_infection_risk[i_line] = False
-        else:
-            counter = 0.
-            septo_infection_risk[i_line] = False   
-    return septo_infection_risk
+    infect_cond = (data.wetness & temp1 & temp2) == True
+    # Count hours since the start of each wet period (groupby on period ids)
+    period_ids = (~infect_cond).cumsum()
+    counter = infect_cond.astype(int).groupby(period_ids).cumsum()
+    return (infect_cond & (counter >= wetness_duration_min)).values.astype(float)
     
 def plot_septo_infection_risk(weather, start_date="2010-10-15 12:00:00", adel=None, axis = 'degree_days', ax = None, xlims=None, only_with_event=True, title = None, xlabel = True):
     def form_tick(x, pos):
@@ -175,15 +167,41 @@ def plot_septo_infection_risk(weather, start_date="2010-10-15 12:00:00", adel=No
     plt.tight_layout()
     return ax
     
+def window_sums(values, index, before=timedelta(0), after=timedelta(0), groups=None):
+    """ Sum values in windows [date - before, date + after] around each date of index.
+
+    Sums are computed by differences of cumulative sums, with the bounds of
+    the windows found by searchsorted in the (sorted) index. If given, 'groups' 
+    numbers the groups of consecutive dates (e.g. site-years of a batch, each
+    sorted) and windows do not span several groups. As sums of the rows of each
+    window, windows with a missing value sum to NaN.
+    """
+    values = np.asarray(values, dtype=float)
+    missing = np.isnan(values)
+    cumsum = np.append(0., np.cumsum(np.where(missing, 0., values)))
+    cummissing = np.append(0, np.cumsum(missing))
+    if groups is None:
+        starts = index.searchsorted(index - before, side='left')
+        stops = index.searchsorted(index + after, side='right')
+    else:
+        # Seconds since first date, groups being moved apart by more than a window
+        seconds = (index.asi8 - index.asi8.min()) // 10**9
+        before = int(before.total_seconds())
+        after = int(after.total_seconds())
+        times = seconds + np.asarray(groups, dtype=np.int64) * (seconds.max() + before + after + 1)
+        starts = times.searchsorted(times - before, side='left')
+        stops = times.searchsorted(times + after, side='right')
+    sums = cumsum[stops] - cumsum[starts]
+    sums[cummissing[stops] > cummissing[starts]] = np.nan
+    return sums
+
 def add_septoria_efficient_rain(data, viability = 5):
     """ viability (in days) is the period after which inoculum is dead if no infection. """
-    df = data.ix[:, ['rain', 'septo_infection_risk']]
-    df['first_risk'] = np.append(np.zeros(1), data['septo_infection_risk'].values[1:]-data['septo_infection_risk'].values[:-1])
-    df['efficient_rain'] = np.zeros(len(df))
-    for date, row in df.iterrows():
-        if row['rain']>0 and sum(df.ix[date:date+timedelta(viability,0), 'first_risk'])>0:
-            df.set_value(date, 'efficient_rain', 1)
-    return df['efficient_rain']
+    risk = data['septo_infection_risk'].values
+    first_risk = np.append(np.zeros(1), risk[1:]-risk[:-1])
+    next_risks = window_sums(first_risk, data.index, after=timedelta(viability,0))
+    efficient_rain = ((data['rain'].values>0) & (next_risks>0)).astype(float)
+    return pandas.Series(efficient_rain, index=data.index, name='efficient_rain')
     
 def add_septoria_risk_with_event(data, viability = 5, wetness_duration_min = 10., temp_min=10, temp_max=25):
     """ viability (in days) is the period after which inoculum is dead if no infection. """
@@ -191,58 +209,252 @@ def add_septoria_risk_with_event(data, viability = 5, wetness_duration_min = 10.
         data['septo_infection_risk'] = add_septoria_infection_risk(data, 
                                                                    wetness_duration_min = wetness_duration_min, 
                                                                    temp_min=temp_min, temp_max=temp_max)
-    df = data.ix[:, ['rain', 'septo_infection_risk']]
-    df['bool_rain'] = (df['rain']>0)*1
-    df['septo_risk_with_event'] = np.zeros(len(df))
-    for date, row in df.iterrows():
-        if row['septo_infection_risk']>0 and sum(df.ix[date-timedelta(days=viability-1, hours=23):date+timedelta(hours=1), 'bool_rain'])>0:
-            df.set_value(date, 'septo_risk_with_event', 1) 
-    return df['septo_risk_with_event']
-    
-def add_rain_dispersal_events(weather):
+    bool_rain = (data['rain'].values>0)*1
+    last_rains = window_sums(bool_rain, data.index, 
+                             before=timedelta(days=viability-1, hours=23),
+                             after=timedelta(hours=1))
+    risk_with_event = ((data['septo_infection_risk'].values>0) & (last_rains>0)).astype(float)
+    return pandas.Series(risk_with_event, index=data.index, name='septo_risk_with_event')
+    
+def rain_spells(rain):
+    """ Run-length encoding of rain spells (consecutive hours with rain > 0).
+
+    Returns
+    -------
+    starts, stops: arrays
+        Index of first hour of each spell and of the hour after its end
+    """
+    raining = np.concatenate(([0], (np.asarray(rain) > 0.).astype(int), [0]))
+    edges = np.flatnonzero(np.diff(raining))
+    return edges[::2], edges[1::2]
+
+def add_rain_dispersal_events(weather, return_spells=False):
     """ Add a column to indicate the dispersal events at hours with max rain for each dispersal event,
         Add a column to indicate the value of average rain during dispersal event,
         Add a column to indicate the duration of each dispersal event.
+
+    A rain spell triggers a dispersal event when it is followed by a dry hour.
+    If return_spells is True, also return the table of these spells (start, 
+    end, duration, total rain, mean intensity and date of dispersal event).
     """
-    max_rain = 0.
-    ind_max = 0.
-    rain_counter = 0.
-    rain_amount = 0.
-    
-    dispersal = zeros(len(weather.data))
-    rain = zeros(len(weather.data))
-    rain_duration = zeros(len(weather.data))
-    for i_line in range(len(weather.data)):
-        if weather.data.rain[i_line] > 0.:
-            rain_counter += 1.
-            rain_amount += weather.data.rain[i_line]
-            if weather.data.rain[i_line] > max_rain:
-                max_rain = weather.data.rain[i_line]
-                ind_max = i_line
-        else:
-            if ind_max > 0.:
-                rain[ind_max] = rain_amount/rain_counter
-                rain_duration[ind_max] = rain_counter
-                dispersal[ind_max] = 1
-                max_rain = 0.
-                ind_max = 0.
-                rain_counter = 0.
-                rain_amount = 0.
-    
+    values = weather.data.rain.values
+    nb_hours = len(values)
+    starts, stops = rain_spells(values)
+    lengths = stops - starts
+    nb_spells = len(starts)
+
+    # Aggregates by spell, dry hours after each spell being masked,
+    # and first hour with the max of each spell
+    if nb_spells > 0:
+        hours = np.arange(nb_hours)
+        spell_of_hour = starts.searchsorted(hours, side='right') - 1
+        in_spell = (spell_of_hour >= 0) & (hours < stops[np.maximum(spell_of_hour, 0)])
+        rain_in_spells = np.where(in_spell, values, 0.)
+        amounts = np.add.reduceat(rain_in_spells, starts)
+        maxima = np.maximum.reduceat(rain_in_spells, starts)
+        at_max = np.flatnonzero(in_spell & (rain_in_spells == maxima[spell_of_hour]))
+        ind_max = at_max[np.unique(spell_of_hour[at_max], return_index=True)[1]]
+    else:
+        amounts, maxima = np.zeros(0), np.zeros(0)
+        ind_max = np.zeros(0, dtype=int)
+
+    # A spell with its max at first hour of the data is not recorded and is 
+    # merged with next spells up to the first one with a higher max
+    if nb_spells > 0 and ind_max[0] == 0:
+        higher = np.flatnonzero(maxima > maxima[0])
+        last = higher[0] if len(higher) > 0 else nb_spells
+        if last < nb_spells:
+            hours = np.concatenate([values[start:stop] for start, stop 
+                                    in zip(starts[:last+1], stops[:last+1])])
+            amounts[last] = np.cumsum(hours)[-1]
+            lengths[last] = len(hours)
+            starts[last] = starts[0]
+        keep = np.arange(nb_spells) >= last
+        starts, stops, lengths = starts[keep], stops[keep], lengths[keep]
+        amounts, ind_max = amounts[keep], ind_max[keep]
+
+    # Only spells followed by a dry hour trigger dispersal
+    closed = stops < nb_hours
+    starts, stops, lengths = starts[closed], stops[closed], lengths[closed]
+    amounts, ind_max = amounts[closed], ind_max[closed]
+
+    dispersal = zeros(nb_hours)
+    rain = zeros(nb_hours)
+    rain_duration = zeros(nb_hours)
+    rain[ind_max] = amounts/lengths
+    rain_duration[ind_max] = lengths
+    dispersal[ind_max] = 1
+    
+    index = weather.data.temperature_air.index
     del weather.data['rain']
-    rain = pandas.DataFrame(dict(rain=rain))
-    rain.index = weather.data.temperature_air.index
-    weather.data = weather.data.join(rain)
-    
-    rain_duration = pandas.DataFrame(dict(rain_duration=rain_duration))
-    rain_duration.index = weather.data.temperature_air.index
-    weather.data = weather.data.join(rain_duration)
-    
-    dispersal_event = pandas.DataFrame(dict(dispersal_event=dispersal))
-    dispersal_event.index = weather.data.temperature_air.index
-    weather.data = weather.data.join(dispersal_event)
+    weather.data = weather.data.join(pandas.DataFrame(dict(rain=rain), index=index))
+    weather.data = weather.data.join(pandas.DataFrame(dict(rain_duration=rain_duration), index=index))
+    weather.data = weather.data.join(pandas.DataFrame(dict(dispersal_event=dispersal), index=index))
+    if return_spells:
+        spells = pandas.DataFrame(dict(start=index[starts], end=index[stops-1],
+                                       duration=lengths, total_rain=amounts,
+                                       mean_intensity=amounts/lengths,
+                                       dispersal_event=index[ind_max]),
+                                  columns=['start', 'end', 'duration', 'total_rain',
+                                           'mean_intensity', 'dispersal_event'])
+        return weather, spells
     return weather
     
+def default_site_year(filename):
+    """ Get site and year of harvest from name of a weather file.
+
+    Site is the first word of the name and year is the last one in the
+    name, e.g. 'Boigneville_01092010_31082011_h.csv' -> ('Boigneville', 2011)
+    and 'meteo00-01.txt' -> ('meteo', 2001).
+    """
+    import re
+    name = os.path.splitext(os.path.basename(filename))[0]
+    site = re.match(r'[A-Za-z]*', name).group()
+    year = re.findall(r'\d+', name)[-1]
+    year = int(year[-4:]) if len(year) >= 4 else 2000 + int(year)
+    return site, year
+
+def derive_weather(data, start_date, base_temp=0., max_temp=30., 
+                   wetness_duration_min=10., temp_min=10, temp_max=25, viability=5):
+    """ Add derived columns used by alep models to weather data of one site and year:
+        wetness, degree days and septoria risks.
+    """
+    if not 'wetness' in data.columns:
+        data['wetness'] = wetness_rapilly(data).ravel()
+    data['degree_days'] = linear_degree_days(data, start_date, base_temp=base_temp, 
+                                             max_temp=max_temp)
+    data['septo_infection_risk'] = add_septoria_infection_risk(data, 
+                                        wetness_duration_min=wetness_duration_min,
+                                        temp_min=temp_min, temp_max=temp_max)
+    data['septo_infection_risk_with_event'] = add_septoria_risk_with_event(data, 
+                                        viability=viability).values
+    return data
+
+def derive_weather_batch(table, sowing_date='10-15 12:00:00', base_temp=0., max_temp=30., 
+                         wetness_duration_min=10., temp_min=10, temp_max=25, viability=5):
+    """ Add the columns of 'derive_weather' to a table of weather data of several 
+    sites and years indexed by (site, year, datetime), in one pass on the whole table.
+
+    Degree days of each site-year are counted from the sowing date ('month-day 
+    hour') in the year before harvest, and neither wet periods nor windows of
+    rain span two site-years.
+    """
+    sites = table.index.get_level_values('site').values
+    years = table.index.get_level_values('year').values
+    index = pandas.DatetimeIndex(table.index.get_level_values('datetime'))
+    first = np.append(True, (sites[1:] != sites[:-1]) | (years[1:] != years[:-1]))
+    groups = np.cumsum(first) - 1
+    if not 'wetness' in table.columns:
+        table['wetness'] = wetness_rapilly(table).ravel()
+
+    # Degree days, as 'linear_degree_days' on each site-year
+    temp = table['temperature_air'].values.astype(float)
+    temp = np.where((temp < base_temp) | (temp > max_temp), 0., temp)
+    hourly = (temp - base_temp)/24.
+    cumsum = np.cumsum(hourly)
+    cumsum -= np.append(0., cumsum)[np.flatnonzero(first)][groups]
+    starts = pandas.DatetimeIndex([datetime.strptime(str(year-1)+'-'+sowing_date, '%Y-%m-%d %H:%M:%S')
+                                   for year in years[first]]).asi8[groups]
+    minute = 60 * 10**9
+    after = index.asi8 > starts + minute
+    before = index.asi8 <= starts - minute
+    sum_to_start = np.bincount(groups, weights=hourly*(~after))[groups]
+    # Before sowing, the hour d hours before sowing gets minus the sum of the
+    # d first hours of the site-year, as in 'linear_degree_days'
+    firsts = np.flatnonzero(first)[groups]
+    nb_before = np.bincount(groups, weights=before)[groups].astype(int)
+    mirror = np.where(before, firsts + nb_before - 1 - (np.arange(len(groups)) - firsts), 0)
+    table['degree_days'] = np.where(after, cumsum - sum_to_start, 
+                                    np.where(before, -cumsum[mirror], 0.))
+
+    # Risks of infection, as 'add_septoria_infection_risk' on each site-year
+    infect_cond = (np.asarray(table['wetness'].values, dtype=bool) & 
+                   (table['temperature_air'].values >= temp_min) &
+                   (table['temperature_air'].values <= temp_max))
+    period_ids = np.cumsum(~infect_cond | first)
+    counter = pandas.Series(infect_cond.astype(int)).groupby(period_ids).cumsum().values
+    risk = (infect_cond & (counter >= wetness_duration_min)).astype(float)
+    table['septo_infection_risk'] = risk
+    last_rains = window_sums((table['rain'].values>0)*1, index, 
+                             before=timedelta(days=viability-1, hours=23),
+                             after=timedelta(hours=1), groups=groups)
+    table['septo_infection_risk_with_event'] = ((risk>0) & (last_rains>0)).astype(float)
+    return table
+
+def _read_site_year(args):
+    """ Read one weather file (in a process of the pool if any). """
+    filename, site_year, weather_kwds = args
+    weather = Weather(data_file=filename, **weather_kwds)
+    return site_year(filename), weather.data
+
+def load_weather_batch(directory, pattern='*.txt', reader=None, site_year=default_site_year,
+                       sowing_date='10-15 12:00:00', nb_processes=None, weather_kwds=None, 
+                       **kwds):
+    """ Read all weather files of a directory in a single table and derive it.
+
+    Files are read one by one (in parallel if asked), then wetness, degree days
+    and septoria risks of all sites and years are derived in a single pass on 
+    the table (see derive_weather_batch).
+
+    Parameters
+    ----------
+    directory: str
+        Directory of weather files
+    pattern: str
+        Pattern of names of weather files in directory
+    reader: function
+        Reader of Weather for files (default reader of Weather if None)
+    site_year: function
+        Function giving (site, year of harvest) from the name of a file
+    sowing_date: str
+        Sowing date ('month-day hour'), in year before harvest, from which
+        degree days are computed
+    nb_processes: int
+        Number of processes to read files in parallel, 
+        no parallel processing if None
+    weather_kwds: dict
+        Other arguments of Weather for files (e.g. localisation)
+    kwds:
+        Parameters of derivation of weather (see derive_weather)
+
+    Returns
+    -------
+    table: pandas DataFrame
+        Weather data of all files indexed by (site, year, datetime)
+    """
+    import glob
+    weather_kwds = dict(weather_kwds or {})
+    if reader is not None:
+        weather_kwds['reader'] = reader
+    filenames = sorted(glob.glob(os.path.join(directory, pattern)))
+    args = [(filename, site_year, weather_kwds) for filename in filenames]
+    if nb_processes is not None and nb_processes > 1 and len(args) > 1:
+        from multiprocessing import Pool
+        pool = Pool(nb_processes)
+        try:
+            results = pool.map(_read_site_year, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_read_site_year, args)
+    keys = [key for key, data in results]
+    if len(set(keys)) < len(keys):
+        raise ValueError('Several weather files for the same site and year')
+    table = pandas.concat([data for key, data in results], keys=keys)
+    table.index.names = ['site', 'year', 'datetime']
+    return derive_weather_batch(table, sowing_date=sowing_date, **kwds)
+
+def weather_from_batch(table, site, year, weather_kwds=None):
+    """ Get Weather of one site and year from a table of load_weather_batch.
+
+    The Weather object is built with 'weather_kwds' as in load_weather_batch, 
+    its data being taken from the table instead of read from a file.
+    """
+    weather = Weather(**(weather_kwds or {}))
+    weather.data = table.xs((site, year), level=['site', 'year'])
+    return weather
+
 def plot_rain_and_temp(weather, xaxis = 'degree_days', leaf_dates=None, 
                        ax = None, xlims=None, ylims_rain = None, ylims_temp = None,
                        title = None, xlabel = True, arrowstyle = '->', arrow_color = 'g'):
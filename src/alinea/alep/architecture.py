@@ -4,6 +4,7 @@ The aim of this module is to provide all the tools needed to adapt a given archi
 into one that provides all the good parameters and organ name definition.
 
 """
+import numpy as np
 
 def get_leaves(g, label='LeafElement'):
     labels = g.property('label')
@@ -132,4 +133,179 @@ def set_property_on_each_id(g,
     property_dict = dict({(k,property_dict.get(k, 0.)) for k in vids})
     g.add_property(property_name)
     prop = g.property(property_name)
-    prop.update(property_dict)
\ No newline at end of file
+    prop.update(property_dict)
+
+# Summaries of geometry ###########################################################
+
+class GeometrySummary(object):
+    """ Compact description of the geometry of a leaf element, replacing its mesh 
+    in canopies loaded without geometry (see 'alinea.alep.canopy_archive'). """
+    def __init__(self, center, z_min, z_max):
+        self.center = center
+        self.z_min = z_min
+        self.z_max = z_max
+
+    def __repr__(self):
+        return 'GeometrySummary(center=%s, z_min=%s, z_max=%s)'%(self.center, self.z_min, self.z_max)
+
+def geometry_center(geometry):
+    """ Get the center of the bounding box of a geometry, or of its summary. """
+    if isinstance(geometry, GeometrySummary):
+        return geometry.center
+    from openalea.plantgl import all as pgl
+    import collections
+    bbc = pgl.BBoxComputer(pgl.Tesselator())
+    if isinstance(geometry, collections.Iterable):
+        bbc.process(pgl.Scene(geometry))
+    else:
+        bbc.process(pgl.Scene([pgl.Shape(geometry)]))
+    return bbc.result.getCenter()
+
+# Climate shared by the canopy ####################################################
+
+class ClimateContext(object):
+    """ Weather of the current time step shared by all the leaf elements of a canopy.
+
+    Values are stored once for the whole canopy (sequences as numpy arrays)
+    instead of being copied on each leaf element. Microclimate of some leaf
+    elements can be specified with overrides, that take precedence over the
+    values of the canopy.
+    """
+    def __init__(self):
+        self.values = {}
+        self.overrides = {}
+
+    def update(self, **kwds):
+        """ Set values of the canopy (e.g. temperature_sequence=[...]). """
+        for name, value in kwds.iteritems():
+            if hasattr(value, '__iter__'):
+                value = np.asarray(value)
+            self.values[name] = value
+
+    def override(self, vid, **kwds):
+        """ Set microclimate values of leaf element 'vid'. """
+        self.overrides.setdefault(vid, {}).update(kwds)
+
+    def clear_overrides(self, vid=None):
+        """ Remove microclimate values of leaf element 'vid' (all if None). """
+        if vid is None:
+            self.overrides.clear()
+        else:
+            self.overrides.pop(vid, None)
+
+    def has(self, name, vid=None):
+        """ True if the context gives a value of 'name' to leaf element 'vid' 
+        (to the canopy if vid is None). """
+        return name in self.values or name in self.overrides.get(vid, {})
+
+    def get(self, name, vid=None, default=None):
+        """ Get value of 'name' for leaf element 'vid', or for the canopy if no override. """
+        if vid in self.overrides and name in self.overrides[vid]:
+            return self.overrides[vid][name]
+        return self.values.get(name, default)
+
+    def window(self, start, stop):
+        """ Climate context restricted to steps start:stop of sequences (e.g. for sub-steps). """
+        def restrict(value):
+            if isinstance(value, (np.ndarray, list, tuple)) and np.ndim(value) > 0:
+                return value[start:stop]
+            return value
+        climate = ClimateContext()
+        climate.values = {name:restrict(value) for name, value in self.values.iteritems()}
+        climate.overrides = {vid:{name:restrict(value) for name, value in values.iteritems()}
+                             for vid, values in self.overrides.iteritems()}
+        return climate
+
+    def get_array(self, name, vids, default=0.):
+        """ Get scalar values of 'name' for all 'vids' in an array. 
+
+        'default' is a scalar or an array of values for 'vids'. Raise ValueError
+        if 'name' is a sequence (e.g. temperature_sequence), use 'get' instead.
+        """
+        def scalar(value):
+            if np.ndim(value) > 0:
+                raise ValueError("'%s' is a sequence of weather, not a value by leaf: "
+                                 "use get instead of get_array" % name)
+            return value
+        values = np.empty(len(vids))
+        values[:] = scalar(self.values[name]) if name in self.values else default
+        if len(self.overrides) > 0:
+            for i, vid in enumerate(vids):
+                if vid in self.overrides and name in self.overrides[vid]:
+                    values[i] = scalar(self.overrides[vid][name])
+        return values
+
+def get_climate(g):
+    """ Get climate context of the canopy (None if climate is given on leaves). """
+    return getattr(g, 'climate_context', None)
+
+def set_climate(g, label='LeafElement', leaf_properties=(), **kwds):
+    """ Give values of weather to the canopy as a whole.
+
+    Parameters
+    ----------
+    g: MTG
+        MTG representing the canopy
+    label: str
+        Label of the leaf elements given 'leaf_properties'
+    leaf_properties: list of str
+        Names of values also written as properties of each leaf element, for
+        models that read weather on leaves instead of the climate context
+        (e.g. PopDrops or Septo3D emission, variable_septoria)
+    kwds: 
+        Values of weather (e.g. temperature_sequence, rain_intensity)
+
+    Returns
+    -------
+    g: MTG
+        Updated MTG representing the canopy
+    """
+    climate = get_climate(g)
+    if climate is None:
+        climate = ClimateContext()
+        g.climate_context = climate
+    climate.update(**kwds)
+    if len(leaf_properties) > 0:
+        set_properties(g, label=label, 
+                       **{name:(kwds[name].tolist() if isinstance(kwds[name], np.ndarray)
+                                else kwds[name]) for name in leaf_properties})
+    return g
+
+def carry_climate(g, newg):
+    """ Give the climate context of canopy g to canopy newg (e.g. next canopy 
+    loaded from disk), without the overrides given by vertex ids of g. """
+    climate = get_climate(g)
+    if climate is not None and newg is not g:
+        climate.clear_overrides()
+        newg.climate_context = climate
+    return newg
+
+def climate_value(g, name, vid=None, default=None):
+    """ Get value of weather 'name' for leaf element 'vid'.
+
+    Read climate context of the canopy if it has a value of 'name', property
+    of the leaf otherwise.
+    """
+    climate = get_climate(g)
+    if climate is not None and climate.has(name, vid):
+        return climate.get(name, vid, default)
+    value = g.property(name).get(vid)
+    return value if value is not None else default
+
+def climate_array(g, name, vids, default=0.):
+    """ Get scalar values of weather 'name' for all 'vids' in an array.
+
+    Values of the climate context take precedence over properties of the leaves.
+    """
+    climate = get_climate(g)
+    if climate is not None and climate.has(name):
+        return climate.get_array(name, vids, default)
+    prop = g.property(name)
+    values = np.array([prop.get(vid, default) for vid in vids], dtype=float)
+    if climate is not None:
+        values = climate.get_array(name, vids, values)
+    return values
+
+def leaf_climate(leaf, name, default=None):
+    """ Get value of weather 'name' for a leaf node of an MTG. """
+    return climate_value(leaf._g, name, leaf._vid, default)
\ No newline at end of file
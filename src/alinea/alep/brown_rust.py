@@ -2,6 +2,7 @@
 """ Classes of dispersal unit and lesion of wheat brown rust.
 """
 from alinea.alep.fungus import *
+from alinea.alep.architecture import leaf_climate
 import numpy as np
 
 # Dispersal unit ###################################################################################
@@ -46,8 +47,8 @@ class BrownRustDU(DispersalUnit):
                     return
 
             # Accumulate climatic data on the leaf sector during the time step
-            self.temperature_sequence.append(leaf.temperature_sequence)
-            self.wetness_sequence.append(leaf.wetness_sequence)
+            self.temperature_sequence.append(list(leaf_climate(leaf, 'temperature_sequence', [])))
+            self.wetness_sequence.append(list(leaf_climate(leaf, 'wetness_sequence', [])))
 
             # Infection success
             temps = self.temperature_sequence
@@ -158,7 +159,7 @@ class BrownRustLesion(Lesion):
 
         if self.is_active:
             # Calculate progress in thermal time
-            self.update_age_and_status(leaf_temperature = leaf.temperature_sequence)
+            self.update_age_and_status(leaf_temperature = leaf_climate(leaf, 'temperature_sequence', []))
 
             # Calculate growth demand
             self.update_growth()
@@ -0,0 +1,661 @@
+""" Archive of canopy snapshots gathering all iterations of a reconstruction in a single file.
+
+    Numerical properties of the MTG and the tesselated geometry of its elements are
+    stored as columns of arrays read through memory mapping. Light archives replace
+    the meshes by summaries of the geometry of each element (center and height of
+    its bounding box, see 'GeometrySummary'). Other properties and the
+    topology of the MTG are pickled. A prefetcher loads the next iteration of the canopy
+    in a background thread while the simulation of diseases runs on the current one.
+
+    Delta archives save an iteration in full only when elements appear or disappear
+    in the canopy. Other iterations are saved as the changes of properties and
+    geometries since the previous one, and can be applied in place on the canopy
+    of the simulation (see 'CanopyDeltaReader').
+
+    Layout of an archive file:
+        - header: magic string and offset of the index
+        - data: pickled skeletons of MTGs and raw arrays of columns
+        - index: pickled dict giving for each iteration the offsets, dtypes and shapes
+        of its blocks of data
+
+"""
+
+# Imports #########################################################################
+import os
+import sys
+import struct
+import numbers
+import threading
+import collections
+import numpy as np
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from alinea.alep.disease_store import get_disease_store
+
+MAGIC = 'ALEPCNP1'
+ALIGNMENT = 16
+
+def canopy_archive_path(wheat_dir, light=False, delta=False):
+    """ Path of the snapshot archive (light if without meshes, delta if saved as 
+    changes between iterations) associated with a directory of canopies saved with adel """
+    return (wheat_dir.rstrip('/\\') + ('.light' if light else '') + 
+            ('.delta' if delta else '') + '.canopy')
+
+def _changed(value, previous):
+    try:
+        return bool(value != previous)
+    except ValueError:
+        # e.g. arrays of different values
+        return True
+
+# Geometry ########################################################################
+def mesh_arrays(geometry):
+    """ Get points and triangles of the tesselation of a geometry as arrays.
+
+    A list of geometries (as accepted by 'geometry_center') gives a single mesh 
+    gathering the meshes of its items.
+    """
+    from openalea.plantgl.all import Tesselator
+    if isinstance(geometry, collections.Iterable):
+        meshes = [mesh_arrays(geom) for geom in geometry]
+        if len(meshes) == 0:
+            return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int32)
+        offsets = np.cumsum([0] + [len(p) for p, i in meshes[:-1]])
+        return (np.concatenate([p for p, i in meshes]),
+                np.concatenate([i + offset for (p, i), offset in zip(meshes, offsets)]).astype(np.int32))
+    tesselator = Tesselator()
+    geometry.apply(tesselator)
+    mesh = tesselator.result
+    points = np.array([tuple(p) for p in mesh.pointList], dtype=float).reshape((-1, 3))
+    indices = np.array([tuple(i) for i in mesh.indexList], dtype=np.int32).reshape((-1, 3))
+    return points, indices
+
+def mesh_from_arrays(points, indices):
+    """ Build a triangle set from arrays of points and triangles, PlantGL 
+    converting the arrays without a Vector3 or an Index3 per item """
+    from openalea.plantgl.all import TriangleSet, Point3Array, Index3Array
+    return TriangleSet(Point3Array(np.ascontiguousarray(points, dtype=float).reshape((-1, 3))),
+                       Index3Array(np.ascontiguousarray(indices, dtype=np.uint32).reshape((-1, 3))))
+
+# Columns #########################################################################
+class ColumnProperty(collections.MutableMapping):
+    """ Property of the MTG read from a column of numbers of an archive.
+
+    Vertex ids and values stay in the (memory mapped) arrays of the archive 
+    until the property is first used, when they are converted to a dict. 
+    Properties that the simulation never reads cost no conversion.
+    """
+    def __init__(self, vids, values):
+        self.vids = vids
+        self.values_array = values
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = dict(zip(self.vids.tolist(), self.values_array.tolist()))
+            self.vids = self.values_array = None
+        return self._data
+
+    def detach(self):
+        """ Copy arrays in memory, e.g. before the file of the archive is removed """
+        if self._data is None:
+            self.vids = np.array(self.vids)
+            self.values_array = np.array(self.values_array)
+
+    def __getitem__(self, vid):
+        return self.data[vid]
+
+    def __setitem__(self, vid, value):
+        self.data[vid] = value
+
+    def __delitem__(self, vid):
+        del self.data[vid]
+
+    def __contains__(self, vid):
+        return vid in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.vids) if self._data is None else len(self._data)
+
+    def __repr__(self):
+        return repr(self.data)
+
+def detach_columns(g):
+    """ Copy in memory the columns of properties of g read from an archive """
+    for prop in g.properties().itervalues():
+        if isinstance(prop, ColumnProperty):
+            prop.detach()
+
+# Archive #########################################################################
+class CanopyArchive(object):
+    """ Single file archive of the successive iterations of a canopy.
+
+    Iterations are appended with 'save(g, it, TT)' and read with 'load(it)',
+    which returns (g, TT) as 'AdelWheat.load'.
+    """
+    def __init__(self, filename):
+        """ Open or create the archive.
+
+        Parameters
+        ----------
+        filename: str
+            Path of the archive file
+        """
+        self.filename = filename
+        if os.path.exists(filename):
+            self.index = self._read_index()
+        else:
+            self.index = {'version':1, 'iterations':{}}
+
+    def __contains__(self, it):
+        return it in self.index['iterations']
+
+    def __len__(self):
+        return len(self.index['iterations'])
+
+    def iterations(self):
+        """ Sorted list of iterations stored in the archive """
+        return sorted(self.index['iterations'].keys())
+
+    def _read_index(self):
+        with open(self.filename, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise IOError('%s is not a canopy archive' % self.filename)
+            offset, = struct.unpack('<Q', f.read(8))
+            f.seek(offset)
+            return pickle.load(f)
+
+    def _write_block(self, f, data):
+        """ Write raw bytes at end of data, aligned, and return their offset """
+        offset = f.tell()
+        padding = (-offset) % ALIGNMENT
+        f.write('\0' * padding)
+        f.write(data)
+        return offset + padding
+
+    def _write_array(self, f, array):
+        array = np.ascontiguousarray(array)
+        offset = self._write_block(f, array.tostring())
+        return (offset, array.dtype.str, array.shape)
+
+    def _array(self, block):
+        offset, dtype, shape = block
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    def _split_properties(self, g):
+        """ Find properties of g that can be stored as columns of numbers """
+        columns = {}
+        for name, values in g.properties().iteritems():
+            if name == 'geometry' or len(values) == 0:
+                continue
+            if all(isinstance(v, numbers.Number) for v in values.itervalues()):
+                vids = np.array(values.keys(), dtype=np.int64)
+                array = np.array([values[vid] for vid in vids.tolist()])
+                if array.dtype != object:
+                    columns[name] = (vids, array)
+        return columns
+
+    def _write_columns(self, f, columns):
+        return {name:{'vids':self._write_array(f, vids), 'values':self._write_array(f, values)}
+                for name, (vids, values) in columns.iteritems()}
+
+    def _read_columns(self, entry):
+        """ Read columns of entry as (vids, values) arrays by name of property """
+        return {name:(self._array(blocks['vids']), self._array(blocks['values']))
+                for name, blocks in entry['columns'].iteritems()}
+
+    def _write_geometry(self, f, entry, geometries, geometry=True):
+        """ Write meshes (or their summaries if not geometry) of elements in entry """
+        meshes = [(vid, mesh_arrays(geom)) for vid, geom in geometries.iteritems()
+                  if geom is not None]
+        if len(meshes) == 0:
+            return
+        vids = np.array([vid for vid, mesh in meshes], dtype=np.int64)
+        if not geometry:
+            lows = np.array([p.min(axis=0) for vid, (p, i) in meshes])
+            highs = np.array([p.max(axis=0) for vid, (p, i) in meshes])
+            entry['summaries'] = {'vids':self._write_array(f, vids),
+                                  'z_min':self._write_array(f, lows[:, 2]),
+                                  'z_max':self._write_array(f, highs[:, 2]),
+                                  'center':self._write_array(f, (lows + highs) / 2.)}
+        else:
+            nb_points = np.array([len(p) for vid, (p, i) in meshes], dtype=np.int64)
+            nb_triangles = np.array([len(i) for vid, (p, i) in meshes], dtype=np.int64)
+            entry['geometry'] = {'vids':self._write_array(f, vids),
+                                 'nb_points':self._write_array(f, nb_points),
+                                 'nb_triangles':self._write_array(f, nb_triangles),
+                                 'points':self._write_array(f, np.concatenate([p for vid, (p, i) in meshes])),
+                                 'triangles':self._write_array(f, np.concatenate([i for vid, (p, i) in meshes]))}
+
+    def _read_geometry(self, entry):
+        """ Read meshes (or their summaries) of elements in entry, None if no geometry """
+        if 'geometry' in entry:
+            blocks = entry['geometry']
+            vids = self._array(blocks['vids']).tolist()
+            points = self._array(blocks['points'])
+            triangles = self._array(blocks['triangles'])
+            ends_points = np.cumsum(self._array(blocks['nb_points']))
+            ends_triangles = np.cumsum(self._array(blocks['nb_triangles']))
+            geometry = {}
+            for k, vid in enumerate(vids):
+                start_p = ends_points[k-1] if k > 0 else 0
+                start_t = ends_triangles[k-1] if k > 0 else 0
+                geometry[vid] = mesh_from_arrays(points[start_p:ends_points[k]],
+                                                 triangles[start_t:ends_triangles[k]])
+            return geometry
+        elif 'summaries' in entry:
+            from alinea.alep.architecture import GeometrySummary
+            blocks = entry['summaries']
+            return {vid:GeometrySummary(tuple(center), z_min, z_max) 
+                    for vid, center, z_min, z_max in 
+                    zip(self._array(blocks['vids']).tolist(), 
+                        self._array(blocks['center']).tolist(),
+                        self._array(blocks['z_min']).tolist(),
+                        self._array(blocks['z_max']).tolist())}
+        return None
+
+    def _append(self, it, write_entry):
+        """ Write data of iteration 'it' with write_entry(f), returning its entry, and update index """
+        mode = 'r+b' if os.path.exists(self.filename) else 'w+b'
+        with open(self.filename, mode) as f:
+            if mode == 'w+b':
+                f.write(MAGIC + struct.pack('<Q', 0))
+            else:
+                # New data overwrites previous index
+                f.seek(len(MAGIC))
+                index_offset, = struct.unpack('<Q', f.read(8))
+                f.seek(index_offset)
+            self.index['iterations'][it] = write_entry(f)
+            index_offset = self._write_block(f, pickle.dumps(self.index, pickle.HIGHEST_PROTOCOL))
+            f.truncate()
+            f.seek(len(MAGIC))
+            f.write(struct.pack('<Q', index_offset))
+
+    def save(self, g, it, TT=None, geometry=True):
+        """ Append iteration 'it' of the canopy to the archive.
+
+        Parameters
+        ----------
+        g: MTG
+            MTG representing the canopy
+        it: int
+            Number of the iteration
+        TT: float
+            Thermal time of the canopy
+        geometry: bool
+            True to store meshes of elements, False to store only their summaries
+        """
+        columns = self._split_properties(g)
+        props = g.properties()
+        geometries = props.get('geometry', {})
+        removed = {name:props.pop(name) for name in columns}
+        if 'geometry' in props:
+            removed['geometry'] = props.pop('geometry')
+        try:
+            skeleton = pickle.dumps(g, pickle.HIGHEST_PROTOCOL)
+        finally:
+            props.update(removed)
+
+        def write_entry(f):
+            entry = {'TT':TT}
+            entry['skeleton'] = (self._write_block(f, skeleton), len(skeleton))
+            entry['columns'] = self._write_columns(f, columns)
+            self._write_geometry(f, entry, geometries, geometry)
+            return entry
+        self._append(it, write_entry)
+
+    def save_delta(self, it, base, changes, removed, geometries, TT=None, geometry=True):
+        """ Append iteration 'it' as changes of the canopy since previous iteration.
+
+        Parameters
+        ----------
+        it: int
+            Number of the iteration, the previous one must be in the archive
+        base: int
+            Iteration saved in full whose vertex ids are used in changes
+        changes: dict
+            New values of properties {name: {vid: value}}
+        removed: dict
+            Vertices which lost their value of property {name: [vids]}
+        geometries: dict
+            New geometries of elements {vid: geometry}
+        TT: float
+            Thermal time of the canopy
+        geometry: bool
+            True to store meshes of elements, False to store only their summaries
+        """
+        columns = {}
+        objects = {}
+        for name, values in changes.iteritems():
+            if len(values) == 0:
+                continue
+            vids = np.array(values.keys(), dtype=np.int64)
+            array = np.array([values[vid] for vid in vids.tolist()])
+            if (all(isinstance(v, numbers.Number) for v in values.itervalues()) and 
+                array.dtype != object):
+                columns[name] = (vids, array)
+            else:
+                objects[name] = values
+        objects = pickle.dumps(objects, pickle.HIGHEST_PROTOCOL)
+
+        def write_entry(f):
+            entry = {'TT':TT, 'base':base, 'removed':removed}
+            entry['objects'] = (self._write_block(f, objects), len(objects))
+            entry['columns'] = self._write_columns(f, columns)
+            self._write_geometry(f, entry, geometries, geometry)
+            return entry
+        self._append(it, write_entry)
+
+    def is_delta(self, it):
+        """ True if iteration 'it' is stored as changes since previous iteration """
+        return 'base' in self.index['iterations'][it]
+
+    def apply(self, g, it):
+        """ Update in place canopy g, at iteration 'it' - 1 of the archive, to iteration 'it'.
+
+        If iteration 'it' is saved in full, the canopy is loaded instead of updated.
+        Properties of a disease store bound to g are not updated.
+
+        Returns
+        -------
+        g: MTG
+            MTG representing the canopy, same object as given if updated in place
+        TT: float
+            Thermal time of the canopy
+        """
+        if it not in self:
+            raise KeyError('Iteration %d not in %s' % (it, self.filename))
+        if not self.is_delta(it):
+            return self.load(it)
+        entry = self.index['iterations'][it]
+        props = g.properties()
+        # Disease state of a bound store is kept, as when binding it to a loaded canopy
+        store = get_disease_store(g)
+        kept = set(store.names) if store is not None else set()
+        for name, vids in entry['removed'].iteritems():
+            if name in kept:
+                continue
+            values = props.get(name, {})
+            for vid in vids:
+                values.pop(vid, None)
+        offset, length = entry['objects']
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            objects = pickle.loads(f.read(length))
+        for name, values in objects.iteritems():
+            if name in kept:
+                continue
+            if name not in props:
+                props[name] = {}
+            props[name].update(values)
+        for name, (vids, values) in self._read_columns(entry).iteritems():
+            if name in kept:
+                continue
+            if name not in props:
+                props[name] = ColumnProperty(vids, values)
+            else:
+                props[name].update(zip(vids.tolist(), values.tolist()))
+        geometry = self._read_geometry(entry)
+        if geometry is not None:
+            props.setdefault('geometry', {}).update(geometry)
+        return g, entry['TT']
+
+    def load(self, it):
+        """ Load iteration 'it' of the canopy.
+
+        Returns
+        -------
+        g: MTG
+            MTG representing the canopy
+        TT: float
+            Thermal time of the canopy
+        """
+        if it not in self:
+            raise KeyError('Iteration %d not in %s' % (it, self.filename))
+        entry = self.index['iterations'][it]
+        if self.is_delta(it):
+            g, TT = self.load(entry['base'])
+            for delta_it in range(entry['base']+1, it+1):
+                g, TT = self.apply(g, delta_it)
+            return g, TT
+        offset, length = entry['skeleton']
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            g = pickle.loads(f.read(length))
+        props = g.properties()
+        for name, (vids, values) in self._read_columns(entry).iteritems():
+            props[name] = ColumnProperty(vids, values)
+        geometry = self._read_geometry(entry)
+        if geometry is not None:
+            props['geometry'] = geometry
+        return g, entry['TT']
+
+class CanopyDeltaWriter(object):
+    """ Save successive iterations of a canopy in an archive as changes since previous iteration.
+
+    Elements of successive canopies are matched by their stable labels (see 
+    'alinea.alep.disease_store.stable_label'). An iteration is saved in full when 
+    elements appear or disappear, otherwise only new values of properties and 
+    new geometries of elements are saved.
+    """
+    def __init__(self, archive, geometry=True):
+        """ Initialize the writer.
+
+        Parameters
+        ----------
+        archive: CanopyArchive or str
+            Archive of the canopy or path of its file
+        geometry: bool
+            True to store meshes of elements, False to store only their summaries
+        """
+        if not isinstance(archive, CanopyArchive):
+            archive = CanopyArchive(archive)
+        self.archive = archive
+        self.geometry = geometry
+        self.base = None
+        self.base_vids = None
+        self.state = None
+
+    def _state(self, g, labels):
+        """ Values of properties and hashes of geometries by stable label """
+        import hashlib
+        state = {}
+        for name, values in g.properties().iteritems():
+            if name == 'geometry':
+                hashes = {}
+                for vid, geom in values.iteritems():
+                    if geom is not None:
+                        points, indices = mesh_arrays(geom)
+                        hashes[labels[vid]] = hashlib.md5(points.tostring()+indices.tostring()).hexdigest()
+                state[name] = hashes
+            else:
+                state[name] = {labels[vid]:value for vid, value in values.iteritems() if vid in labels}
+        return state
+
+    def save(self, g, it, TT=None):
+        """ Append iteration 'it' of the canopy to the archive, in full or as changes. """
+        from alinea.alep.disease_store import stable_labels
+        labels = stable_labels(g)
+        state = self._state(g, labels)
+        if self.base_vids is None or set(self.base_vids) != set(labels.itervalues()):
+            self.archive.save(g, it, TT, geometry=self.geometry)
+            self.base = it
+            self.base_vids = {label:vid for vid, label in labels.iteritems()}
+        else:
+            base_vids = self.base_vids
+            changes = {}
+            removed = {}
+            for name, values in state.iteritems():
+                if name == 'geometry':
+                    continue
+                previous = self.state.get(name, {})
+                changes[name] = {base_vids[label]:value for label, value in values.iteritems()
+                                 if label not in previous or _changed(value, previous[label])}
+                removed[name] = [base_vids[label] for label in previous if label not in values]
+            for name in self.state:
+                if name not in state:
+                    removed[name] = [base_vids[label] for label in self.state[name]]
+            removed = {name:vids for name, vids in removed.iteritems() if len(vids) > 0}
+            previous = self.state.get('geometry', {})
+            hashes = state.get('geometry', {})
+            new_geometries = {base_vids[labels[vid]]:geom 
+                              for vid, geom in g.properties().get('geometry', {}).iteritems()
+                              if geom is not None and 
+                              previous.get(labels[vid]) != hashes.get(labels[vid])}
+            self.archive.save_delta(it, self.base, changes, removed, new_geometries, TT, 
+                                    geometry=self.geometry)
+        self.state = state
+
+class CanopyDeltaReader(object):
+    """ Load successive iterations of a delta archive, updating in place the canopy
+    of the previous iteration when possible.
+    """
+    def __init__(self, archive):
+        """ Initialize the reader.
+
+        Parameters
+        ----------
+        archive: CanopyArchive or str
+            Archive of the canopy or path of its file
+        """
+        if not isinstance(archive, CanopyArchive):
+            archive = CanopyArchive(archive)
+        self.archive = archive
+        self.g = None
+        self.it = None
+
+    def load(self, it, g=None):
+        """ Get iteration 'it' of the canopy.
+
+        If g is the canopy returned for iteration 'it' - 1 and iteration 'it' is 
+        saved as changes, g is updated in place and returned. Otherwise a new MTG 
+        is loaded.
+
+        Returns
+        -------
+        g: MTG
+            MTG representing the canopy
+        TT: float
+            Thermal time of the canopy
+        """
+        if (g is not None and g is self.g and self.it == it - 1 and 
+            it in self.archive and self.archive.is_delta(it)):
+            g, TT = self.archive.apply(g, it)
+        else:
+            g, TT = self.archive.load(it)
+        self.g = g
+        self.it = it
+        return g, TT
+
+def archive_canopies(adel, wheat_dir, filename=None, geometry=True, delta=False):
+    """ Gather in a snapshot archive the canopies saved with adel in wheat_dir.
+
+    Parameters
+    ----------
+    adel: AdelWheat
+        Model of wheat that saved the canopies
+    wheat_dir: str
+        Directory of canopies saved with 'adel.save'
+    filename: str
+        Path of the archive. By default, given by 'canopy_archive_path(wheat_dir, light)'
+    geometry: bool
+        False to build a light archive, without meshes (see 'CanopyArchive.save')
+    delta: bool
+        True to save iterations as changes since the previous one (see 'CanopyDeltaWriter')
+
+    Returns
+    -------
+    archive: CanopyArchive
+        Archive of the canopies
+    """
+    if filename is None:
+        filename = canopy_archive_path(wheat_dir, light=not geometry, delta=delta)
+    tmp_filename = filename + '.tmp'
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    archive = CanopyArchive(tmp_filename)
+    writer = CanopyDeltaWriter(archive, geometry=geometry) if delta else None
+    it = 0
+    while True:
+        try:
+            g, TT = adel.load(it, dir=wheat_dir)
+        except IOError:
+            break
+        if writer is not None:
+            writer.save(g, it, TT)
+        else:
+            archive.save(g, it, TT, geometry=geometry)
+        it += 1
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+    return CanopyArchive(filename)
+
+# Prefetch ########################################################################
+class CanopyPrefetcher(object):
+    """ Load iterations of a canopy archive, preparing the next one in a background thread.
+
+    After iteration 'it' is returned by 'load', iteration 'it + 1' is loaded in a
+    thread while the simulation runs on the current canopy.
+    """
+    def __init__(self, archive):
+        """ Initialize the prefetcher.
+
+        Parameters
+        ----------
+        archive: CanopyArchive or str
+            Archive of the canopy or path of its file
+        """
+        if not isinstance(archive, CanopyArchive):
+            archive = CanopyArchive(archive)
+        self.archive = archive
+        self._thread = None
+        self._pending = None
+        self._result = None
+
+    def _prefetch(self, it):
+        def target():
+            try:
+                self._result = (self.archive.load(it), None)
+            except Exception:
+                self._result = (None, sys.exc_info())
+        self._pending = it
+        self._result = None
+        self._thread = threading.Thread(target=target, name='canopy_prefetch_%d' % it)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def load(self, it):
+        """ Load iteration 'it' of the canopy and start prefetching the next one.
+
+        Returns
+        -------
+        g: MTG
+            MTG representing the canopy
+        TT: float
+            Thermal time of the canopy
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            if self._pending == it:
+                canopy, exc_info = self._result
+                self._result = None
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                canopy = self.archive.load(it)
+        else:
+            canopy = self.archive.load(it)
+        if it + 1 in self.archive:
+            self._prefetch(it + 1)
+        return canopy
@@ -0,0 +1,210 @@
+""" Store of the state of diseases on the canopy, kept outside of the MTG.
+
+    Disease properties (e.g. 'lesions', 'dispersal_units') are stored by stable
+    labels of leaf elements (plant, axis, metamer, element) instead of vertex ids.
+    The MTG only receives views of these properties, indexed by vertex id through
+    the current binding label <-> vid. Protocol functions and recorders use them
+    as usual with g.property(name).
+
+    When the canopy is replaced by a new MTG (e.g. loaded from disk in 'grow_canopy'),
+    binding the store to the new MTG installs views of the disease properties in
+    place of those moved by 'move_properties': no lesion nor dispersal unit
+    changes hands, only the index label <-> vid is rebuilt.
+
+    Plant models whose elements are not identified by their labels and complexes
+    (e.g. 'alinea.alep.vine') give their own label function to the store.
+
+"""
+
+# Imports #########################################################################
+import collections
+
+DISEASE_PROPERTIES = ('lesions', 'dispersal_units', 'healthy_area')
+
+def stable_label(g, vid):
+    """ Get labels of vertex vid and of its complexes, from plant to element.
+
+    Parameters
+    ----------
+    g: MTG
+        MTG representing the canopy
+    vid: int
+        Id of the vertex in the MTG
+
+    Returns
+    -------
+    label: tuple
+        e.g. ('plant1', 'MS', 'metamer3', 'LeafElementA1')
+    """
+    labels = []
+    while vid is not None and vid != g.root:
+        labels.append(g.label(vid))
+        vid = g.complex(vid)
+    return tuple(reversed(labels))
+
+def stable_labels(g, vids=None):
+    """ Get stable labels of vertices of g, duplicated labels being distinguished
+    by order of vertex ids as in the disease store.
+
+    Parameters
+    ----------
+    g: MTG
+        MTG representing the canopy
+    vids: list of int
+        Ids of the vertices, all vertices of g except its root if None
+
+    Returns
+    -------
+    labels: dict
+        Stable labels by vertex id
+    """
+    if vids is None:
+        vids = [vid for vid in g.vertices() if vid != g.root]
+    labels = {}
+    used = set()
+    for vid in sorted(vids):
+        label = stable_label(g, vid)
+        if label in used:
+            count = 1
+            while label + (count,) in used:
+                count += 1
+            label = label + (count,)
+        labels[vid] = label
+        used.add(label)
+    return labels
+
+def get_disease_store(g):
+    """ Get the disease store bound to g, None if disease properties are plain dicts """
+    for prop in g.properties().itervalues():
+        if isinstance(prop, StoreProperty):
+            return prop.store
+    return None
+
+# Views of properties #############################################################
+class StoreProperty(collections.MutableMapping):
+    """ View by vertex id of a property of the disease store, installed in the MTG """
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    @property
+    def data(self):
+        return self.store.data[self.name]
+
+    def __getitem__(self, vid):
+        try:
+            return self.data[self.store.label(vid)]
+        except KeyError:
+            raise KeyError(vid)
+
+    def __setitem__(self, vid, value):
+        self.data[self.store.label(vid)] = value
+
+    def __delitem__(self, vid):
+        try:
+            del self.data[self.store.label(vid)]
+        except KeyError:
+            raise KeyError(vid)
+
+    def __contains__(self, vid):
+        return vid in self.store.labels and self.store.labels[vid] in self.data
+
+    def __iter__(self):
+        vids = self.store.vids
+        for label in self.data.keys():
+            if label in vids:
+                yield vids[label]
+
+    def __len__(self):
+        vids = self.store.vids
+        return sum(1 for label in self.data if label in vids)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+# Store ###########################################################################
+class DiseaseStore(object):
+    """ State of diseases on the canopy indexed by stable labels of leaf elements. """
+    def __init__(self, g, names=DISEASE_PROPERTIES, label=stable_label):
+        """ Create the store with the disease properties of g, and bind it to g.
+
+        Parameters
+        ----------
+        g: MTG
+            MTG representing the canopy
+        names: list of str
+            Names of the disease properties to keep in the store
+        label: function
+            Function label(g, vid) giving the stable label of a vertex
+        """
+        self.names = list(names)
+        self.label_function = label
+        self.data = {name:{} for name in self.names}
+        self.g = None
+        self.labels = {}
+        self.vids = {}
+        self.index(g)
+        props = g.properties()
+        for name in self.names:
+            self.data[name].update((self.label(vid), value)
+                                   for vid, value in props.get(name, {}).iteritems())
+        self.install(g)
+
+    def index(self, g):
+        """ Build index label <-> vid for the elements of g """
+        self.g = g
+        self.labels = {}
+        self.vids = {}
+        for vid in g.vertices(scale=g.max_scale()):
+            self._register(vid)
+
+    def _register(self, vid):
+        label = self.label_function(self.g, vid)
+        if label in self.vids:
+            # Duplicated labels are distinguished by order of appearance
+            count = 1
+            while label + (count,) in self.vids:
+                count += 1
+            label = label + (count,)
+        self.labels[vid] = label
+        self.vids[label] = vid
+        return label
+
+    def label(self, vid):
+        """ Stable label of vertex vid, registered if vid is new in the canopy """
+        try:
+            return self.labels[vid]
+        except KeyError:
+            if not self.g.has_vertex(vid):
+                raise
+            return self._register(vid)
+
+    def install(self, g):
+        """ Replace disease properties of g by views of the store """
+        props = g.properties()
+        for name in self.names:
+            props[name] = StoreProperty(self, name)
+
+    def bind(self, g, prune=True):
+        """ Bind the store to a new MTG representing the canopy.
+
+        Parameters
+        ----------
+        g: MTG
+            New MTG representing the canopy
+        prune: bool
+            True to forget the state of elements that are not in the new canopy
+        """
+        self.index(g)
+        if prune:
+            for name in self.names:
+                data = self.data[name]
+                for label in [l for l in data if l not in self.vids]:
+                    del data[label]
+        self.install(g)
+        return g
+
+    def by_label(self, name):
+        """ Values of property 'name' by stable label of elements of the current canopy """
+        return {label:value for label, value in self.data[name].iteritems()
+                if label in self.vids}
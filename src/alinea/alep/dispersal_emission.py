@@ -3,7 +3,7 @@
 """
 
 # Imports #########################################################################
-from alinea.alep.architecture import get_total_leaf_area
+from alinea.alep.architecture import get_total_leaf_area, climate_value
 from alinea.alep.septoria import SeptoriaDU
 from alinea.alep.powdery_mildew import PowderyMildewDU
 from math import exp
@@ -117,7 +117,7 @@ class SeptoriaRainEmission:
                 # Compute number of dispersal units emitted by lesion
                 leaf = g.node(vid)
                 total_DU_leaf = 0.36 * 6.19e7 * intercept * tot_fraction_spo *\
-                                leaf.rain_intensity * domain_area
+                                climate_value(g, 'rain_intensity', vid, 0.) * domain_area
                 
                 if lesion.is_stock_available(leaf):
                     initial_stock = lesion.stock_spores
@@ -198,7 +198,7 @@ class BenchSeptoriaRainEmission:
             for lesion in l:
                 # Compute number of dispersal units emitted by lesion
                 leaf = g.node(vid)
-                total_DU_leaf = 0.36 * 6.19e7 * intercept * tot_fraction_spo * leaf.rain_intensity * self.domain_area
+                total_DU_leaf = 0.36 * 6.19e7 * intercept * tot_fraction_spo * climate_value(g, 'rain_intensity', vid, 0.) * self.domain_area
 
                 initial_stock = lesion.stock_spores
                 stock_available = int(lesion.stock_spores*2/3.)
@@ -1 +1 @@
-""" Gather different strategies for modeling dispersal of fungus propagules."""# Imports #########################################################################import randomimport numpyimport collectionsfrom alinea.alep.fungus import Fungusfrom alinea.alep.architecture import get_leaves# Useful function #################################################################def is_iterable(obj):    """ Test if object is iterable """    return isinstance(obj, collections.Iterable)# Random dispersal ################################################################class RandomDispersal:    """ Template class for a dispersal model that complies with the guidelines of Alep.        A class for a model of dispersal must include a method 'disperse'. In this example,    dispersal units are randomly distributed.        """    def disperse(self, g, dispersal_units, time_control = None):        """ Example method for dispersal with random distribution.                Parameters        ----------        g: MTG            MTG representing the canopy (and the soil)        dispersal_units : dict            Dispersal units emitted by the lesions on leaves                    Returns        -------        deposits : dict            Dispersal units deposited on new position on leaves        """        # vids = scene.todict().keys()        try:            dt = time_control.dt        except:            dt = 1                vids = [id for id,v in g.property('geometry').iteritems()]        n = len(vids)        deposits = {}        if dt > 0:            for vid, dlist in dispersal_units.iteritems():                for d in dlist:                    if random.random() < 0.1:                        if n>=1:                            idx = random.randint(0,n-1)                            v = vids[idx]                            d.set_position([0, 0])                            deposits.setdefault(v,[]).append(d)                return deposits        # Septoria rain dispersal #########################################################class SeptoriaRainDispersal:    """ Template class for a model of dispersal by rain that complies with the     guidelines of Alep.        A class for a model of dispersal must include a method 'disperse'. In this example,    dispersal units are first distributed updward in a semi-sphere normal to source leaf.    After, those which are left are deposited downward on leaves comprised in a cylinder    whose dimension is calculated according to the size of the semi-sphere.        """        def __init__(self, k=0.148, precision=0.01, label='LeafElement', fungus=None):        """ Initialize the model with fixed parameters.                Parameters        ----------        k: float            Shape parameter of the exponential decreasing function        precision: float            Value defining distance max with the exponential decreasing function         label: str            Label of the part of the MTG concerned by the calculation        """        from math import log        self.label = label        self.k = k        self.distance_max = -log(precision)/k        if fungus is None:            self.fungus = Fungus()        else:            self.fungus = fungus       def disperse(self, g, dispersal_units, time_control = None, **kwds):        """ Compute distribution of dispersal units by rain splash.                1. Upward dispersal:        For each source of dispersal units, create a semi-sphere of dispersal         normal to the surface of source leaf. In the semi-sphere, target         leaves are sorted according to the distance from the source.                        Then distribute dispersal units from the closer target to the more far.        The number of dispersal units by target leaf is computed as in Robert et al. 2008                2. Downward dispersal:        Get leaves in a cylinder whose dimensions are related to the dimesions        of the semi-sphere in step 1. Then distribute dispersal units from top to bottom.                Parameters        ----------        g: MTG            MTG representing the canopy (and the soil)        dispersal_units : dict            Dispersal units emitted by the lesions on leaves                    Returns        -------        deposits : dict            Dispersal units deposited on new position on leaves        """        try:            dt = time_control.dt        except:            dt = 1                deposits = {}        if dt>0:            from alinea.astk.plantgl_utils import get_area_and_normal            from openalea.plantgl import all as pgl            from collections import OrderedDict            from math import exp, pi, cos, sin, tan            from random import shuffle            from copy import copy                        dmax = self.distance_max            tesselator = pgl.Tesselator()            bbc = pgl.BBoxComputer(tesselator)            leaves = get_leaves(g, label=self.label)            centroids = g.property('centroid')            geometries = g.property('geometry')            _, norm = get_area_and_normal(geometries)            areas = g.property('area')                                  def centroid(vid):                if is_iterable(geometries[vid]):                    bbc.process(pgl.Scene(geometries[vid]))                else:                    bbc.process(pgl.Scene([pgl.Shape(geometries[vid])]))                center = bbc.result.getCenter()                centroids[vid] = center                        for source, dus in dispersal_units.iteritems():                nb_tri = len(norm[source])                borders = numpy.linspace(0,1,num=nb_tri)                                dus_by_tri = {k: int(dus / nb_tri) for k in range(nb_tri)}                dus_by_tri[nb_tri-1] += dus % nb_tri                                for k,n in dus_by_tri.iteritems():                    source_normal = norm[source][k]                                        ## UPWARD ##                    # All leaves except the source are potential targets                    targets = list(leaf for leaf in leaves if leaf in geometries.iterkeys())                    targets.remove(source)                                        # Compute centroids                    centroid(source)                    for vid in targets:                        centroid(vid)                                        # Sort the vids based on the direction                     # TODO : modify source angle                    Origin = centroids[source]                    vects = {vid:(centroids[vid]-Origin) for vid in targets                             if (centroids[vid]-Origin)*source_normal >= 0}                                        # Sort the vids based on the distance                    distances = {vid:pgl.norm(vects[vid]) for vid in vects if pgl.norm(vects[vid])<dmax}                    distances = OrderedDict(sorted(distances.iteritems(), key=lambda x: x[1]))                                        # Distribute the dispersal units                    if len(distances.values())>0:                         sphere_area = 2*pi*distances.values()[-1]**2                        for leaf_id in distances:						    if n >= 1:								area_factor = areas[leaf_id]/sphere_area								distance_factor = exp(-self.k * distances[leaf_id])								qc = min(n, (n * area_factor * distance_factor))								deposits[leaf_id] = qc								n -= qc                                # break                                        ## DOWNWARD ##                    vects2 = {vid:(centroids[vid]-Origin) for vid in targets if not vid in vects}                    projection = {}                    alpha = pgl.angle(source_normal, (1,0,0))                    if alpha>=pi/2. or (alpha<pi/2. and source_normal[2]>=0):                        alpha+=pi/2.                    beta = pgl.angle(source_normal, (0,0,1))                    a = dmax                    b = dmax*cos(beta)                                        for leaf in vects2:                        if (centroids[leaf]-Origin)*(source_normal[0], source_normal[1], 0) >= 0:                            # Big side of the projection semi circle                            copy_centroid = copy(centroids[leaf])                            copy_origin = copy(Origin)                            copy_centroid[2] = 0.                            copy_origin[2] = 0.                            if pgl.norm(copy_centroid-copy_origin) < dmax:                                projection[leaf] = vects2[leaf]                        else:                            # Small side of the projection semi ellipse                            x = vects2[leaf][0]                            y = vects2[leaf][1]                            x2 = x*cos(alpha)+y*sin(alpha)                            y2 = -x*sin(alpha)+y*cos(alpha)                            if (x2**2)/(a**2) + (y2**2)/(b**2) < 1 :                                projection[leaf] = vects2[leaf]                    projection = OrderedDict(sorted(projection.items(), key=lambda x:x[1][2], reverse=True))                                        if len(projection)>0:                        n_big = int(n*(beta+pi/2.)/pi)                        n_small = n - n_big                        for leaf in projection:                            if n >= 1:                                copy_centroid = copy(centroids[leaf])                                copy_origin = copy(Origin)                                copy_centroid[2] = 0.                                copy_origin[2] = 0.                                if (centroids[leaf]-Origin)*(source_normal[0],source_normal[1],0) >= 0:                                    area_factor = areas[leaf]/(pi*dmax**2/2.)                                    dist = pgl.norm(copy_centroid-copy_origin)                                    distance_factor = exp(-self.k * dist)                                    qc = min(n_big, (n_big * area_factor * distance_factor))                                else:                                    area_factor = areas[leaf]/(pi*a*b/2.)                                    dist = pgl.norm(copy_centroid-copy_origin)/abs(cos(pgl.angle(source_normal, (1,0,0))+pi/2.))                                    distance_factor = exp(-self.k * dist)                                    qc = min(n_small, (n_small * area_factor * distance_factor))                                    # import pdb                                    # pdb.set_trace()                                qc = min(qc, n)                                deposits[leaf] = qc                                n-=qc                            for vid, dep in deposits.iteritems():            du = self.fungus.dispersal_unit()            du.set_nb_dispersal_units(nb_dispersal_units=dep)            deposits[vid] = [du]                return deposits            def plot_distri_3d(self, g):        from alinea.alep.architecture import set_property_on_each_id        from alinea.alep.alep_color import alep_colormap, green_yellow_red        from alinea.alep.disease_outputs import plot3d_transparency        from openalea.plantgl.all import Viewer        import matplotlib.pyplot as plt        # Compute severity by leaf        dus = g.property("dispersal_units")        deposits = {k:sum([du.nb_dispersal_units for du in v]) for k,v in dus.iteritems()}        set_property_on_each_id(g, 'nb_dispersal_units', deposits)            # Visualization        vmax = 2*max(deposits.values())/3        g = alep_colormap(g, 'nb_dispersal_units', cmap=green_yellow_red(),                           lognorm=False, zero_to_one=False,                           vmax = vmax)        d = [numpy.arange(vmax)]        fig, ax = plt.subplots()        ax.imshow(d, cmap = green_yellow_red())        for id in g:            if not id in deposits:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            elif deposits[id]==0.:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            else:                g.node(id).transparency = 0.                              scene = plot3d_transparency(g)        Viewer.display(scene)        # Powdery mildew wind dispersal ###################################################class PowderyMildewWindDispersal:    """ Template class for a model of dispersal by wind that complies with the     guidelines of Alep.        A class for a model of dispersal must include a method 'disperse'. In this example,    dispersal units are distributed in a cone of dispersal in the direction of the wind.    This model is adapted from the work of Calonnec et al., 2008 on powdery mildew.        """        def __init__(self, cid=0.04, a0=45., reduction=100., k_beer=0.5, label='lf', wind_direction=(1, 0, 0), fungus=None):        """ Initialize the model with fixed parameters.                Parameters        ----------        cid: float            Spore decay with distance        a0: float            Angle of the cone of dispersal        reduction: float            Reduction parameter to limit the number of spores reaching a surface.            Regarding the equation, this parameter must be homogeneous to a surface.        k_beer: float            Value of k in the Beer-Lambert law for simplification of interception             of spores in the canopy.        label: str            Label of the part of the MTG concerned by the calculation        wind_direction (3-tuple) the wind direction vector        """        self.cid = cid        self.a0 = a0        self.reduction = reduction        self.k_beer = k_beer        self.label = label        self.wind_direction = wind_direction        print('')        print('Be careful conversion l.228 dispersal')        print('Be careful Beer law commented l.229 dispersal')                if fungus is None:            self.fungus = Fungus()        else:            self.fungus = fungus                def disperse(self, g, dispersal_units, time_control = None):        """ Compute dispersal of spores of powdery mildew by wind in a cone.                For each source of dispersal units, create a cone of dispersal         in which target leaves are sorted:        1. according to the wind direction        2. according to the angle a0        3. according to the distance from the source                Then distribute dispersal units from the closer target to the more far.        The number of dispersal units by target leaf is computed as in        Calonnec et al. 2008.                Parameters        ----------        g: MTG            MTG representing the canopy (and the soil)        dispersal_units : dict            Dispersal units emitted by the lesions on leaves                    Returns        -------        deposits : dict            Dispersal units deposited on new position on leaves        """        try:            dt = time_control.dt        except:            dt = 1                deposits = {}        if dt > 0:            from openalea.plantgl import all as pgl            from random import shuffle            from math import degrees, exp, tan, pi, radians            from collections import OrderedDict            geometries = g.property('geometry')            centroids = g.property('centroid')            areas = g.property('area')            wind_directions = g.property('wind_direction')            tesselator = pgl.Tesselator()            bbc = pgl.BBoxComputer(tesselator)                    leaves = get_leaves(g, label=self.label)            def centroid(vid):                if is_iterable(geometries[vid]):                    bbc.process(pgl.Scene(geometries[vid]))                else:                    bbc.process(pgl.Scene([pgl.Shape(geometries[vid])]))                center = bbc.result.getCenter()                centroids[vid] = center                        def area(vid):                # areas[vid] = pgl.surface(geometries[vid][0])*1000                areas[vid] = pgl.surface(geometries[vid][0])            for source, dus in dispersal_units.iteritems():                # TODO: Special computation for interception by source leaf                                # All other leaves are potential targets                targets = list(leaf for leaf in leaves if leaf in geometries.iterkeys())                targets.remove(source)                                # Compute centroids                centroid(source)                for vid in targets:                    centroid(vid)                    # surface(vid)                # Sort the vids based on the direction                 Origin = centroids[source]                vects = {vid:(centroids[vid]-Origin) for vid in targets                         if (centroids[vid]-Origin)*wind_directions.get(source, self.wind_direction) >= 0}                                # Sort the vids based on the angle                                angles = {vid:degrees(pgl.angle(vect, wind_directions.get(source, self.wind_direction)))                           for vid, vect in vects.iteritems()                          if degrees(pgl.angle(vect, wind_directions.get(source, self.wind_direction)))<= self.a0}                                # Sort the vids based on the distance                distances = {vid:pgl.norm(vects[vid]) for vid in angles}                distances = OrderedDict(sorted(distances.iteritems(), key=lambda x: x[1]))                                               # Beer law inside cone to take into account leaf coverage                n = dus                if len(distances.values())>0:                    for leaf in distances:                        # qc = min(n, (n * (areas[leaf]/self.reduction) *                              # exp(-self.cid * distances[leaf]) *                              # (self.a0 - angles[leaf])/self.a0))                        surf_base_cone = pi*(tan(radians(self.a0))*distances[leaf])**2                        area_factor = min(1, areas[leaf]/surf_base_cone)                        # import pdb                        # pdb.set_trace()                        qc = min(n, (n * area_factor *                              exp(-self.cid * distances[leaf]) *                              (self.a0 - angles[leaf])/self.a0))                                                # if qc < 1:                            # for d in dus:                                # d.disable()                            # break                                                                    deposits[leaf] = int(qc)                        n -= int(qc)                        # if len(dus) < 1 or len(deposits[leaf]) < 1:                        if n < 1:                            break                                    for vid, dep in deposits.iteritems():            du = self.fungus.dispersal_unit()            du.set_nb_dispersal_units(nb_dispersal_units=dep)            deposits[vid] = [du]                                return deposits                    def plot_distri_3d(self, g):        from alinea.alep.architecture import set_property_on_each_id        from alinea.alep.alep_color import alep_colormap, green_yellow_red        from alinea.alep.disease_outputs import plot3d_transparency        from openalea.plantgl.all import Viewer        import matplotlib.pyplot as plt        # Compute severity by leaf        dus = g.property("dispersal_units")        deposits = {k:sum([du.nb_dispersal_units for du in v]) for k,v in dus.iteritems()}        set_property_on_each_id(g, 'nb_dispersal_units', deposits)            # Visualization        vmax = 2*max(deposits.values())/3        g = alep_colormap(g, 'nb_dispersal_units', cmap=green_yellow_red(),                           lognorm=False, zero_to_one=False,                           vmax = vmax)        d = [numpy.arange(vmax)]        fig, ax = plt.subplots()        ax.imshow(d, cmap = green_yellow_red())        for id in g:            if not id in deposits:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            elif deposits[id]==0.:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            else:                g.node(id).transparency = 0.                              scene = plot3d_transparency(g)        Viewer.display(scene)        # Brown Rust wind dispersal (horizontal layers) ###############################def compute_overlaying(nb_du, area, impact_surface):    # true_area_impacted = areas[vid] * (1 - min(1., numpy.exp(-nb_du * impact_surface / areas[vid])))    # new_nb_du = int(true_area_impacted / diameter)    return max(1, int((1 - min(1., numpy.exp(-nb_du * impact_surface / area)))*(area/impact_surface)))class BrownRustDispersal:    import sys    sys.setrecursionlimit(10000)    """ Calculate distribution of dispersal units in horizontal layers """    def __init__(self, fungus = None,                 group_dus = False,                 domain_area = 1.,                 convUnit = 0.01,                 layer_thickness = 1.,                 k_dispersal = 0.07,                 k_beer = 0.5):                     if fungus is not None:            self.fungus = fungus        else:            self.fungus = Fungus()        self.group_dus = group_dus        self.domain_area = domain_area        self.convUnit = convUnit        self.layer_thickness = layer_thickness        self.k_dispersal = k_dispersal        self.k_beer = k_beer    def leaves_in_grid(self, g, label = 'LeafElement'):        from openalea.plantgl import all as pgl        from alinea.alep.fungus import Fungus        geometries = g.property('geometry')        centroids = g.property('centroid')        areas = g.property('area')        tesselator = pgl.Tesselator()        bbc = pgl.BBoxComputer(tesselator)              leaves = get_leaves(g, label=label)        leaves = [l for l in leaves if l in geometries]                # Get centroids                def centroid(vid):            if is_iterable(geometries[vid]):                bbc.process(pgl.Scene(geometries[vid]))            else:                bbc.process(pgl.Scene([pgl.Shape(geometries[vid])]))            center = bbc.result.getCenter()            centroids[vid] = center                if len(leaves)>0:            for vid in leaves:                centroid(vid)                            # Define grid (horizontal layers)            zs = [c[2] for c in centroids.itervalues()]            minz = min(zs)            maxz = max(zs) + self.layer_thickness            layers = {l:[] for l in numpy.arange(minz, maxz, self.layer_thickness)}                        # Distribute leaves in layers            for vid, coords in centroids.iteritems():                z = coords[2]                ls = layers.keys()                i_layer = numpy.where(map(lambda x: x<=z<x+self.layer_thickness                                         if z!=maxz - self.layer_thickness                                        else x<=z<=x+self.layer_thickness , ls))[0]                if len(i_layer) > 0. and areas[vid]>1e-10:                    layers[ls[i_layer]].append(vid)                        self.layers = layers        else:            self.layers = {}    def get_dispersal_units(self, g,                             fungus_name = "brown_rust",                             label = 'LeafElement',                            weather_data = None, **kwds):        lesions = g.property('lesions')        return {vid:sum([l.emission() for l in les if l.is_sporulating                         and l.fungus.name.startswith(fungus_name)])                         for vid, les in lesions.iteritems()}    def disperse(self, g, dispersal_units = {}, weather_data = None,                 label='LeafElement', domain_area=None, **kwds):                             def expo_decrease(dist):            return numpy.exp(-self.k_dispersal*dist)                    def left_in_canopy(nb_dus, layer, max_height):            xmax = numpy.arange(100)            ymax = expo_decrease(xmax)            x_up = numpy.arange(max_height-layer)            y_up = expo_decrease(x_up)            upward = numpy.trapz(y_up,x_up)/numpy.trapz(ymax,xmax)            x_down = numpy.arange(max_height)            y_down = expo_decrease(x_down)            downward = numpy.trapz(y_down,x_down)/numpy.trapz(ymax,xmax)            return nb_dus*(upward+downward)/2.                self.leaves_in_grid(g, label=label)        # Group DUs in layers and reduce global number according to Beer Law        areas = g.property('area')        geom = g.property('geometry')        labels = g.property('label')        areas = {k:v for k,v in areas.iteritems()                 if k in geom and labels[k].startswith('LeafElement')}        total_area = sum(areas.values())        if domain_area is None:            domain_area = self.domain_area        lai = total_area*(self.convUnit**2)/domain_area if domain_area>0. else 0.        beer_factor = 1-numpy.exp(-self.k_beer * lai)        dus_by_layer = {layer:sum([dispersal_units[v]                        for v in vids if v in dispersal_units])*beer_factor                        for layer, vids in self.layers.iteritems()}        max_height = max(self.layers.keys())        dus_by_layer = {layer:left_in_canopy(nb_dus, layer, max_height)                        for layer, nb_dus                         in dus_by_layer.iteritems() if nb_dus>0.}                        def sum_nb(nb_leaves, nb_du):            if nb_leaves == 1:                return [nb_du]            elif nb_du == 0:                return [0] + sum_nb(nb_leaves-1, nb_du)            else:                nb_du_avg = float(nb_du/nb_leaves)                nb_du_sup = 2.*nb_du_avg                if nb_du_sup >= 1:                    nb_on_vid = int(round(max(0, min(nb_du, numpy.random.normal(nb_du_avg, nb_du_sup)))))                else:                    nb_on_vid = 1 if numpy.random.random()<nb_du_sup else 0                return [nb_on_vid] + sum_nb(nb_leaves-1, nb_du - nb_on_vid)                        deposits = {}        for source, nb_dus in dus_by_layer.iteritems():            probas = {}            for target, vids in self.layers.iteritems():                nb_vids = len(vids)                if nb_vids>0:                    dist = abs(source - target)                    area_l = (sum([areas[vid] for vid in vids])*self.convUnit**2)/self.domain_area                    proba_lai = 1-numpy.exp(-self.k_beer * area_l)                    proba_dist = numpy.exp(-self.k_dispersal*dist)                    try:                        probas[target] += proba_lai*proba_dist                    except:                        probas[target] = proba_lai*proba_dist            total_probas = sum([p for p in probas.itervalues()])                        for layer, proba in probas.iteritems():                proba /= total_probas                nb_depo_layer = numpy.random.binomial(nb_dus, proba)                vids = self.layers[layer]                nb_vids = len(vids)                distribution_by_leaf = sum_nb(nb_vids, nb_depo_layer)                numpy.random.shuffle(distribution_by_leaf)                for i_lf, lf in enumerate(vids):                    if distribution_by_leaf[i_lf] > 0.:                        depo = distribution_by_leaf[i_lf]                        depo = compute_overlaying(depo, areas[lf], numpy.pi*0.0015**2)                        try:                            deposits[lf] += depo                        except:                            deposits[lf] = depo        for vid, nb_dus in deposits.iteritems():            if self.group_dus==True:                du = self.fungus.dispersal_unit()                du.set_nb_dispersal_units(nb_dispersal_units = nb_dus)                deposits[vid] = [du]            else:                dus = []                for d in range(nb_dus):                    du = self.fungus.dispersal_unit(1)                    dus.append(du)                deposits[vid] = dus        return deposits    def plot_layers(self, g):        from alinea.alep.architecture import set_property_on_each_id        from alinea.alep.alep_color import alep_colormap        from alinea.alep.disease_outputs import plot3d_transparency        from openalea.plantgl.all import Viewer        # Compute severity by leaf        self.leaves_in_grid(g)        layers = self.layers        layer_by_leaf = {vid:k for k,v in layers.iteritems() for vid in v}        set_property_on_each_id(g, 'height', layer_by_leaf)            # Visualization        g = alep_colormap(g, 'height', cmap='prism',                           lognorm=False, zero_to_one=False)        geometries = g.property('geometry')         leaves = get_leaves(g, label='LeafElement')        leaves = [l for l in leaves if l in geometries]         transp = {vid:0. for k,v in layers.iteritems() for vid in v}        set_property_on_each_id(g, 'transparency', transp)                                 scene = plot3d_transparency(g)        Viewer.display(scene)            def view_distri_layers(self, g, nb_dispersal_units = 1e5, vmax = None,                           position_source = 3./5, return_df=False):        from alinea.alep.architecture import set_property_on_each_id        from alinea.alep.alep_color import alep_colormap, green_yellow_red        from alinea.alep.disease_outputs import plot3d_transparency        from openalea.plantgl.all import Viewer        import matplotlib.pyplot as plt        import pandas as pd        # Compute severity by leaf        self.leaves_in_grid(g)        layers = self.layers.keys()        layers.sort()                layer = layers[int(position_source*len(layers))]        if len(self.layers[layer])>0:            leaf = self.layers[layer][0]        else:            non_empty = {k:v for k,v in self.layers.iteritems() if len(v)>0}            leaf = self.layers[min(non_empty.keys(), key=lambda k:abs(k-layer))][0]        deposits = {k:sum([du.nb_dispersal_units for du in v]) for k,v in                     self.disperse(g, dispersal_units = {leaf : nb_dispersal_units}).iteritems()}          set_property_on_each_id(g, 'nb_dispersal_units', deposits)            # Visualization        if vmax is None:            vmax = 2*max(deposits.values())/3        g = alep_colormap(g, 'nb_dispersal_units', cmap=green_yellow_red(),                           lognorm=False, zero_to_one=False,                           vmax = vmax)        d = [numpy.arange(vmax)]        fig, ax = plt.subplots()        ax.imshow(d, cmap = green_yellow_red())        transp = {vid:0. for k,v in self.layers.iteritems() for vid in v}        set_property_on_each_id(g, 'transparency', transp)           for id in g:            if not id in deposits:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            elif deposits[id]==0.:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            else:                g.node(id).transparency = 0.                              scene = plot3d_transparency(g)        Viewer.display(scene)                if return_df==True:                    depo_layer = {k:sum([deposits[vid] for vid in v if vid in deposits])                            for k,v in self.layers.iteritems()}            df = pd.DataFrame([[k,v] for k, v in depo_layer.iteritems()])            df = df.sort(0)            df[2] = df[1]/df[1].sum()            fig, ax = plt.subplots()            ax.plot(df[2], df[0], 'k')            ax.set_ylabel('Height', fontsize = 16)            ax.set_xlabel('Proportion of deposits', fontsize = 16)            return df            def plot_distri_layers(self, g, nb_dispersal_units = 1000,                            position_source = 3./5):        import pandas as pd        import matplotlib.pyplot as plt        # Compute severity by leaf        self.leaves_in_grid(g)        layers = self.layers.keys()        layers.sort()                layer = layers[int(position_source*len(layers))]        if len(self.layers[layer])>0:            leaf = self.layers[layer][0]        else:            non_empty = {k:v for k,v in self.layers.iteritems() if len(v)>0}            leaf = self.layers[min(non_empty.keys(), key=lambda k:abs(k-layer))][0]        deposits = {k:sum([du.nb_dispersal_units for du in v]) for k,v in                     self.disperse(g, dispersal_units = {leaf : nb_dispersal_units}).iteritems()}        depo_layer = {k:sum([deposits[vid] for vid in v if vid in deposits])                        for k,v in self.layers.iteritems()}        df = pd.DataFrame([[k,v] for k, v in depo_layer.iteritems()])        df = df.sort(0)        df[2] = df[1]/df[1].sum()        fig, ax = plt.subplots()        ax.plot(df[2], df[0], 'k')        ax.set_ylabel('Height', fontsize = 16)        ax.set_xlabel('Proportion of deposits', fontsize = 16)                return d
\ No newline at end of file
+""" Gather different strategies for modeling dispersal of fungus propagules."""# Imports #########################################################################import randomimport numpyimport collectionsfrom scipy import sparsefrom alinea.alep.fungus import Fungusfrom alinea.alep.architecture import get_leaves# Useful function #################################################################def is_iterable(obj):    """ Test if object is iterable """    return isinstance(obj, collections.Iterable)# Random dispersal ################################################################class RandomDispersal:    """ Template class for a dispersal model that complies with the guidelines of Alep.        A class for a model of dispersal must include a method 'disperse'. In this example,    dispersal units are randomly distributed.        """    def disperse(self, g, dispersal_units, time_control = None):        """ Example method for dispersal with random distribution.                Parameters        ----------        g: MTG            MTG representing the canopy (and the soil)        dispersal_units : dict            Dispersal units emitted by the lesions on leaves                    Returns        -------        deposits : dict            Dispersal units deposited on new position on leaves        """        # vids = scene.todict().keys()        try:            dt = time_control.dt        except:            dt = 1                vids = [id for id,v in g.property('geometry').iteritems()]        n = len(vids)        deposits = {}        if dt > 0:            for vid, dlist in dispersal_units.iteritems():                for d in dlist:                    if random.random() < 0.1:                        if n>=1:                            idx = random.randint(0,n-1)                            v = vids[idx]                            d.set_position([0, 0])                            deposits.setdefault(v,[]).append(d)                return deposits        # Septoria rain dispersal #########################################################class SeptoriaRainDispersal:    """ Template class for a model of dispersal by rain that complies with the     guidelines of Alep.        A class for a model of dispersal must include a method 'disperse'. In this example,    dispersal units are first distributed updward in a semi-sphere normal to source leaf.    After, those which are left are deposited downward on leaves comprised in a cylinder    whose dimension is calculated according to the size of the semi-sphere.        """        def __init__(self, k=0.148, precision=0.01, label='LeafElement', fungus=None):        """ Initialize the model with fixed parameters.                Parameters        ----------        k: float            Shape parameter of the exponential decreasing function        precision: float            Value defining distance max with the exponential decreasing function         label: str            Label of the part of the MTG concerned by the calculation        """        from math import log        self.label = label        self.k = k        self.distance_max = -log(precision)/k        if fungus is None:            self.fungus = Fungus()        else:            self.fungus = fungus       def disperse(self, g, dispersal_units, time_control = None, **kwds):        """ Compute distribution of dispersal units by rain splash.                1. Upward dispersal:        For each source of dispersal units, create a semi-sphere of dispersal         normal to the surface of source leaf. In the semi-sphere, target         leaves are sorted according to the distance from the source.                        Then distribute dispersal units from the closer target to the more far.        The number of dispersal units by target leaf is computed as in Robert et al. 2008                2. Downward dispersal:        Get leaves in a cylinder whose dimensions are related to the dimesions        of the semi-sphere in step 1. Then distribute dispersal units from top to bottom.                Parameters        ----------        g: MTG            MTG representing the canopy (and the soil)        dispersal_units : dict            Dispersal units emitted by the lesions on leaves                    Returns        -------        deposits : dict            Dispersal units deposited on new position on leaves        """        try:            dt = time_control.dt        except:            dt = 1                deposits = {}        if dt>0:            from alinea.astk.plantgl_utils import get_area_and_normal            from openalea.plantgl import all as pgl            from collections import OrderedDict            from math import exp, pi, cos, sin, tan            from random import shuffle            from copy import copy                        dmax = self.distance_max            tesselator = pgl.Tesselator()            bbc = pgl.BBoxComputer(tesselator)            leaves = get_leaves(g, label=self.label)            centroids = g.property('centroid')            geometries = g.property('geometry')            _, norm = get_area_and_normal(geometries)            areas = g.property('area')                                  def centroid(vid):                if is_iterable(geometries[vid]):                    bbc.process(pgl.Scene(geometries[vid]))                else:                    bbc.process(pgl.Scene([pgl.Shape(geometries[vid])]))                center = bbc.result.getCenter()                centroids[vid] = center                        for source, dus in dispersal_units.iteritems():                nb_tri = len(norm[source])                borders = numpy.linspace(0,1,num=nb_tri)                                dus_by_tri = {k: int(dus / nb_tri) for k in range(nb_tri)}                dus_by_tri[nb_tri-1] += dus % nb_tri                                for k,n in dus_by_tri.iteritems():                    source_normal = norm[source][k]                                        ## UPWARD ##                    # All leaves except the source are potential targets                    targets = list(leaf for leaf in leaves if leaf in geometries.iterkeys())                    targets.remove(source)                                        # Compute centroids                    centroid(source)                    for vid in targets:                        centroid(vid)                                        # Sort the vids based on the direction                     # TODO : modify source angle                    Origin = centroids[source]                    vects = {vid:(centroids[vid]-Origin) for vid in targets                             if (centroids[vid]-Origin)*source_normal >= 0}                                        # Sort the vids based on the distance                    distances = {vid:pgl.norm(vects[vid]) for vid in vects if pgl.norm(vects[vid])<dmax}                    distances = OrderedDict(sorted(distances.iteritems(), key=lambda x: x[1]))                                        # Distribute the dispersal units                    if len(distances.values())>0:                         sphere_area = 2*pi*distances.values()[-1]**2                        for leaf_id in distances:						    if n >= 1:								area_factor = areas[leaf_id]/sphere_area								distance_factor = exp(-self.k * distances[leaf_id])								qc = min(n, (n * area_factor * distance_factor))								deposits[leaf_id] = qc								n -= qc                                # break                                        ## DOWNWARD ##                    vects2 = {vid:(centroids[vid]-Origin) for vid in targets if not vid in vects}                    projection = {}                    alpha = pgl.angle(source_normal, (1,0,0))                    if alpha>=pi/2. or (alpha<pi/2. and source_normal[2]>=0):                        alpha+=pi/2.                    beta = pgl.angle(source_normal, (0,0,1))                    a = dmax                    b = dmax*cos(beta)                                        for leaf in vects2:                        if (centroids[leaf]-Origin)*(source_normal[0], source_normal[1], 0) >= 0:                            # Big side of the projection semi circle                            copy_centroid = copy(centroids[leaf])                            copy_origin = copy(Origin)                            copy_centroid[2] = 0.                            copy_origin[2] = 0.                            if pgl.norm(copy_centroid-copy_origin) < dmax:                                projection[leaf] = vects2[leaf]                        else:                            # Small side of the projection semi ellipse                            x = vects2[leaf][0]                            y = vects2[leaf][1]                            x2 = x*cos(alpha)+y*sin(alpha)                            y2 = -x*sin(alpha)+y*cos(alpha)                            if (x2**2)/(a**2) + (y2**2)/(b**2) < 1 :                                projection[leaf] = vects2[leaf]                    projection = OrderedDict(sorted(projection.items(), key=lambda x:x[1][2], reverse=True))                                        if len(projection)>0:                        n_big = int(n*(beta+pi/2.)/pi)                        n_small = n - n_big                        for leaf in projection:                            if n >= 1:                                copy_centroid = copy(centroids[leaf])                                copy_origin = copy(Origin)                                copy_centroid[2] = 0.                                copy_origin[2] = 0.                                if (centroids[leaf]-Origin)*(source_normal[0],source_normal[1],0) >= 0:                                    area_factor = areas[leaf]/(pi*dmax**2/2.)                                    dist = pgl.norm(copy_centroid-copy_origin)                                    distance_factor = exp(-self.k * dist)                                    qc = min(n_big, (n_big * area_factor * distance_factor))                                else:                                    area_factor = areas[leaf]/(pi*a*b/2.)                                    dist = pgl.norm(copy_centroid-copy_origin)/abs(cos(pgl.angle(source_normal, (1,0,0))+pi/2.))                                    distance_factor = exp(-self.k * dist)                                    qc = min(n_small, (n_small * area_factor * distance_factor))                                    # import pdb                                    # pdb.set_trace()                                qc = min(qc, n)                                deposits[leaf] = qc                                n-=qc                            for vid, dep in deposits.iteritems():            du = self.fungus.dispersal_unit()            du.set_nb_dispersal_units(nb_dispersal_units=dep)            deposits[vid] = [du]                return deposits            def plot_distri_3d(self, g):        from alinea.alep.architecture import set_property_on_each_id        from alinea.alep.alep_color import alep_colormap, green_yellow_red        from alinea.alep.disease_outputs import plot3d_transparency        from openalea.plantgl.all import Viewer        import matplotlib.pyplot as plt        # Compute severity by leaf        dus = g.property("dispersal_units")        deposits = {k:sum([du.nb_dispersal_units for du in v]) for k,v in dus.iteritems()}        set_property_on_each_id(g, 'nb_dispersal_units', deposits)            # Visualization        vmax = 2*max(deposits.values())/3        g = alep_colormap(g, 'nb_dispersal_units', cmap=green_yellow_red(),                           lognorm=False, zero_to_one=False,                           vmax = vmax)        d = [numpy.arange(vmax)]        fig, ax = plt.subplots()        ax.imshow(d, cmap = green_yellow_red())        for id in g:            if not id in deposits:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            elif deposits[id]==0.:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            else:                g.node(id).transparency = 0.                              scene = plot3d_transparency(g)        Viewer.display(scene)        # Powdery mildew wind dispersal ###################################################class PowderyMildewWindDispersal:    """ Template class for a model of dispersal by wind that complies with the     guidelines of Alep.        A class for a model of dispersal must include a method 'disperse'. In this example,    dispersal units are distributed in a cone of dispersal in the direction of the wind.    This model is adapted from the work of Calonnec et al., 2008 on powdery mildew.        """        def __init__(self, cid=0.04, a0=45., reduction=100., k_beer=0.5, label='lf', wind_direction=(1, 0, 0), fungus=None):        """ Initialize the model with fixed parameters.                Parameters        ----------        cid: float            Spore decay with distance        a0: float            Angle of the cone of dispersal        reduction: float            Reduction parameter to limit the number of spores reaching a surface.            Regarding the equation, this parameter must be homogeneous to a surface.        k_beer: float            Value of k in the Beer-Lambert law for simplification of interception             of spores in the canopy.        label: str            Label of the part of the MTG concerned by the calculation        wind_direction (3-tuple) the wind direction vector        """        self.cid = cid        self.a0 = a0        self.reduction = reduction        self.k_beer = k_beer        self.label = label        self.wind_direction = wind_direction        print('')        print('Be careful conversion l.228 dispersal')        print('Be careful Beer law commented l.229 dispersal')                if fungus is None:            self.fungus = Fungus()        else:            self.fungus = fungus                def disperse(self, g, dispersal_units, time_control = None):        """ Compute dispersal of spores of powdery mildew by wind in a cone.                For each source of dispersal units, create a cone of dispersal         in which target leaves are sorted:        1. according to the wind direction        2. according to the angle a0        3. according to the distance from the source                Then distribute dispersal units from the closer target to the more far.        The number of dispersal units by target leaf is computed as in        Calonnec et al. 2008.                Parameters        ----------        g: MTG            MTG representing the canopy (and the soil)        dispersal_units : dict            Dispersal units emitted by the lesions on leaves                    Returns        -------        deposits : dict            Dispersal units deposited on new position on leaves        """        try:            dt = time_control.dt        except:            dt = 1                deposits = {}        if dt > 0:            from openalea.plantgl import all as pgl            from random import shuffle            from math import degrees, exp, tan, pi, radians            from collections import OrderedDict            geometries = g.property('geometry')            centroids = g.property('centroid')            areas = g.property('area')            wind_directions = g.property('wind_direction')            tesselator = pgl.Tesselator()            bbc = pgl.BBoxComputer(tesselator)                    leaves = get_leaves(g, label=self.label)            def centroid(vid):                if is_iterable(geometries[vid]):                    bbc.process(pgl.Scene(geometries[vid]))                else:                    bbc.process(pgl.Scene([pgl.Shape(geometries[vid])]))                center = bbc.result.getCenter()                centroids[vid] = center                        def area(vid):                # areas[vid] = pgl.surface(geometries[vid][0])*1000                areas[vid] = pgl.surface(geometries[vid][0])            for source, dus in dispersal_units.iteritems():                # TODO: Special computation for interception by source leaf                                # All other leaves are potential targets                targets = list(leaf for leaf in leaves if leaf in geometries.iterkeys())                targets.remove(source)                                # Compute centroids                centroid(source)                for vid in targets:                    centroid(vid)                    # surface(vid)                # Sort the vids based on the direction                 Origin = centroids[source]                vects = {vid:(centroids[vid]-Origin) for vid in targets                         if (centroids[vid]-Origin)*wind_directions.get(source, self.wind_direction) >= 0}                                # Sort the vids based on the angle                                angles = {vid:degrees(pgl.angle(vect, wind_directions.get(source, self.wind_direction)))                           for vid, vect in vects.iteritems()                          if degrees(pgl.angle(vect, wind_directions.get(source, self.wind_direction)))<= self.a0}                                # Sort the vids based on the distance                distances = {vid:pgl.norm(vects[vid]) for vid in angles}                distances = OrderedDict(sorted(distances.iteritems(), key=lambda x: x[1]))                                               # Beer law inside cone to take into account leaf coverage                n = dus                if len(distances.values())>0:                    for leaf in distances:                        # qc = min(n, (n * (areas[leaf]/self.reduction) *                              # exp(-self.cid * distances[leaf]) *                              # (self.a0 - angles[leaf])/self.a0))                        surf_base_cone = pi*(tan(radians(self.a0))*distances[leaf])**2                        area_factor = min(1, areas[leaf]/surf_base_cone)                        # import pdb                        # pdb.set_trace()                        qc = min(n, (n * area_factor *                              exp(-self.cid * distances[leaf]) *                              (self.a0 - angles[leaf])/self.a0))                                                # if qc < 1:                            # for d in dus:                                # d.disable()                            # break                                                                    deposits[leaf] = int(qc)                        n -= int(qc)                        # if len(dus) < 1 or len(deposits[leaf]) < 1:                        if n < 1:                            break                                    for vid, dep in deposits.iteritems():            du = self.fungus.dispersal_unit()            du.set_nb_dispersal_units(nb_dispersal_units=dep)            deposits[vid] = [du]                                return deposits                    def plot_distri_3d(self, g):        from alinea.alep.architecture import set_property_on_each_id        from alinea.alep.alep_color import alep_colormap, green_yellow_red        from alinea.alep.disease_outputs import plot3d_transparency        from openalea.plantgl.all import Viewer        import matplotlib.pyplot as plt        # Compute severity by leaf        dus = g.property("dispersal_units")        deposits = {k:sum([du.nb_dispersal_units for du in v]) for k,v in dus.iteritems()}        set_property_on_each_id(g, 'nb_dispersal_units', deposits)            # Visualization        vmax = 2*max(deposits.values())/3        g = alep_colormap(g, 'nb_dispersal_units', cmap=green_yellow_red(),                           lognorm=False, zero_to_one=False,                           vmax = vmax)        d = [numpy.arange(vmax)]        fig, ax = plt.subplots()        ax.imshow(d, cmap = green_yellow_red())        for id in g:            if not id in deposits:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            elif deposits[id]==0.:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            else:                g.node(id).transparency = 0.                              scene = plot3d_transparency(g)        Viewer.display(scene)        # Brown Rust wind dispersal (horizontal layers) ###############################def compute_overlaying(nb_du, area, impact_surface):    # true_area_impacted = areas[vid] * (1 - min(1., numpy.exp(-nb_du * impact_surface / areas[vid])))    # new_nb_du = int(true_area_impacted / diameter)    return max(1, int((1 - min(1., numpy.exp(-nb_du * impact_surface / area)))*(area/impact_surface)))def sum_nb(nb_leaves, nb_du):    """ Share randomly nb_du dispersal units between nb_leaves leaves of a layer """    distribution = []    while nb_leaves > 1:        if nb_du == 0:            nb_on_vid = 0        else:            nb_du_avg = float(nb_du/nb_leaves)            nb_du_sup = 2.*nb_du_avg            if nb_du_sup >= 1:                nb_on_vid = int(round(max(0, min(nb_du, numpy.random.normal(nb_du_avg, nb_du_sup)))))            else:                nb_on_vid = 1 if numpy.random.random()<nb_du_sup else 0        distribution.append(nb_on_vid)        nb_leaves -= 1        nb_du -= nb_on_vid    return distribution + [nb_du]class BrownRustDispersal:    """ Calculate distribution of dispersal units in horizontal layers """    def __init__(self, fungus = None,                 group_dus = False,                 domain_area = 1.,                 convUnit = 0.01,                 layer_thickness = 1.,                 k_dispersal = 0.07,                 k_beer = 0.5):                     if fungus is not None:            self.fungus = fungus        else:            self.fungus = Fungus()        self.group_dus = group_dus        self.domain_area = domain_area        self.convUnit = convUnit        self.layer_thickness = layer_thickness        self.k_dispersal = k_dispersal        self.k_beer = k_beer    def leaves_in_grid(self, g, label = 'LeafElement'):        from alinea.alep.architecture import geometry_center        geometries = g.property('geometry')        centroids = g.property('centroid')        areas = g.property('area')        leaves = get_leaves(g, label=label)        leaves = [l for l in leaves if l in geometries]                # Get centroids                def centroid(vid):            centroids[vid] = geometry_center(geometries[vid])                if len(leaves)>0:            for vid in leaves:                centroid(vid)                            # Define grid (horizontal layers)            zs = [c[2] for c in centroids.itervalues()]            minz = min(zs)            maxz = max(zs) + self.layer_thickness            layers = {l:[] for l in numpy.arange(minz, maxz, self.layer_thickness)}                        # Distribute leaves in layers            for vid, coords in centroids.iteritems():                z = coords[2]                ls = layers.keys()                i_layer = numpy.where(map(lambda x: x<=z<x+self.layer_thickness                                         if z!=maxz - self.layer_thickness                                        else x<=z<=x+self.layer_thickness , ls))[0]                if len(i_layer) > 0. and areas[vid]>1e-10:                    layers[ls[i_layer[0]]].append(vid)                        self.layers = layers        else:            self.layers = {}    def get_dispersal_units(self, g,                             fungus_name = "brown_rust",                             label = 'LeafElement',                            weather_data = None, **kwds):        lesions = g.property('lesions')        return {vid:sum([l.emission() for l in les if l.is_sporulating                         and l.fungus.name.startswith(fungus_name)])                         for vid, les in lesions.iteritems()}    def disperse(self, g, dispersal_units = {}, weather_data = None,                 label='LeafElement', domain_area=None, **kwds):                             def expo_decrease(dist):            return numpy.exp(-self.k_dispersal*dist)                    def left_in_canopy(nb_dus, layer, max_height):            xmax = numpy.arange(100)            ymax = expo_decrease(xmax)            x_up = numpy.arange(max_height-layer)            y_up = expo_decrease(x_up)            upward = numpy.trapz(y_up,x_up)/numpy.trapz(ymax,xmax)            x_down = numpy.arange(max_height)            y_down = expo_decrease(x_down)            downward = numpy.trapz(y_down,x_down)/numpy.trapz(ymax,xmax)            return nb_dus*(upward+downward)/2.                self.leaves_in_grid(g, label=label)        # Group DUs in layers and reduce global number according to Beer Law        areas = g.property('area')        geom = g.property('geometry')        labels = g.property('label')        areas = {k:v for k,v in areas.iteritems()                 if k in geom and labels[k].startswith('LeafElement')}        total_area = sum(areas.values())        if domain_area is None:            domain_area = self.domain_area        lai = total_area*(self.convUnit**2)/domain_area if domain_area>0. else 0.        beer_factor = 1-numpy.exp(-self.k_beer * lai)        dus_by_layer = {layer:sum([dispersal_units[v]                        for v in vids if v in dispersal_units])*beer_factor                        for layer, vids in self.layers.iteritems()}        max_height = max(self.layers.keys())        dus_by_layer = {layer:left_in_canopy(nb_dus, layer, max_height)                        for layer, nb_dus                         in dus_by_layer.iteritems() if nb_dus>0.}                        deposits = {}        for source, nb_dus in dus_by_layer.iteritems():            probas = {}            for target, vids in self.layers.iteritems():                nb_vids = len(vids)                if nb_vids>0:                    dist = abs(source - target)                    area_l = (sum([areas[vid] for vid in vids])*self.convUnit**2)/self.domain_area                    proba_lai = 1-numpy.exp(-self.k_beer * area_l)                    proba_dist = numpy.exp(-self.k_dispersal*dist)                    try:                        probas[target] += proba_lai*proba_dist                    except:                        probas[target] = proba_lai*proba_dist            total_probas = sum([p for p in probas.itervalues()])                        for layer, proba in probas.iteritems():                proba /= total_probas                nb_depo_layer = numpy.random.binomial(nb_dus, proba)                vids = self.layers[layer]                nb_vids = len(vids)                distribution_by_leaf = sum_nb(nb_vids, nb_depo_layer)                numpy.random.shuffle(distribution_by_leaf)                for i_lf, lf in enumerate(vids):                    if distribution_by_leaf[i_lf] > 0.:                        depo = distribution_by_leaf[i_lf]                        depo = compute_overlaying(depo, areas[lf], numpy.pi*0.0015**2)                        try:                            deposits[lf] += depo                        except:                            deposits[lf] = depo        for vid, nb_dus in deposits.iteritems():            if self.group_dus==True:                du = self.fungus.dispersal_unit()                du.set_nb_dispersal_units(nb_dispersal_units = nb_dus)                deposits[vid] = [du]            else:                dus = []                for d in range(nb_dus):                    du = self.fungus.dispersal_unit(1)                    dus.append(du)                deposits[vid] = dus        return deposits    def plot_layers(self, g):        from alinea.alep.architecture import set_property_on_each_id        from alinea.alep.alep_color import alep_colormap        from alinea.alep.disease_outputs import plot3d_transparency        from openalea.plantgl.all import Viewer        # Compute severity by leaf        self.leaves_in_grid(g)        layers = self.layers        layer_by_leaf = {vid:k for k,v in layers.iteritems() for vid in v}        set_property_on_each_id(g, 'height', layer_by_leaf)            # Visualization        g = alep_colormap(g, 'height', cmap='prism',                           lognorm=False, zero_to_one=False)        geometries = g.property('geometry')         leaves = get_leaves(g, label='LeafElement')        leaves = [l for l in leaves if l in geometries]         transp = {vid:0. for k,v in layers.iteritems() for vid in v}        set_property_on_each_id(g, 'transparency', transp)                                 scene = plot3d_transparency(g)        Viewer.display(scene)            def view_distri_layers(self, g, nb_dispersal_units = 1e5, vmax = None,                           position_source = 3./5, return_df=False):        from alinea.alep.architecture import set_property_on_each_id        from alinea.alep.alep_color import alep_colormap, green_yellow_red        from alinea.alep.disease_outputs import plot3d_transparency        from openalea.plantgl.all import Viewer        import matplotlib.pyplot as plt        import pandas as pd        # Compute severity by leaf        self.leaves_in_grid(g)        layers = self.layers.keys()        layers.sort()                layer = layers[int(position_source*len(layers))]        if len(self.layers[layer])>0:            leaf = self.layers[layer][0]        else:            non_empty = {k:v for k,v in self.layers.iteritems() if len(v)>0}            leaf = self.layers[min(non_empty.keys(), key=lambda k:abs(k-layer))][0]        deposits = {k:sum([du.nb_dispersal_units for du in v]) for k,v in                     self.disperse(g, dispersal_units = {leaf : nb_dispersal_units}).iteritems()}          set_property_on_each_id(g, 'nb_dispersal_units', deposits)            # Visualization        if vmax is None:            vmax = 2*max(deposits.values())/3        g = alep_colormap(g, 'nb_dispersal_units', cmap=green_yellow_red(),                           lognorm=False, zero_to_one=False,                           vmax = vmax)        d = [numpy.arange(vmax)]        fig, ax = plt.subplots()        ax.imshow(d, cmap = green_yellow_red())        transp = {vid:0. for k,v in self.layers.iteritems() for vid in v}        set_property_on_each_id(g, 'transparency', transp)           for id in g:            if not id in deposits:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            elif deposits[id]==0.:                g.node(id).color = (0,0,0)                g.node(id).transparency = 0.7            else:                g.node(id).transparency = 0.                              scene = plot3d_transparency(g)        Viewer.display(scene)                if return_df==True:                    depo_layer = {k:sum([deposits[vid] for vid in v if vid in deposits])                            for k,v in self.layers.iteritems()}            df = pd.DataFrame([[k,v] for k, v in depo_layer.iteritems()])            df = df.sort(0)            df[2] = df[1]/df[1].sum()            fig, ax = plt.subplots()            ax.plot(df[2], df[0], 'k')            ax.set_ylabel('Height', fontsize = 16)            ax.set_xlabel('Proportion of deposits', fontsize = 16)            return df            def plot_distri_layers(self, g, nb_dispersal_units = 1000,                            position_source = 3./5):        import pandas as pd        import matplotlib.pyplot as plt        # Compute severity by leaf        self.leaves_in_grid(g)        layers = self.layers.keys()        layers.sort()                layer = layers[int(position_source*len(layers))]        if len(self.layers[layer])>0:            leaf = self.layers[layer][0]        else:            non_empty = {k:v for k,v in self.layers.iteritems() if len(v)>0}            leaf = self.layers[min(non_empty.keys(), key=lambda k:abs(k-layer))][0]        deposits = {k:sum([du.nb_dispersal_units for du in v]) for k,v in                     self.disperse(g, dispersal_units = {leaf : nb_dispersal_units}).iteritems()}        depo_layer = {k:sum([deposits[vid] for vid in v if vid in deposits])                        for k,v in self.layers.iteritems()}        df = pd.DataFrame([[k,v] for k, v in depo_layer.iteritems()])        df = df.sort(0)        df[2] = df[1]/df[1].sum()        fig, ax = plt.subplots()        ax.plot(df[2], df[0], 'k')        ax.set_ylabel('Height', fontsize = 16)        ax.set_xlabel('Proportion of deposits', fontsize = 16)                return d# Cache of transfer matrices ######################################################class TransferMatrixCache(object):    """ Wrapper around a model of transport that reuses leaf-to-leaf transfer matrices.    Within one canopy iteration, rain events with the same rain regime share the    same geometry of dispersal. The first time a leaf emits in a given regime, the    wrapped model is probed once with 'nb_probe' dispersal units emitted by this    leaf: the fractions deposited on each receiving leaf give a row of a sparse    source -> target transfer matrix. Subsequent events draw the deposits of the    dispersal units emitted by each leaf from its row of the matrix (multinomial    draw, the rest of the DUs leaves the canopy).    The cache is emptied when the canopy changes (new MTG returned by    'grow_canopy', or change of the leaf elements or of their area).    Side effects of the wrapped model on g would only occur when it is probed:    washing is thus switched off in the wrapped model (attribute 'wash') and     done on every call with 'washing_model' (see 'alinea.alep.protocol.wash').    The washing of the wrapped model is never used: results differ from the    uncached transport, and 'washing_model' has to be given explicitly.    """    def __init__(self, transport_model, fungus, group_dus=None,                 rain_classes=(0.5, 1., 2., 5., 10.), nb_probe=1000,                 washing_model=None, label='LeafElement'):        """ Initialize the cache.        Parameters        ----------        transport_model: model            Model of transport with a method 'disperse(g, DU, weather_data, **kwds)'            returning a dict {leaf_id: list of DU deposited}        fungus: Fungus            Fungus of the dispersal units to create on receiving leaves        group_dus: bool            True to deposit cohorts, False for individual dispersal units.            By default, given by the fungus.        rain_classes: tuple of float            Limits of the classes of mean rain intensity (mm/h) that share            the same transfer matrix        nb_probe: int            Number of dispersal units emitted by a source leaf to estimate            its row of the transfer matrix        washing_model: model            Model with a method 'compute_washing_rate' (e.g. RapillyWashing),             required if the wrapped model washes leaves        label: str            Label of the part of the MTG concerned by the calculation        """        if getattr(transport_model, 'wash', False) and washing_model is None:            raise ValueError('A washing model is required to cache the transport of '                             'a model that washes leaves')        self.transport_model = transport_model        self.fungus = fungus        self.group_dus = fungus.group_dus if group_dus is None else group_dus        self.rain_classes = rain_classes        self.nb_probe = nb_probe        self.washing_model = washing_model        self.label = label        self.reset()    def reset(self):        """ Empty the cache of transfer matrices. """        self._canopy = None        self._signature = None        self.leaves = []        self._index = {}        self._matrices = {}        self._probed = {}    def check_canopy(self, g):        """ Reset the cache if g is not the canopy used for the cached matrices. """        leaves = get_leaves(g, label=self.label)        areas = g.property('area')        signature = (len(leaves), round(sum(areas.get(vid, 0.) for vid in leaves), 6))        if g is not self._canopy or signature != self._signature:            self.reset()            self._canopy = g            self._signature = signature            self.leaves = leaves            self._index = {vid:i for i, vid in enumerate(leaves)}    def rain_class(self, weather_data=None):        """ Find the class of rain regime of the event. """        if weather_data is None or len(weather_data) == 0:            return 0        return int(numpy.digitize([weather_data.rain.mean()], self.rain_classes)[0])    def _transport(self, g, DU, weather_data=None, **kwds):        # Washing of the wrapped model is done separately on each call        wash = getattr(self.transport_model, 'wash', None)        if wash:            self.transport_model.wash = False        try:            if weather_data is not None:                return self.transport_model.disperse(g, DU, weather_data, **kwds)            else:                return self.transport_model.disperse(g, DU, **kwds)        finally:            if wash:                self.transport_model.wash = wash    def transfer_matrix(self, g, sources, rain_class, weather_data=None, **kwds):        """ Get the transfer matrix of the rain regime, probing missing sources.        Parameters        ----------        g: MTG            MTG representing the canopy        sources: array of int            Indexes of the emitting leaves in 'self.leaves'        rain_class: int            Class of rain regime        Returns        -------        matrix: scipy.sparse.csr_matrix            Fraction of the DUs emitted by leaf i (row) deposited on leaf j (column)        """        nb_leaves = len(self.leaves)        if rain_class not in self._matrices:            self._matrices[rain_class] = sparse.csr_matrix((nb_leaves, nb_leaves))            self._probed[rain_class] = set()        probed = self._probed[rain_class]        missing = [i for i in sources if i not in probed]        if len(missing) > 0:            rows = sparse.lil_matrix((nb_leaves, nb_leaves))            for i in missing:                deposits = self._transport(g, {self.leaves[i]: self.nb_probe},                                           weather_data, **kwds)                for vid, dlist in deposits.iteritems():                    if vid in self._index:                        nb = sum(du.nb_dispersal_units for du in dlist)                        rows[i, self._index[vid]] += float(nb)/self.nb_probe                probed.add(i)            self._matrices[rain_class] = self._matrices[rain_class] + rows.tocsr()        return self._matrices[rain_class]    def dispersal_units(self, nb_dus):        """ Create the dispersal units deposited on a leaf. """        if self.group_dus:            du = self.fungus.dispersal_unit()            du.set_nb_dispersal_units(nb_dispersal_units=nb_dus)            return [du]        else:            return [self.fungus.dispersal_unit() for i in range(nb_dus)]    def disperse(self, g, DU, weather_data=None, **kwds):        """ Compute the deposits of dispersal units emitted by leaves.        Parameters        ----------        g: MTG            MTG representing the canopy        DU: dict([leaf_id, number of DUs emitted])            Dispersal units emitted by leaf (or list of emitted dispersal units,             counted with their number of DUs in cohort)        weather_data: pandas DataFrame            Weather data for the time step        Returns        -------        deposits: dict([leaf_id, list of dispersal units])            Dispersal units deposited by leaf        """        if self.washing_model is not None:            from alinea.alep.protocol import wash            rain = weather_data.rain.mean() if weather_data is not None and len(weather_data) > 0 else 0.            wash(g, self.washing_model, rain, label=self.label)        self.check_canopy(g)        nb_leaves = len(self.leaves)        emissions = numpy.zeros(nb_leaves, dtype=int)        others = {}        for vid, nb in DU.iteritems():            if is_iterable(nb):                nb = sum(du.nb_dispersal_units for du in nb)            if vid in self._index:                emissions[self._index[vid]] += nb            elif nb > 0:                others[vid] = nb        deposits = {}        if emissions.sum() > 0:            rain_class = self.rain_class(weather_data)            sources = numpy.flatnonzero(emissions)            matrix = self.transfer_matrix(g, sources, rain_class, weather_data, **kwds)            nb_deposited = numpy.zeros(nb_leaves, dtype=int)            for i in sources:                row = matrix.getrow(i)                if row.nnz > 0:                    # Each DU emitted lands on one leaf or leaves the canopy                    probas = numpy.append(row.data, max(0., 1. - row.data.sum()))                    draws = numpy.random.multinomial(emissions[i], probas/probas.sum())                    nb_deposited[row.indices] += draws[:-1]            for i in numpy.flatnonzero(nb_deposited):                deposits[self.leaves[i]] = self.dispersal_units(int(nb_deposited[i]))        # Sources out of the leaf elements are not cached        if len(others) > 0:            for vid, dlist in self._transport(g, others, weather_data, **kwds).iteritems():                deposits[vid] = deposits.get(vid, []) + list(dlist)        return deposits# Brown rust layer kernel #########################################################class BrownRustLayerDispersal(BrownRustDispersal):    """ BrownRustDispersal with its kernel between layers computed once per canopy iteration.    The layers of leaves, the interception of the canopy (Beer law on its LAI),    the fraction of spores left in the canopy above and below each layer and    the probability of deposit from each layer to each layer (Beer law on the    area of the layer and exponential decrease with distance, 'k_dispersal')     are those of BrownRustDispersal. They are stored in arrays and only    computed again when the canopy changes, with the share of the deposits of    a layer received by each of its leaves (the same for all leaves, as the    mean of 'sum_nb') and the overlaying factors of the leaves.    Each dispersal event then aggregates emissions by layer with a matrix    product and draws the deposits on leaves with one multinomial draw by    emitting layer. Overlaying ('compute_overlaying') is applied to the total    number of deposits on each leaf.    """    def __init__(self, *args, **kwds):        BrownRustDispersal.__init__(self, *args, **kwds)        self.reset()    def reset(self):        """ Forget the kernel of the current canopy. """        self._canopy = None        self._signature = None        self.layers = {}        self.sources = []        self.targets = []        self.retention = numpy.array([])        self.kernel = numpy.zeros((0, 0))        self.leaves = []        self.membership = numpy.zeros((0, 0))        self.leaf_kernel = numpy.zeros((0, 0))        self.overlaying_rate = numpy.array([])        self.overlaying_capacity = numpy.array([])    def update_kernel(self, g, label='LeafElement', domain_area=None):        """ Compute layers and kernel if the canopy changed since last call. """        if domain_area is None:            domain_area = self.domain_area        geom = g.property('geometry')        labels = g.property('label')        areas = {k:v for k,v in g.property('area').iteritems()                  if k in geom and labels[k].startswith('LeafElement')}        signature = (len(areas), round(sum(areas.values()), 6), domain_area, label)        if g is self._canopy and signature == self._signature:            return        self.reset()        self._canopy = g        self._signature = signature        self.leaves_in_grid(g, label=label)        if len(self.layers) == 0:            return        # Spores intercepted by the canopy and left in the canopy from each layer        total_area = sum(areas.values())        lai = total_area*(self.convUnit**2)/domain_area if domain_area>0. else 0.        beer_factor = 1-numpy.exp(-self.k_beer * lai)        xmax = numpy.arange(100)        norm = numpy.trapz(numpy.exp(-self.k_dispersal*xmax), xmax)        def integral(length):            x = numpy.arange(length)            return numpy.trapz(numpy.exp(-self.k_dispersal*x), x)/norm        self.sources = sorted(self.layers.keys())        max_height = max(self.sources)        self.retention = numpy.array([beer_factor*(integral(max_height-layer)+                                                   integral(max_height))/2.                                      for layer in self.sources])        # Probability of deposit from layer of emission to receiving layer        self.targets = [layer for layer in self.sources if len(self.layers[layer])>0]        if len(self.targets) == 0:            return        area_l = numpy.array([sum([areas[vid] for vid in self.layers[layer]])                              for layer in self.targets])*self.convUnit**2/self.domain_area        proba_lai = 1-numpy.exp(-self.k_beer * area_l)        dist = numpy.abs(numpy.subtract.outer(self.sources, self.targets))        kernel = proba_lai*numpy.exp(-self.k_dispersal*dist)        self.kernel = kernel/kernel.sum(axis=1)[:, numpy.newaxis]        # Same share of the deposits of a layer for each of its leaves        self.leaves = [vid for layer in self.targets for vid in self.layers[layer]]        i_target = numpy.repeat(numpy.arange(len(self.targets)),                                [len(self.layers[layer]) for layer in self.targets])        shares = 1./numpy.bincount(i_target)[i_target]        self.membership = (numpy.array(self.sources)[:, numpy.newaxis] ==                            numpy.array(self.targets)[i_target]).astype(float)        leaf_kernel = self.kernel[:, i_target]*shares        self.leaf_kernel = leaf_kernel/leaf_kernel.sum(axis=1)[:, numpy.newaxis]        # Overlaying of deposits on leaves (see compute_overlaying)        impact_surface = numpy.pi*0.0015**2        leaf_areas = numpy.array([areas[vid] for vid in self.leaves])        self.overlaying_rate = impact_surface/leaf_areas        self.overlaying_capacity = leaf_areas/impact_surface    def disperse(self, g, dispersal_units = {}, weather_data = None,                 label='LeafElement', domain_area=None, **kwds):        """ Compute the deposits of dispersal units emitted by leaves.        Parameters        ----------        g: MTG            MTG representing the canopy        dispersal_units: dict([leaf_id, number of DUs emitted])            Dispersal units emitted by leaf        weather_data: pandas DataFrame            Weather data for the time step (not used)        label: str            Label of the part of the MTG concerned by the calculation        domain_area: float            Area of the domain of the canopy (m2)        Returns        -------        deposits: dict([leaf_id, list of dispersal units])            Dispersal units deposited by leaf        """        self.update_kernel(g, label=label, domain_area=domain_area)        deposits = {}        if len(self.targets) == 0:            return deposits        # Emissions by layer left in the canopy        emitted = numpy.array([dispersal_units.get(vid, 0.) for vid in self.leaves])        emissions = self.membership.dot(emitted)*self.retention        # Deposits by leaf: one multinomial draw by emitting layer        nb_depo = numpy.zeros(len(self.leaves), dtype=int)        for source in numpy.flatnonzero(emissions >= 1.):            nb_depo += numpy.random.multinomial(int(emissions[source]),                                                 self.leaf_kernel[source])        received = numpy.flatnonzero(nb_depo)        overlaid = (1 - numpy.exp(-nb_depo[received]*self.overlaying_rate[received]))        nb_depo = numpy.maximum(1, (overlaid*self.overlaying_capacity[received]).astype(int))        for i_lf, nb_dus in zip(received, nb_depo):            if self.group_dus==True:                du = self.fungus.dispersal_unit()                du.set_nb_dispersal_units(nb_dispersal_units = int(nb_dus))                deposits[self.leaves[i_lf]] = [du]            else:                deposits[self.leaves[i_lf]] = [self.fungus.dispersal_unit(1)                                                for d in range(nb_dus)]        return deposits
\ No newline at end of file
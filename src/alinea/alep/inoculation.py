@@ -6,8 +6,9 @@
 import random
 import numpy as np
 import collections
-from alinea.alep.fungal_objects import DispersalUnit, Lesion, Fungus
-from alinea.alep.architecture import get_leaves
+from alinea.alep.fungus import DispersalUnit, Lesion, Fungus
+from alinea.alep.architecture import get_leaves, geometry_center
+from alinea.alep.protocol import group_in_cohort
 from openalea.plantgl import all as pgl
 
 # Random inoculation ##############################################################
@@ -23,6 +24,9 @@ class RandomInoculation:
     def allocate(self, g, inoculum, label='LeafElement'):
         """ Select randomly elements of the MTG and allocate them a random part of the inoculum.
 
+        Target leaves are drawn at once for the whole inoculum, then fungal objects
+        are attached leaf by leaf (as cohorts if fungus operates with 'group_dus').
+
         Parameters
         ----------
         g: MTG
@@ -37,32 +41,8 @@ class RandomInoculation:
         None
             Update directly the MTG
         """        
-        vids = [n for n in g if g.label(n).startswith(label)]
-        areas = g.property('area')
-        vids = [vid for vid in vids if vid in g.property('geometry') if areas[vid]>0.]
-        n = len(vids)
-        
-        if n>0:
-            for i in inoculum:
-                idx = random.randint(0,n-1)
-                v = vids[idx]
-                leaf = g.node(v)
-                # Set a position for i :
-                if i.position==None:
-                    i.position = [random.random(), 0] # TODO : improve
-                
-                #  Attach it to the leaf
-                if isinstance(i, Lesion):
-                    try:
-                        leaf.lesions.append(i)
-                    except:
-                        leaf.lesions = [i]            
-                elif isinstance(i, DispersalUnit):
-                    i.deposited()
-                    try:
-                        leaf.dispersal_units.append(i)
-                    except:
-                        leaf.dispersal_units = [i]
+        vids = get_leaves(g, label=label)
+        allocate_in_bulk(g, inoculum, available_leaves(g, vids))
 
 class InoculationYoungLeaves:
     """ Template class for inoculum allocation that complies with the guidelines of Alep.
@@ -84,6 +64,9 @@ class InoculationYoungLeaves:
     def allocate(self, g, inoculum, label='LeafElement'):
         """ Select randomly elements of the MTG and allocate them a random part of the inoculum.
 
+        Target leaves are drawn at once for the whole inoculum, then fungal objects
+        are attached leaf by leaf (as cohorts if fungus operates with 'group_dus').
+
         Parameters
         ----------
         g: MTG
@@ -98,32 +81,10 @@ class InoculationYoungLeaves:
         None
             Update directly the MTG
         """        
-        vids = [n for n in g if g.label(n).startswith(label) and g.node(n).age<self.age_max]
-        areas = g.property('area')
-        vids = [vid for vid in vids if vid in g.property('geometry') if areas[vid]>0.]
-        n = len(vids)
-        
-        if n>0:
-            for i in inoculum:
-                idx = random.randint(0,n-1)
-                v = vids[idx]
-                leaf = g.node(v)
-                # Set a position for i :
-                if i.position==None:
-                    i.position = [random.random(), 0] # TODO : improve
-                
-                #  Attach it to the leaf
-                if isinstance(i, Lesion):
-                    try:
-                        leaf.lesions.append(i)
-                    except:
-                        leaf.lesions = [i]            
-                elif isinstance(i, DispersalUnit):
-                    i.deposited()
-                    try:
-                        leaf.dispersal_units.append(i)
-                    except:
-                        leaf.dispersal_units = [i]
+        ages = g.property('age')
+        vids = [vid for vid in get_leaves(g, label=label)
+                if vid in ages and ages[vid] < self.age_max]
+        allocate_in_bulk(g, inoculum, available_leaves(g, vids))
                         
 class InoculationLowerLeaves(object):
     """ Template class for inoculum allocation that complies with the guidelines of Alep.
@@ -142,14 +103,7 @@ class InoculationLowerLeaves(object):
         return isinstance(obj, collections.Iterable)
     
     def get_leaf_height(self, leaf_geom):
-        from openalea.plantgl import all as pgl
-        tesselator = pgl.Tesselator()
-        bbc = pgl.BBoxComputer(tesselator)
-        if self.is_iterable(leaf_geom):
-            bbc.process(pgl.Scene(leaf_geom))
-        else:
-            bbc.process(pgl.Scene([pgl.Shape(leaf_geom)]))
-        return bbc.result.getCenter()[2]
+        return geometry_center(leaf_geom)[2]
         
     def allocate(self, g, inoculum, label='LeafElement'):
         """ Select lower elements of the MTG and allocate them a random part of the inoculum.
@@ -201,6 +155,71 @@ def is_iterable(obj):
     """ Test if object is iterable """
     return isinstance(obj, collections.Iterable)
 
+# Bulk allocation #################################################################
+
+def available_leaves(g, vids):
+    """ Keep only the leaf elements with a geometry and a positive area. """
+    areas = g.property('area')
+    geometries = g.property('geometry')
+    return [vid for vid in vids if vid in geometries and areas.get(vid, 0.)>0.]
+
+def allocate_in_bulk(g, inoculum, vids):
+    """ Draw a target leaf for every fungal object of the inoculum and attach them to g.
+
+    Draws are made at once for the whole inoculum. Fungal objects are then grouped
+    by target leaf and added to the property 'lesions' or 'dispersal_units' of the
+    leaf in a single operation. If the fungus operates with cohorts ('group_dus'),
+    dispersal units falling on the same leaf are merged in a single cohort.
+    Fungal objects without position are given a list holding one random position.
+
+    Draws use numpy.random instead of the random module of the former loop by
+    object: runs seeded with random.seed give other allocations than before.
+
+    Parameters
+    ----------
+    g: MTG
+        MTG representing the canopy (and the soil)
+    inoculum: list of dispersal units OR list of lesions
+        Source of fungal objects to distribute on the MTG
+    vids: list of int
+        Ids of the leaf elements that can receive inoculum
+    """
+    n = len(vids)
+    inoculum = list(inoculum)
+    if n==0 or len(inoculum)==0:
+        return
+
+    # Lesions or dispersal units: the stock is homogeneous
+    if isinstance(inoculum[0], Lesion):
+        prop_name = 'lesions'
+        as_cohorts = False
+    elif isinstance(inoculum[0], DispersalUnit):
+        prop_name = 'dispersal_units'
+        as_cohorts = getattr(inoculum[0].fungus, 'group_dus', False)==True
+    else:
+        return
+
+    # Draw target leaves and default positions for the whole stock
+    targets = np.random.randint(0, n, size=len(inoculum))
+    x_positions = np.random.random(len(inoculum))
+    for i, obj in enumerate(inoculum):
+        if getattr(obj, 'position', None) is None:
+            obj.position = [[x_positions[i], 0]]
+        if prop_name == 'dispersal_units':
+            obj.set_status(status='deposited')
+
+    # Group by target leaf and attach in bulk
+    g.add_property(prop_name)
+    prop = g.property(prop_name)
+    order = np.argsort(targets, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(targets[order]))+1
+    for group in np.split(order, bounds):
+        vid = vids[targets[group[0]]]
+        objs = [inoculum[i] for i in group]
+        if as_cohorts:
+            objs = [group_in_cohort(objs)]
+        prop[vid] = prop.get(vid, []) + objs
+
 class AirborneContamination:
     """ Model of airborne inoculation """
     def __init__(self, fungus, group_dus = False, mutable = False, 
@@ -220,19 +239,12 @@ class AirborneContamination:
     def leaves_in_grid(self, g, label = 'LeafElement'):
         geometries = g.property('geometry')
         centroids = g.property('centroid')
-        tesselator = pgl.Tesselator()
-        bbc = pgl.BBoxComputer(tesselator)      
         leaves = get_leaves(g, label=label)
         leaves = [l for l in leaves if l in geometries]
         
         # Get centroids        
         def centroid(vid):
-            if is_iterable(geometries[vid]):
-                bbc.process(pgl.Scene(geometries[vid]))
-            else:
-                bbc.process(pgl.Scene([pgl.Shape(geometries[vid])]))
-            center = bbc.result.getCenter()
-            centroids[vid] = center
+            centroids[vid] = geometry_center(geometries[vid])
         
         if len(leaves)>0:
             for vid in leaves:
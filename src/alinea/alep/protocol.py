@@ -1,10 +1,91 @@
 """ Define the protocol between plant architecture and lesions """
 
+def group_in_cohort(dus):
+    """ Merge dispersal units deposited together into a single cohort.
+
+    The first dispersal unit of the list is kept: it gathers the number of
+    dispersal units and the positions of all the others. The position of the
+    cohort is always a list of positions, even for a single dispersal unit.
+
+    :Parameters:
+     - 'dus' (list): Dispersal units of the same fungus to gather
+
+    :Returns:
+     - 'cohort' (DispersalUnit): Dispersal unit representing the whole group
+    """
+    cohort = dus[0]
+    positions = []
+    for du in dus:
+        position = getattr(du, 'position', None)
+        if position is None:
+            continue
+        elif len(position)>0 and hasattr(position[0], '__iter__'):
+            # Already a list of positions
+            positions += list(position)
+        else:
+            positions.append(position)
+    if len(dus)>1:
+        cohort.set_nb_dispersal_units(sum(du.nb_dispersal_units for du in dus))
+    if len(positions)>0 or len(dus)>1:
+        cohort.position = positions
+    return cohort
+
+def coalesce_dispersal_units(dispersal_units):
+    """ Merge the cohorts of dispersal units of same fungus and same state.
+
+    Only active cohorts that have not started infection yet (no climatic
+    sequence accumulated) and that share the same status, number of spores
+    and dry duration (for septoria) are merged: they are interchangeable.
+    Individual dispersal units (fungus with 'group_dus' False) and mutable
+    ones are kept as they are.
+
+    :Parameters:
+     - 'dispersal_units' (list): Dispersal units on a leaf element
+
+    :Returns:
+     - 'dispersal_units' (list): Dispersal units with one cohort by fungus and state
+    """
+    kept = []
+    cohorts = {}
+    for du in dispersal_units:
+        if (du.is_active and not du.mutable and du.fungus.group_dus==True and
+            len(getattr(du, 'temperature_sequence', []))==0):
+            key = (du.fungus.name, du.status, getattr(du, 'nb_spores', None),
+                   getattr(du, 'dry_dt', None))
+            if key not in cohorts:
+                cohorts[key] = []
+                kept.append(key)
+            cohorts[key].append(du)
+        else:
+            kept.append(du)
+    return [group_in_cohort(cohorts[k]) if isinstance(k, tuple) else k for k in kept]
+
+def deposit(g, deposits, label='LeafElement', coalesce=False):
+    """ Add dispersal units deposited on leaf elements to their property 'dispersal_units'.
+
+    :Parameters:
+     - 'g' (MTG): MTG representing the canopy
+     - 'deposits' (dict): {'leaf_id in the MTG': list of DU deposited}
+     - 'label' (str): Label of the part of the MTG concerned by the calculation
+     - 'coalesce' (bool): True to merge new cohorts with the cohorts of same
+        fungus and state already on the leaf (see 'coalesce_dispersal_units')
+    """
+    labels = g.property('label')
+    g.add_property('dispersal_units')
+    dispersal_units = g.property('dispersal_units')
+    for vid, dlist in deposits.iteritems():
+        if len(dlist)>0 and labels[vid].startswith(label):
+            dus = dispersal_units.get(vid, []) + list(dlist)
+            if coalesce:
+                dus = coalesce_dispersal_units(dus)
+            dispersal_units[vid] = dus
+
 def external_contamination(g, 
              contamination_source, 
              contamination_model,
              weather_data = None, 
-             label = 'LeafElement', **kwds):
+             label = 'LeafElement',
+             coalesce = False, **kwds):
     """ Inoculate fungal objects (DispersalUnit) on elements of the MTG by using a
     contamination_model.
 
@@ -16,25 +97,20 @@ def external_contamination(g,
         Requires a method named 'contaminate(g, DU, weather_data, label, **kwds)' (see doc)
      - 'weather_data' (pandas DataFrame): Weather data for the time step
      - 'label' (str): Label of the part of the MTG concerned by the calculation
+     - 'coalesce' (bool): True to merge deposited cohorts of same fungus and status
+        on each leaf into a single cohort
     
     :Returns:
      - 'g' (MTG): Updated MTG representing the canopy
     """
     stock = contamination_source.emission(g, weather_data, **kwds)
-    labels = g.property('label')
     if stock > 0:
         # Allocation of stock of inoculum
         deposits = contamination_model.contaminate(g, stock, weather_data, label=label, **kwds)
         stock = 0 # stock has been used (avoid uncontrolled future re-use)
 
         # Allocation of new dispersal units
-        for vid, dlist in deposits.iteritems():
-            if len(dlist)>0 and labels[vid].startswith(label):
-                leaf = g.node(vid)
-                try:
-                    leaf.dispersal_units += dlist
-                except:
-                    leaf.dispersal_units = dlist
+        deposit(g, deposits, label=label, coalesce=coalesce)
     return g
 
 def initiate(g, 
@@ -93,10 +169,53 @@ def infect(g, dt,
             du.infect(dt, leaf)
     return g
     
+def sub_steps(g, dt, max_ddday=None):
+    """ Split the time step in sub-steps that every lesion on the MTG can handle at once.
+    
+    Lesions providing 'split_time_step(temperature_sequence, max_ddday)' cut the
+    time step according to the temperatures of the canopy climate context. Lesions
+    of mutable fungi have their own stage durations: for each class of lesion, 
+    the time step is cut by the lesion that can handle the fewest degree days at
+    once ('time_step_limit(max_ddday)' if provided, otherwise one lesion by fungus).
+    Sub-steps are the union of these cuts.
+    
+    :Parameters:
+     - 'g' (MTG): MTG representing the canopy 
+     - 'dt' (int): Time step of the simulation
+     - 'max_ddday' (float): Maximum degree days in a sub-step
+     
+    :Returns:
+     - 'sub_steps' (list of tuples): Offsets (start, stop) of sub-steps in the time step
+    """
+    from alinea.alep.architecture import get_climate
+    climate = get_climate(g)
+    temperatures = climate.get('temperature_sequence') if climate is not None else None
+    if temperatures is None or len(temperatures) != dt:
+        return [(0, dt)]
+    splitters = {}
+    limits = {}
+    for les in g.property('lesions').itervalues():
+        for lesion in les:
+            if lesion.is_active and hasattr(lesion, 'split_time_step'):
+                if hasattr(lesion, 'time_step_limit'):
+                    key = type(lesion)
+                    limit = lesion.time_step_limit(max_ddday)
+                    if key not in limits or limit < limits[key]:
+                        splitters[key] = lesion
+                        limits[key] = limit
+                else:
+                    splitters.setdefault(id(lesion.fungus), lesion)
+    cuts = set([0, dt])
+    for lesion in splitters.itervalues():
+        cuts.update(start for start, stop in lesion.split_time_step(temperatures, max_ddday))
+    cuts = sorted(cuts)
+    return zip(cuts[:-1], cuts[1:])
+
 def update(g, dt,
            growth_control_model=None,
            weather_data=None,
-           label="LeafElement"):
+           label="LeafElement",
+           max_ddday=None):
     """ Update the status of every lesion on the MTG.
     
     In the framework, the growth of lesions is calculated in two steps:
@@ -105,6 +224,15 @@ def update(g, dt,
         - 2. A model at leaf scale gathers all the demands and limits the growth of each lesion
         ('growth_offer') depending on the space available on the leaf.
     
+    When the climate of the time step is given by a canopy climate context, the time step 
+    is split in sub-steps that lesions can handle at once (see 'sub_steps'), and both steps
+    are repeated on each sub-step. Coarse time steps (e.g. 6 to 24h in winter) are thus 
+    run as a single step when degree days are few, and sub-divided otherwise. Results are
+    then those of a simulation with steps of at most 'max_ddday' degree days: ages and 
+    status of lesions are those of hourly steps, surfaces of septoria lesions differ 
+    from those of hourly steps by about 1% with sub-steps as long as the shortest 
+    stage, and by less than 0.01% with max_ddday = 10.
+    
     :Parameters:
      - 'g' (MTG): MTG representing the canopy 
         'DispersalUnit' objects and climatic variables are stored in the MTG as properties
@@ -112,24 +240,35 @@ def update(g, dt,
      - 'growth_control_model' (Class): Model that coordinates thegrowth of lesions on the leaf. 
         Requires methods: 'control(g, label)' (see doc)
      - 'label' (str): Label of the part of the MTG concerned by the calculation
+     - 'max_ddday' (float): Maximum degree days in a sub-step. 
+        If None, sub-steps are only as short as required by lesions.
 
     :Returns:
      - 'g' (MTG): Updated MTG representing the canopy    
     """
     lesions = g.property('lesions')
-    # 1. Compute growth demand
-    for vid, les in lesions.iteritems():
-        for lesion in lesions[vid]:
-            if lesion.is_active:
-                leaf=g.node(vid)
-                if weather_data is None:
-                    lesion.update(dt, leaf)
-                else:
-                    lesion.update(dt, leaf, weather_data)
-    
-    # 2. Allocate or not growth demand
-    if growth_control_model:
-        growth_control_model.control(g, label=label)  
+    steps = sub_steps(g, dt, max_ddday) if weather_data is None else [(0, dt)]
+    climate = getattr(g, 'climate_context', None)
+    try:
+        for start, stop in steps:
+            if len(steps) > 1:
+                g.climate_context = climate.window(start, stop)
+            # 1. Compute growth demand
+            for vid, les in lesions.iteritems():
+                for lesion in lesions[vid]:
+                    if lesion.is_active:
+                        leaf=g.node(vid)
+                        if weather_data is None:
+                            lesion.update(stop - start, leaf)
+                        else:
+                            lesion.update(dt, leaf, weather_data)
+            
+            # 2. Allocate or not growth demand
+            if growth_control_model:
+                growth_control_model.control(g, label=label)
+    finally:
+        if len(steps) > 1:
+            g.climate_context = climate
     return g
 
 def disperse(g,
@@ -138,6 +277,7 @@ def disperse(g,
              fungus_name='', 
              weather_data=None,
              label="LeafElement",
+             coalesce=False,
 			 **kwds):
     """ Disperse spores of the lesions of fungus identified by fungus_name.
         
@@ -156,6 +296,8 @@ def disperse(g,
         Name of the fungus
      - 'weather_data' (pandas DataFrame): Weather data for the time step
      - 'label' (str): Label of the part of the MTG concerned by the calculation
+     - 'coalesce' (bool): True to merge deposited cohorts of same fungus and status
+        on each leaf into a single cohort (bounds the number of DUs by leaf)
     
     :Returns:
      - 'g' (MTG): Updated MTG representing the canopy
@@ -176,12 +318,36 @@ def disperse(g,
         # deposits is in the following format: dict: {'leaf_id in the MTG': list of DU deposited}
             
         # Allocation of new dispersal units
-        labels = g.property('label') 
-        for vid, dlist in deposits.iteritems():
-            if len(dlist)>0 and labels[vid].startswith(label):
-                leaf = g.node(vid)
-                try:
-                    leaf.dispersal_units += dlist
-                except:
-                    leaf.dispersal_units = dlist
+        deposit(g, deposits, label=label, coalesce=coalesce)
+    return g
+
+def wash(g, washing_model, global_rain_intensity, label='LeafElement'):
+    """ Wash the dispersal units deposited on leaves by rain.
+    
+    Each active dispersal unit on a leaf element is washed with the probability
+    given by the washing rate of the leaf. Cohorts lose a binomial number of 
+    dispersal units and are disabled when empty.
+    
+    :Parameters:
+     - 'g' (MTG): MTG representing the canopy 
+    washing_model: model
+        Model with a method 'compute_washing_rate' (e.g. RapillyWashing)
+     - 'global_rain_intensity' (float): Rain intensity over the canopy
+     - 'label' (str): Label of the part of the MTG concerned by the calculation
+    
+    :Returns:
+     - 'g' (MTG): Updated MTG representing the canopy
+    """
+    import numpy
+    vids, rates = washing_model.compute_washing_rate(g, global_rain_intensity, 
+                                                     label=label, as_array=True)
+    dispersal_units = g.property('dispersal_units')
+    for vid, rate in zip(vids, rates):
+        if rate > 0. and vid in dispersal_units:
+            for du in dispersal_units[vid]:
+                if du.is_active:
+                    nb_washed = numpy.random.binomial(int(du.nb_dispersal_units), rate)
+                    du.set_nb_dispersal_units(du.nb_dispersal_units - nb_washed)
+                    if du.nb_dispersal_units == 0:
+                        du.disable()
     return g
\ No newline at end of file
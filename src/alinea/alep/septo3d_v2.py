@@ -3,6 +3,7 @@
 """
 # Imports #####################################################################
 from alinea.alep.fungus import *
+from alinea.alep.architecture import leaf_climate
 from random import random
 import numpy as np
 from math import floor, ceil
@@ -56,10 +57,9 @@ class SeptoriaDU(DispersalUnit):
                 self.disable()
                 return
             else:
-                props = leaf.properties()
                 # Accumulate climatic data on the leaf sector during the time step
-                self.temperature_sequence += props['temperature_sequence']
-                self.wetness_sequence += props['wetness_sequence']
+                self.temperature_sequence += list(leaf_climate(leaf, 'temperature_sequence', []))
+                self.wetness_sequence += list(leaf_climate(leaf, 'wetness_sequence', []))
 
                 # Infection success
                 temps = self.temperature_sequence
@@ -153,8 +153,7 @@ class SeptoriaDU(DispersalUnit):
             self.nb_dispersal_units -= nb_lesions
             if 'temperature_sequence' in kwds:
                 temps = kwds['temperature_sequence']
-                leaf.temperature_sequence = temps
-                les.update(dt=len(temps), leaf=leaf)
+                les.update(dt=len(temps), leaf=leaf, temperature_sequence=temps)
             try:
                 leaf.lesions.append(les)
             except:
@@ -240,7 +239,7 @@ class SeptoriaLesion(Lesion):
         """ Check if lesion status is sporulation. """
         return self.status == self.fungus.SPORULATING
     
-    def update(self, dt=1., leaf=None):
+    def update(self, dt=1., leaf=None, temperature_sequence=None):
         """ Update the status of the lesion and create a new growth ring if needed.
                 
         Parameters
@@ -250,6 +249,8 @@ class SeptoriaLesion(Lesion):
         leaf: Leaf sector node of an MTG 
             A leaf sector with properties (e.g. area, green area, healthy area,
             senescence, rain intensity, wetness, temperature, lesions, etc.)
+        temperature_sequence: list
+            Temperatures during dt if not those of the leaf (e.g. at infection)
         """            
         # Manage senescence              
         if any([x[0]<=leaf.senesced_length for x in self.position]):
@@ -257,7 +258,7 @@ class SeptoriaLesion(Lesion):
 
         if self.is_active:           
             # Compute delta degree days in dt
-            self.compute_delta_ddays(dt, leaf)
+            self.compute_delta_ddays(dt, leaf, temperature_sequence)
             
             if self.ddday > 0.:
                 # Update age in degree days of the lesion
@@ -286,7 +287,7 @@ class SeptoriaLesion(Lesion):
                 round(self.surface_spo, 14) == 0.):
                     self.disable()
                 
-    def compute_delta_ddays(self, dt=1., leaf=None):
+    def compute_delta_ddays(self, dt=1., leaf=None, temperature_sequence=None):
         """ Compute delta degree days in dt.
         
         Parameters
@@ -296,23 +297,75 @@ class SeptoriaLesion(Lesion):
         leaf: Leaf sector node of an MTG 
             A leaf sector with properties (e.g. healthy surface,
             senescence, rain intensity, wetness, temperature, lesions) 
+        temperature_sequence: list
+            Temperatures during dt if not those of the leaf
         """        
         f = self.fungus
-        props = leaf.properties()
         # Calculation
         if dt != 0.:
-            ddday = sum([max(0,(temp - f.basis_for_dday)*1/24.) if temp<=f.temp_max else 0. for temp in props['temperature_sequence']])
-            if f.rh_effect==True:
-                if any([rh < f.rh_min for rh in props['relative_humidity_sequence']]) and self.is_incubating():
+            if temperature_sequence is None:
+                temperature_sequence = leaf_climate(leaf, 'temperature_sequence', [])
+            ddday = self.hourly_ddays(temperature_sequence).sum()
+            if f.rh_effect==True and self.is_incubating():
+                rhs = np.asarray(leaf_climate(leaf, 'relative_humidity_sequence', []), dtype=float)
+                if (rhs < f.rh_min).any():
                     ddday =0.
         else:
             ddday = 0.
         
         if ddday > f.degree_days_to_chlorosis or ddday > f.degree_days_to_necrosis or ddday > f.degree_days_to_sporulation:
-            raise SeptoError('Can not handle a dt > minimum stage duration')
+            raise SeptoError('Can not handle a dt > minimum stage duration, split it with split_time_step')
         
         # Save variable
         self.ddday = ddday
+
+    def hourly_ddays(self, temperature_sequence):
+        """ Compute degree days of each hour of a sequence of temperatures. """
+        f = self.fungus
+        temps = np.asarray(temperature_sequence, dtype=float)
+        return np.where(temps<=f.temp_max, np.maximum(0, (temps - f.basis_for_dday)*1/24.), 0.)
+
+    def time_step_limit(self, max_ddday=None):
+        """ Maximum degree days that the lesion can handle in a time step. """
+        f = self.fungus
+        limit = min(f.degree_days_to_chlorosis, f.degree_days_to_necrosis, f.degree_days_to_sporulation)
+        if max_ddday is not None:
+            limit = min(limit, max_ddday)
+        return limit
+
+    def split_time_step(self, temperature_sequence, max_ddday=None):
+        """ Split a time step in sub-steps that the lesion can handle at once.
+        
+        Each sub-step holds at most the minimum duration of lesion stages in
+        degree days, or max_ddday if lower. Results with sub-steps are those 
+        of a simulation with steps of at most max_ddday degree days (as with
+        septoria_filter_ddays with delay = max_ddday).
+        
+        Parameters
+        ----------
+        temperature_sequence: list
+            Temperatures during the time step
+        max_ddday: float
+            Maximum degree days in a sub-step
+            
+        Returns
+        -------
+        sub_steps: list of (start, stop)
+            Offsets of sub-steps in the time step
+        """
+        limit = self.time_step_limit(max_ddday)
+        ddays = self.hourly_ddays(temperature_sequence)
+        sub_steps = []
+        start = 0
+        total = 0.
+        for hour, ddday in enumerate(ddays):
+            if total + ddday > limit and hour > start:
+                sub_steps.append((start, hour))
+                start = hour
+                total = 0.
+            total += ddday
+        sub_steps.append((start, len(ddays)))
+        return sub_steps
     
     def progress(self, age_threshold=0.):
         """ Compute progress in physiological age according to age_threshold. 
@@ -13,15 +13,19 @@ from alinea.alep.simulation_tools.simulation_tools import (wheat_path,
                                                            grow_canopy,
                                                            alep_echap_reconstructions,
                                                            alep_custom_reconstructions,
+                                                           custom_canopy,
+                                                           CanopyServer,
+                                                           close_canopy,
+                                                           echap_adel,
                                                            get_iter_rep_wheats,
                                                            get_filename)
-from alinea.alep.architecture import set_properties
+from alinea.alep.architecture import set_climate
 
 # Imports for weather
 from alinea.alep.simulation_tools.simulation_tools import get_weather
 
 # Imports for scheduling of simulation
-from alinea.alep.alep_time_control import CustomIterWithDelays
+from alinea.alep.alep_time_control import CustomIterWithDelays, EventSchedule, WeatherWindows
 from alinea.astk.TimeControl import (time_filter, IterWithDelays,
                                      thermal_time_filter, DegreeDayModel,
                                      time_control)
@@ -35,7 +39,7 @@ from alinea.alep.growth_control import GeometricPoissonCompetition, SeptoRustCom
 from alinea.alep.inoculation import AirborneContamination
 from alinea.alep.protocol import infect, update, disperse, external_contamination
 from alinea.alep.infection_control import BiotrophDUProbaModel
-from alinea.alep.dispersal_transport import BrownRustDispersal
+from alinea.alep.dispersal_transport import BrownRustDispersal, BrownRustLayerDispersal
 
 # Temp
 from alinea.alep.disease_outputs import plot_by_leaf, get_data_without_death, get_synthetic_outputs_by_leaf
@@ -45,7 +49,9 @@ def setup_simu(sowing_date="2000-10-15 12:00:00", start_date = None,
                variety = 'Mercia', nplants = 30, nsect = 7,
                TT_delay = 20, dispersal_delay = 24,
                record=True, layer_thickness=1., rep_wheat = None, 
-               save_images=False, keep_leaves=False, leaf_duration=2., **kwds):
+               save_images=False, keep_leaves=False, leaf_duration=2., 
+               layer_kernel=False, cache_custom=False, 
+               pipeline_canopy=False, light_canopy=False, delta_canopy=False, **kwds):
     # Get weather
     weather = get_weather(start_date=sowing_date, end_date=end_date)
     
@@ -59,8 +65,27 @@ def setup_simu(sowing_date="2000-10-15 12:00:00", start_date = None,
     else:
         adel = alep_custom_reconstructions(variety='Tremie13', nplants=nplants, nsect=nsect, **kwds)
     year = int(end_date[:4])    
-    wheat_dir = wheat_path(year, variety, nplants, nsect, rep_wheat)
-    g, wheat_is_loaded = init_canopy(adel, wheat_dir, rain_and_light=True)
+    if variety=='Custom' and cache_custom==True:
+        wheat_dir = custom_canopy(adel, start_date or sowing_date, end_date, delay=TT_delay,
+                                  variety='Tremie13', nplants=nplants, nsect=nsect, **kwds)
+    else:
+        wheat_dir = wheat_path(year, variety, nplants, nsect, rep_wheat)
+    canopy_server = None
+    if pipeline_canopy==True:
+        # Grow canopy in a separate process if not saved
+        if variety!='Custom':
+            adel_kwds = dict(name=variety, nplants=nplants, nsect=nsect,
+                             keep_leaves=keep_leaves, leaf_duration=leaf_duration)
+            canopy_server = CanopyServer(echap_adel, adel_kwds,
+                                         start_date or sowing_date, end_date, delay=TT_delay)
+        else:
+            canopy_server = CanopyServer(alep_custom_reconstructions,
+                                         dict(variety='Tremie13', nplants=nplants, nsect=nsect, **kwds),
+                                         start_date or sowing_date, end_date, delay=TT_delay)
+    g, wheat_is_loaded = init_canopy(adel, wheat_dir, rain_and_light=True,
+                                     canopy_server=canopy_server,
+                                     light_canopy=light_canopy,
+                                     delta_canopy=delta_canopy)
     
     # Manage temporal sequence  
     if start_date is None:
@@ -90,10 +115,11 @@ def setup_simu(sowing_date="2000-10-15 12:00:00", start_date = None,
                                          group_dus = True,
                                          domain_area = adel.domain_area,
                                          layer_thickness=layer_thickness)
-    dispersor = BrownRustDispersal(fungus = fungus,
-                                   group_dus = True,
-                                   domain_area = adel.domain_area,
-                                   layer_thickness=layer_thickness)
+    dispersal_model = BrownRustLayerDispersal if layer_kernel else BrownRustDispersal
+    dispersor = dispersal_model(fungus = fungus,
+                                group_dus = True,
+                                domain_area = adel.domain_area,
+                                layer_thickness=layer_thickness)
     return (g, adel, fungus,  canopy_timing, dispersal_timing, rust_timing, 
             recorder, growth_controler, infection_controler, 
             contaminator, dispersor, it_wheat, wheat_dir, wheat_is_loaded)
@@ -119,62 +145,70 @@ def annual_loop_rust(year = 2013, variety = 'Tremie13',
                    leaf_duration=leaf_duration, **kwds)
         
     # Simulation loop
-    for i, controls in enumerate(zip(canopy_timing, 
-                                     dispersal_timing, 
-                                     rust_timing)):
-        canopy_iter, dispersal_iter, rust_iter = controls
-        # Grow wheat canopy
-        if canopy_iter:
-            it_wheat += 1
-            g = grow_canopy(g, adel, canopy_iter, it_wheat,
-                        wheat_dir, wheat_is_loaded)
-        # Get weather for date and add it as properties on leaves
-        if rust_iter:
-            set_properties(g,label = 'LeafElement',
-                           temperature_sequence = rust_iter.value.temperature_air.tolist(),
-                           wetness_sequence = rust_iter.value.wetness.tolist(),
-                           dd_sequence = rust_iter.value.degree_days.tolist())
-        # Simulate airborne contamination
-        geom = g.property('geometry')
-        if dispersal_iter and len(geom)>0:
-            external_contamination(g, contaminator, contaminator, 
-                                   density_dispersal_units=density_dispersal_units,
-                                   domain_area=adel.domain_area)
-        # Develop disease (infect for dispersal units and update for lesions)
-        if rust_iter:
-            infect(g, rust_iter.dt, infection_controler, label='LeafElement')
-            group_duplicates_in_cohort(g) # Additional optimisation (group identical cohorts)
-            update(g, rust_iter.dt, growth_controler, label='LeafElement')
-        # Disperse disease
-        if dispersal_iter and len(geom)>0:
-            g = disperse(g, dispersor, dispersor,
-                         fungus_name = "brown_rust",
-                         label='LeafElement', 
-                         weather_data=dispersal_iter.value,
-                         domain_area=adel.domain_area)
-        # Save images
-        if save_images == True:
+    # Only visit steps where at least one model is called
+    schedule = EventSchedule(canopy=canopy_timing, 
+                             dispersal=dispersal_timing, 
+                             rust=rust_timing)
+    weather_windows = WeatherWindows.from_timing(rust_timing,
+                                                 names=['temperature_air', 'wetness', 'degree_days'])
+    try:
+        for step, events in schedule:
+            canopy_iter, dispersal_iter, rust_iter = [events.get(name) for name in 
+                                                      ('canopy', 'dispersal', 'rust')]
+            # Grow wheat canopy
             if canopy_iter:
-                scene = plot_severity_rust_by_leaf(g, senescence=False)
-                if it_wheat < 10 :
-                    image_name=variety+'_image0000%d.png' % it_wheat
-                elif it_wheat < 100 :
-                    image_name=variety+'_image000%d.png' % it_wheat
-                elif it_wheat < 1000 :
-                    image_name=variety+'_image00%d.png' % it_wheat
-                elif it_wheat < 10000 :
-                    image_name=variety+'_image0%d.png' % it_wheat
-                else :
-                    image_name='image%d.png' % it_wheat
-                image_name = str(shared_data(alinea.alep)/'images_rust'/image_name)
-                save_image(scene, image_name=image_name)        
+                it_wheat += 1
+                g = grow_canopy(g, adel, canopy_iter, it_wheat,
+                            wheat_dir, wheat_is_loaded)
+            # Get weather for date and give it to the canopy
+            if rust_iter:
+                climate = weather_windows.window(rust_iter)
+                set_climate(g, temperature_sequence = climate['temperature_air'],
+                               wetness_sequence = climate['wetness'],
+                               dd_sequence = climate['degree_days'])
+            # Simulate airborne contamination
+            geom = g.property('geometry')
+            if dispersal_iter and len(geom)>0:
+                external_contamination(g, contaminator, contaminator, 
+                                       density_dispersal_units=density_dispersal_units,
+                                       domain_area=adel.domain_area)
+            # Develop disease (infect for dispersal units and update for lesions)
+            if rust_iter:
+                infect(g, rust_iter.dt, infection_controler, label='LeafElement')
+                group_duplicates_in_cohort(g) # Additional optimisation (group identical cohorts)
+                update(g, rust_iter.dt, growth_controler, label='LeafElement')
+            # Disperse disease
+            if dispersal_iter and len(geom)>0:
+                g = disperse(g, dispersor, dispersor,
+                             fungus_name = "brown_rust",
+                             label='LeafElement', 
+                             weather_data=dispersal_iter.value,
+                             domain_area=adel.domain_area)
+            # Save images
+            if save_images == True:
+                if canopy_iter:
+                    scene = plot_severity_rust_by_leaf(g, senescence=False)
+                    if it_wheat < 10 :
+                        image_name=variety+'_image0000%d.png' % it_wheat
+                    elif it_wheat < 100 :
+                        image_name=variety+'_image000%d.png' % it_wheat
+                    elif it_wheat < 1000 :
+                        image_name=variety+'_image00%d.png' % it_wheat
+                    elif it_wheat < 10000 :
+                        image_name=variety+'_image0%d.png' % it_wheat
+                    else :
+                        image_name='image%d.png' % it_wheat
+                    image_name = str(shared_data(alinea.alep)/'images_rust'/image_name)
+                    save_image(scene, image_name=image_name)        
         
-        # Save outputs
-        if rust_iter and record == True:
-            date = rust_iter.value.index[-1]
-            print date
-            recorder.record(g, date, 
-                            degree_days = rust_iter.value.degree_days[-1])
+            # Save outputs
+            if rust_iter and record == True:
+                date = rust_iter.value.index[-1]
+                print date
+                recorder.record(g, date, 
+                                degree_days = rust_iter.value.degree_days[-1])
+    finally:
+        close_canopy(wheat_is_loaded)
    
     if record == True:
         recorder.post_treatment(variety=variety)
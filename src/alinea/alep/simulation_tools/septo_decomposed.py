@@ -11,13 +11,17 @@ from alinea.alep.simulation_tools.simulation_tools import (wheat_path,
                                                            grow_canopy,
                                                            alep_echap_reconstructions,
                                                            alep_custom_reconstructions,
+                                                           custom_canopy,
+                                                           CanopyServer,
+                                                           close_canopy,
+                                                           echap_adel,
                                                            get_iter_rep_wheats,
                                                            get_filename)
-from alinea.alep.architecture import set_properties
+from alinea.alep.architecture import set_climate
 
 # Imports for weather
 from simulation_tools import get_weather
-from alinea.alep.alep_time_control import CustomIterWithDelays, septoria_filter_ddays
+from alinea.alep.alep_time_control import CustomIterWithDelays, septoria_filter_ddays, EventSchedule, WeatherWindows
 from alinea.astk.TimeControl import (IterWithDelays, rain_filter, time_filter,
                                      thermal_time_filter, DegreeDayModel,
                                      time_control)
@@ -29,6 +33,7 @@ from alinea.alep.simulation_tools.simulation_tools import group_duplicates_in_co
 from alinea.septo3d.dispersion.alep_interfaces import SoilInoculum, Septo3DEmission
 from alinea.popdrops.alep_interface import PopDropsSoilContamination, PopDropsEmission, PopDropsTransport
 from alinea.alep.growth_control import PriorityGrowthControl, SeptoRustCompetition, GeometricPoissonCompetition
+from alinea.alep.dispersal_transport import TransferMatrixCache
 from alinea.alep.infection_control import BiotrophDUProbaModel
 from alinea.alep.disease_outputs import save_image, AdelSeptoRecorder
 from variable_septoria import *
@@ -46,7 +51,8 @@ def setup(sowing_date="2010-10-15 12:00:00", start_date=None,
           nplants=30, nsect=7, disc_level=5, septo_delay_dday=10.,
           rain_min=0.2, recording_delay=24., rep_wheat=None,
           save_images=False, keep_leaves=False, leaf_duration=2.,
-          single_nff=False, variability=True, **kwds):
+          single_nff=False, variability=True, cache_custom=False,
+          pipeline_canopy=False, light_canopy=False, delta_canopy=False, **kwds):
     """ Get plant model, weather data and set scheduler for simulation. """
     # Set canopy
     it_wheat = 0
@@ -59,8 +65,28 @@ def setup(sowing_date="2010-10-15 12:00:00", start_date=None,
     else:
         adel = alep_custom_reconstructions(variety='Tremie13', nplants=nplants, nsect=nsect, **kwds)
     year = int(end_date[:4])
-    wheat_dir = wheat_path(year, variety, nplants, nsect, rep_wheat)
-    g, wheat_is_loaded = init_canopy(adel, wheat_dir, rain_and_light=True)
+    if variety=='Custom' and cache_custom==True:
+        wheat_dir = custom_canopy(adel, start_date or sowing_date, end_date, delay=20.,
+                                  variety='Tremie13', nplants=nplants, nsect=nsect, **kwds)
+    else:
+        wheat_dir = wheat_path(year, variety, nplants, nsect, rep_wheat)
+    canopy_server = None
+    if pipeline_canopy==True:
+        # Grow canopy in a separate process if not saved
+        if variety!='Custom':
+            adel_kwds = dict(name=variety, nplants=nplants, nsect=nsect,
+                             keep_leaves=keep_leaves, leaf_duration=leaf_duration,
+                             single_nff=single_nff, variability=variability)
+            canopy_server = CanopyServer(echap_adel, adel_kwds,
+                                         start_date or sowing_date, end_date, delay=20.)
+        else:
+            canopy_server = CanopyServer(alep_custom_reconstructions,
+                                         dict(variety='Tremie13', nplants=nplants, nsect=nsect, **kwds),
+                                         start_date or sowing_date, end_date, delay=20.)
+    g, wheat_is_loaded = init_canopy(adel, wheat_dir, rain_and_light=True,
+                                     canopy_server=canopy_server,
+                                     light_canopy=light_canopy,
+                                     delta_canopy=delta_canopy)
 
     # Manage weather
     weather = get_weather(start_date=sowing_date, end_date=end_date)
@@ -84,8 +110,14 @@ def setup(sowing_date="2010-10-15 12:00:00", start_date=None,
 
 def septo_disease(adel, sporulating_fraction, layer_thickness,
                   distri_chlorosis=None, competition='poisson',
-                  age_infection=False, compute_star=False, **kwds):
-    """ Choose models to assemble the disease model. """
+                  age_infection=False, compute_star=False,
+                  cache_transport=False, washing_model=None, **kwds):
+    """ Choose models to assemble the disease model.
+
+    With 'cache_transport', PopDrops transport is wrapped in a TransferMatrixCache
+    and leaves are washed by 'washing_model' (e.g. RapillyWashing) instead of
+    PopDrops: results then differ from the uncached transport.
+    """
 
     if 'alinea.alep.septo3d_v2' in sys.modules:
         del (sys.modules['alinea.alep.septo3d_v2'])
@@ -120,6 +152,9 @@ def septo_disease(adel, sporulating_fraction, layer_thickness,
                                     domain=domain, domain_area=domain_area,
                                     dh=layer_thickness, convUnit=convUnit,
                                     compute_star=compute_star, wash=True)
+    if cache_transport:
+        transporter = TransferMatrixCache(transporter, fungus=fungus,
+                                          washing_model=washing_model)
     return inoculum, contaminator, infection_controler, growth_controler, emitter, transporter
 
 
@@ -131,8 +166,12 @@ def annual_loop_septo(year=2013, variety='Tremie13', sowing_date='10-29',
                       reset_reconst=True, distri_chlorosis=None,
                       rep_wheat=None, age_infection=False, keep_leaves=False,
                       leaf_duration=2., compute_star=False,
-                      single_nff=False, variability=True, **kwds):
-    """ Simulate epidemics with canopy saved before simulation """
+                      single_nff=False, variability=True,
+                      cache_transport=False, washing_model=None, **kwds):
+    """ Simulate epidemics with canopy saved before simulation
+
+    'washing_model' is required with 'cache_transport' (see septo_disease).
+    """
     (g, adel, weather, seq, rain_timing,
      canopy_timing, septo_timing, recorder_timing, it_wheat, wheat_dir,
      wheat_is_loaded) = setup(sowing_date=str(year - 1) + "-" + sowing_date + " 12:00:00",
@@ -152,69 +191,87 @@ def annual_loop_septo(year=2013, variety='Tremie13', sowing_date='10-29',
                                   distri_chlorosis, competition=competition,
                                   age_infection=age_infection,
                                   compute_star=compute_star,
+                                  cache_transport=cache_transport,
+                                  washing_model=washing_model,
                                   **kwds)
 
     # Prepare saving of outputs
     if record == True:
         recorder = AdelSeptoRecorder(add_height=True)
 
-    for i, controls in enumerate(zip(canopy_timing, rain_timing,
-                                     septo_timing, recorder_timing)):
-        canopy_iter, rain_iter, septo_iter, record_iter = controls
-
-        # Grow wheat canopy
-        if canopy_iter:
-            it_wheat += 1
-            g = grow_canopy(g, adel, canopy_iter, it_wheat,
-                            wheat_dir, wheat_is_loaded, rain_and_light=True)
-            # Get weather for date and add it as properties on leaves
-        if septo_iter:
-            set_properties(g, label='LeafElement',
-                           temperature_sequence=septo_iter.value.temperature_air.tolist(),
-                           wetness_sequence=septo_iter.value.wetness.tolist(),
-                           relative_humidity_sequence=septo_iter.value.relative_humidity.tolist(),
-                           dd_sequence=septo_iter.value.degree_days.tolist())
-        if rain_iter:
-            set_properties(g, label='LeafElement',
-                           rain_intensity=rain_iter.value.rain.mean(),
-                           rain_duration=len(rain_iter.value.rain) if rain_iter.value.rain.sum() > 0 else 0.)
-        # External contamination
-        geom = g.property('geometry')
-        if rain_iter and len(geom) > 0 and rain_iter.value.rain.mean() > 0.2:
-            g = external_contamination(g, inoculum, contaminator, rain_iter.value,
-                                       domain=adel.domain,
-                                       domain_area=adel.domain_area)
-        # Develop disease (infect for dispersal units and update for lesions)
-        if septo_iter:
-            infect(g, septo_iter.dt, infection_controler, label='LeafElement')
-            group_duplicates_in_cohort(g)  # Additional optimisation (group identical cohorts)
-            update(g, septo_iter.dt, growth_controler, label='LeafElement')
-            # Disperse and wash
-        if rain_iter and len(geom) > 0 and rain_iter.value.rain.mean() > 0.2:
-            g = disperse(g, emitter, transporter, "septoria",
-                         label='LeafElement', weather_data=rain_iter.value,
-                         domain=adel.domain, domain_area=adel.domain_area)
-        # Save images
-        if save_images == True:
+    # Weather read on leaves by PopDrops and by variable_septoria
+    rain_on_leaves = ['rain_intensity', 'rain_duration']
+    septo_on_leaves = ([] if distri_chlorosis is None else
+                       ['temperature_sequence', 'wetness_sequence',
+                        'relative_humidity_sequence', 'dd_sequence'])
+
+    # Only visit steps where at least one model is called
+    schedule = EventSchedule(canopy=canopy_timing, rain=rain_timing,
+                             septo=septo_timing, recorder=recorder_timing)
+    weather_windows = WeatherWindows.from_timing(septo_timing,
+                                                 names=['temperature_air', 'wetness',
+                                                        'relative_humidity', 'degree_days'])
+    try:
+        for step, events in schedule:
+            canopy_iter, rain_iter, septo_iter, record_iter = [events.get(name) for name in
+                                                               ('canopy', 'rain', 'septo', 'recorder')]
+
+            # Grow wheat canopy
             if canopy_iter:
-                scene = plot_severity_septo_by_leaf(g, senescence=False)
-                if it_wheat < 10:
-                    image_name = variety + '_image0000%d.png' % it_wheat
-                elif it_wheat < 100:
-                    image_name = variety + '_image000%d.png' % it_wheat
-                elif it_wheat < 1000:
-                    image_name = variety + '_image00%d.png' % it_wheat
-                elif it_wheat < 10000:
-                    image_name = variety + '_image0%d.png' % it_wheat
-                else:
-                    image_name = 'image%d.png' % it_wheat
-                image_name = str(shared_data(alinea.alep) / 'images_septo' / image_name)
-                save_image(scene, image_name=image_name)
-        # Save outputs
-        if record_iter and record == True:
-            date = record_iter.value.index[-1]
-            print date
-            recorder.record(g, date, degree_days=record_iter.value.degree_days[-1])
+                it_wheat += 1
+                g = grow_canopy(g, adel, canopy_iter, it_wheat,
+                                wheat_dir, wheat_is_loaded, rain_and_light=True)
+                # Get weather for date and give it to the canopy
+            if septo_iter:
+                climate = weather_windows.window(septo_iter)
+                set_climate(g, temperature_sequence=climate['temperature_air'],
+                               wetness_sequence=climate['wetness'],
+                               relative_humidity_sequence=climate['relative_humidity'],
+                               dd_sequence=climate['degree_days'],
+                               leaf_properties=septo_on_leaves)
+            if rain_iter:
+                set_climate(g, leaf_properties=rain_on_leaves,
+                               rain_intensity=rain_iter.value.rain.mean(),
+                               rain_duration=len(rain_iter.value.rain) if rain_iter.value.rain.sum() > 0 else 0.)
+            # External contamination
+            geom = g.property('geometry')
+            if rain_iter and len(geom) > 0 and rain_iter.value.rain.mean() > 0.2:
+                g = external_contamination(g, inoculum, contaminator, rain_iter.value,
+                                           domain=adel.domain,
+                                           domain_area=adel.domain_area)
+            # Develop disease (infect for dispersal units and update for lesions)
+            if septo_iter:
+                infect(g, septo_iter.dt, infection_controler, label='LeafElement')
+                group_duplicates_in_cohort(g)  # Additional optimisation (group identical cohorts)
+                update(g, septo_iter.dt, growth_controler, label='LeafElement')
+                # Disperse and wash
+            if rain_iter and len(geom) > 0 and rain_iter.value.rain.mean() > 0.2:
+                g = disperse(g, emitter, transporter, "septoria",
+                             label='LeafElement', weather_data=rain_iter.value,
+                             domain=adel.domain, domain_area=adel.domain_area)
+            # Save images
+            if save_images == True:
+                if canopy_iter:
+                    scene = plot_severity_septo_by_leaf(g, senescence=False)
+                    if it_wheat < 10:
+                        image_name = variety + '_image0000%d.png' % it_wheat
+                    elif it_wheat < 100:
+                        image_name = variety + '_image000%d.png' % it_wheat
+                    elif it_wheat < 1000:
+                        image_name = variety + '_image00%d.png' % it_wheat
+                    elif it_wheat < 10000:
+                        image_name = variety + '_image0%d.png' % it_wheat
+                    else:
+                        image_name = 'image%d.png' % it_wheat
+                    image_name = str(shared_data(alinea.alep) / 'images_septo' / image_name)
+                    save_image(scene, image_name=image_name)
+            # Save outputs
+            if record_iter and record == True:
+                date = record_iter.value.index[-1]
+                print date
+                recorder.record(g, date, degree_days=record_iter.value.degree_days[-1])
+    finally:
+        close_canopy(wheat_is_loaded)
 
     if record:
         recorder.post_treatment(variety=variety)
@@ -8,7 +8,7 @@ import sys
 
 # Imports for weather and scheduling of simulation
 from alinea.alep.simulation_tools.simulation_tools import get_weather
-from alinea.alep.alep_time_control import CustomIterWithDelays, septoria_filter_ddays
+from alinea.alep.alep_time_control import CustomIterWithDelays, septoria_filter_ddays, EventSchedule, WeatherWindows
 from alinea.astk.TimeControl import (time_filter, rain_filter, IterWithDelays,
                                      thermal_time_filter, DegreeDayModel,
                                      time_control)
@@ -23,7 +23,7 @@ from alinea.popdrops.alep_interface import (PopDropsSoilContamination,
 # Imports for rust
 from alinea.alep.brown_rust import BrownRustFungus
 from alinea.alep.inoculation import AirborneContamination
-from alinea.alep.dispersal_transport import BrownRustDispersal
+from alinea.alep.dispersal_transport import BrownRustDispersal, BrownRustLayerDispersal
 
 # Imports for both diseases
 from alinea.alep.simulation_tools.simulation_tools import group_duplicates_in_cohort
@@ -38,10 +38,14 @@ from alinea.alep.simulation_tools.simulation_tools import (wheat_path,
                                                            grow_canopy,
                                                            alep_echap_reconstructions,
                                                            alep_custom_reconstructions,
+                                                           custom_canopy,
+                                                           CanopyServer,
+                                                           close_canopy,
+                                                           echap_adel,
                                                            get_iter_rep_wheats,
                                                            get_filename,
                                                            get_data_sim)
-from alinea.alep.architecture import set_properties
+from alinea.alep.architecture import set_climate
 from alinea.alep.disease_outputs import plot_by_leaf
 
 # Temp
@@ -58,12 +62,15 @@ def setup_simu(sowing_date="2000-10-15 12:00:00", start_date = None,
                rust_dispersal_delay = 24, recording_delay = 24,
                record=True, layer_thickness_septo = 0.01,
                layer_thickness_rust = 1., rep_wheat = None, group_dus = True,
-               leaf_duration = 2., **kwds):
+               leaf_duration = 2., layer_kernel_rust = False, cache_custom=False, 
+               pipeline_canopy = False, light_canopy = False, delta_canopy = False, **kwds):
     """ Setup the simulation 
     
     Note : kwds are used to modify disease parameters, if same name of parameter for septoria and 
     rust, need to specify in name with '_septoria' or '_rust', otherwise they are given the same 
     value.
+    If layer_kernel_rust is True, rust is dispersed with a kernel of layers 
+    computed once per canopy iteration (BrownRustLayerDispersal).
     
     """
     def modif_params(fungus, suffix='_septoria'):
@@ -87,8 +94,27 @@ def setup_simu(sowing_date="2000-10-15 12:00:00", start_date = None,
     else:
         adel = alep_custom_reconstructions(variety='Tremie13', nplants=nplants, nsect=nsect, **kwds)
     year = int(end_date[:4])    
-    wheat_dir = wheat_path(year, variety, nplants, nsect, rep_wheat)
-    g, wheat_is_loaded = init_canopy(adel, wheat_dir, rain_and_light=True)
+    if variety=='Custom' and cache_custom==True:
+        wheat_dir = custom_canopy(adel, start_date or sowing_date, end_date, delay=TT_delay,
+                                  variety='Tremie13', nplants=nplants, nsect=nsect, **kwds)
+    else:
+        wheat_dir = wheat_path(year, variety, nplants, nsect, rep_wheat)
+    canopy_server = None
+    if pipeline_canopy==True:
+        # Grow canopy in a separate process if not saved
+        if variety!='Custom':
+            adel_kwds = dict(name=variety, nplants=nplants, nsect=nsect,
+                             leaf_duration=leaf_duration)
+            canopy_server = CanopyServer(echap_adel, adel_kwds,
+                                         start_date or sowing_date, end_date, delay=TT_delay)
+        else:
+            canopy_server = CanopyServer(alep_custom_reconstructions,
+                                         dict(variety='Tremie13', nplants=nplants, nsect=nsect, **kwds),
+                                         start_date or sowing_date, end_date, delay=TT_delay)
+    g, wheat_is_loaded = init_canopy(adel, wheat_dir, rain_and_light=True,
+                                     canopy_server=canopy_server,
+                                     light_canopy=light_canopy,
+                                     delta_canopy=delta_canopy)
     domain = adel.domain
     domain_area = adel.domain_area
     convUnit = adel.convUnit
@@ -144,10 +170,11 @@ def setup_simu(sowing_date="2000-10-15 12:00:00", start_date = None,
                                           domain = domain, domain_area = domain_area,
                                           dh = layer_thickness_septo, convUnit = convUnit,
                                           compute_star = False)
-    rust_dispersor = BrownRustDispersal(fungus = brown_rust,
-                                        group_dus = group_dus,
-                                        domain_area = adel.domain_area,
-                                        layer_thickness=layer_thickness_rust)
+    rust_model = BrownRustLayerDispersal if layer_kernel_rust else BrownRustDispersal
+    rust_dispersor = rust_model(fungus = brown_rust,
+                                group_dus = group_dus,
+                                domain_area = adel.domain_area,
+                                layer_thickness=layer_thickness_rust)
     return (g, adel, brown_rust, septoria, canopy_timing, septo_dispersal_timing, 
             rust_dispersal_timing, septo_rust_timing, recorder_timing,
             recorder, growth_controler, infection_controler, septo_inoculum,
@@ -187,34 +214,44 @@ def annual_loop_septo_rust(year = 2013, variety = 'Tremie13', sowing_date = '10-
         phenT = phenT[phenT['n']==phenT['n'].max()-force_inoc_leaf+1]
         date_inoc_rust = phenT['col'].max()
 
-    for i, controls in enumerate(zip(canopy_timing, septo_dispersal_timing, rust_dispersal_timing,
-                                     septo_rust_timing, recorder_timing)):
-        (canopy_iter, septo_dispersal_iter, rust_dispersal_iter,
-        septo_rust_iter, record_iter) = controls
+    # Only visit steps where at least one model is called
+    schedule = EventSchedule(canopy=canopy_timing, septo_dispersal=septo_dispersal_timing,
+                             rust_dispersal=rust_dispersal_timing, 
+                             septo_rust=septo_rust_timing, recorder=recorder_timing)
+    weather_windows = WeatherWindows.from_timing(septo_rust_timing,
+                                                 names=['temperature_air', 'wetness',
+                                                        'relative_humidity', 'degree_days'])
+    try:
+        for step, events in schedule:
+            (canopy_iter, septo_dispersal_iter, rust_dispersal_iter,
+            septo_rust_iter, record_iter) = [events.get(name) for name in 
+                                             ('canopy', 'septo_dispersal', 'rust_dispersal',
+                                              'septo_rust', 'recorder')]
         
-        # Grow wheat canopy
-        if canopy_iter:
-            it_wheat += 1
-            g = grow_canopy(g, adel, canopy_iter, it_wheat,
-                        wheat_dir, wheat_is_loaded,rain_and_light=True)               
+            # Grow wheat canopy
+            if canopy_iter:
+                it_wheat += 1
+                g = grow_canopy(g, adel, canopy_iter, it_wheat,
+                            wheat_dir, wheat_is_loaded,rain_and_light=True)               
                 
-        # Get weather for date and add it as properties on leaves
-        if septo_rust_iter:
-            set_properties(g,label = 'LeafElement',
-                           temperature_sequence = septo_rust_iter.value.temperature_air.tolist(),
-                           wetness_sequence = septo_rust_iter.value.wetness.tolist(),
-                           relative_humidity_sequence = septo_rust_iter.value.relative_humidity.tolist(),
-                           dd_sequence = septo_rust_iter.value.degree_days.tolist())
-        if septo_dispersal_iter:
-            set_properties(g,label = 'LeafElement',
-                           rain_intensity = septo_dispersal_iter.value.rain.mean(),
-                           rain_duration = len(septo_dispersal_iter.value.rain) if septo_dispersal_iter.value.rain.sum() > 0 else 0.)
-        # External contamination
-        geom = g.property('geometry')
-        if septo_dispersal_iter and len(geom)>0 and septo_dispersal_iter.value.rain.mean()>0.2:
-            g = external_contamination(g, septo_inoculum, septo_contaminator, septo_dispersal_iter.value,
-                                       domain=adel.domain, 
-                                       domain_area=adel.domain_area)
+            # Get weather for date and give it to the canopy
+            if septo_rust_iter:
+                climate = weather_windows.window(septo_rust_iter)
+                set_climate(g, temperature_sequence = climate['temperature_air'],
+                               wetness_sequence = climate['wetness'],
+                               relative_humidity_sequence = climate['relative_humidity'],
+                               dd_sequence = climate['degree_days'])
+            if septo_dispersal_iter:
+                # Rain is read on leaves by PopDrops
+                set_climate(g, leaf_properties = ['rain_intensity', 'rain_duration'],
+                               rain_intensity = septo_dispersal_iter.value.rain.mean(),
+                               rain_duration = len(septo_dispersal_iter.value.rain) if septo_dispersal_iter.value.rain.sum() > 0 else 0.)
+            # External contamination
+            geom = g.property('geometry')
+            if septo_dispersal_iter and len(geom)>0 and septo_dispersal_iter.value.rain.mean()>0.2:
+                g = external_contamination(g, septo_inoculum, septo_contaminator, septo_dispersal_iter.value,
+                                           domain=adel.domain, 
+                                           domain_area=adel.domain_area)
 #        if (rust_dispersal_iter and len(geom)>0 and
 #            rust_dispersal_iter.value.index[0] > pd.to_datetime(str(year)+'-03-01') and
 #            rust_dispersal_iter.value.index[-1] < pd.to_datetime(str(year)+'-03-15')):
@@ -222,38 +259,40 @@ def annual_loop_septo_rust(year = 2013, variety = 'Tremie13', sowing_date = '10-
 #            rust_dispersal_iter.value.degree_days.tolist()[-1] > date_inoc_rust and
 #            rust_dispersal_iter.value.degree_days.tolist()[-1] < date_inoc_rust+length_inoc_rust):
 #            print 'RUST INOC'
-        if (rust_dispersal_iter and len(geom)>0):
-            if force_inoc_leaf is not None:
-                if (rust_dispersal_iter.value.degree_days.tolist()[-1] > date_inoc_rust and
-                    rust_dispersal_iter.value.degree_days.tolist()[-1] < date_inoc_rust+length_inoc_rust):
+            if (rust_dispersal_iter and len(geom)>0):
+                if force_inoc_leaf is not None:
+                    if (rust_dispersal_iter.value.degree_days.tolist()[-1] > date_inoc_rust and
+                        rust_dispersal_iter.value.degree_days.tolist()[-1] < date_inoc_rust+length_inoc_rust):
+                        g = external_contamination(g, rust_contaminator, rust_contaminator, 
+                                           density_dispersal_units=density_dispersal_units,
+                                           domain_area=adel.domain_area)
+                else:
                     g = external_contamination(g, rust_contaminator, rust_contaminator, 
-                                       density_dispersal_units=density_dispersal_units,
-                                       domain_area=adel.domain_area)
-            else:
-                g = external_contamination(g, rust_contaminator, rust_contaminator, 
-                                       density_dispersal_units=density_dispersal_units,
-                                       domain_area=adel.domain_area)
-        # Develop disease (infect for dispersal units and update for lesions)
-        if septo_rust_iter:
-            infect(g, septo_rust_iter.dt, infection_controler, label='LeafElement')
+                                           density_dispersal_units=density_dispersal_units,
+                                           domain_area=adel.domain_area)
+            # Develop disease (infect for dispersal units and update for lesions)
+            if septo_rust_iter:
+                infect(g, septo_rust_iter.dt, infection_controler, label='LeafElement')
 #            group_duplicates_in_cohort(g) # Additional optimisation (group identical cohorts)
-            update(g, septo_rust_iter.dt, growth_controler, label='LeafElement')            
+                update(g, septo_rust_iter.dt, growth_controler, label='LeafElement')            
 #         Disperse and wash
-        if septo_dispersal_iter and len(geom)>0 and septo_dispersal_iter.value.rain.mean()>0.2:
-            g = disperse(g, septo_emitter, septo_transporter, "septoria",
-                         label='LeafElement', weather_data=septo_dispersal_iter.value,
-                         domain=adel.domain, domain_area=adel.domain_area)
-        if rust_dispersal_iter and len(geom)>0:
-            g = disperse(g, rust_dispersor, rust_dispersor,
-                         fungus_name = "brown_rust",
-                         label='LeafElement', 
-                         weather_data=rust_dispersal_iter.value,
-                         domain_area=adel.domain_area)
-        # Save outputs
-        if record_iter and record == True:
-            date = record_iter.value.index[-1]
-            print date
-            recorder.record(g, date, degree_days = record_iter.value.degree_days[-1])
+            if septo_dispersal_iter and len(geom)>0 and septo_dispersal_iter.value.rain.mean()>0.2:
+                g = disperse(g, septo_emitter, septo_transporter, "septoria",
+                             label='LeafElement', weather_data=septo_dispersal_iter.value,
+                             domain=adel.domain, domain_area=adel.domain_area)
+            if rust_dispersal_iter and len(geom)>0:
+                g = disperse(g, rust_dispersor, rust_dispersor,
+                             fungus_name = "brown_rust",
+                             label='LeafElement', 
+                             weather_data=rust_dispersal_iter.value,
+                             domain_area=adel.domain_area)
+            # Save outputs
+            if record_iter and record == True:
+                date = record_iter.value.index[-1]
+                print date
+                recorder.record(g, date, degree_days = record_iter.value.degree_days[-1])
+    finally:
+        close_canopy(wheat_is_loaded)
                     
     if record == True:
         recorder.post_treatment(variety = variety)
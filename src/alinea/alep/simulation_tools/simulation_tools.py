@@ -10,6 +10,8 @@ import random as rd
 # Imports for weather
 from alinea.alep.alep_weather import (wetness_rapilly,
                                       linear_degree_days,
+                                      add_septoria_risk_with_event,
+                                      add_rain_dispersal_events,
                                       plot_rain_and_temp,
                                       plot_wetness_and_temp)
 from alinea.alep.alep_time_control import *
@@ -34,29 +36,148 @@ from alinea.echap.architectural_reconstructions import (EchapReconstructions, pd
                                                         dimension_fits,
                                                         leafshape_fits)
 from alinea.adel.newmtg import move_properties
+from alinea.alep.disease_store import DiseaseStore, get_disease_store
+from alinea.alep.architecture import carry_climate
 from alinea.caribu.caribu_star import rain_and_light_star
+from alinea.alep.canopy_archive import (CanopyPrefetcher, CanopyDeltaReader,
+                                       canopy_archive_path, archive_canopies,
+                                       detach_columns)
 
 # Tools for weather ###########################################################
-def get_weather(start_date="2010-10-15 12:00:00", end_date="2011-08-01 01:00:00"):
-    """ Get weather data for simulation. """
+WEATHER_CACHE_VERSION = 2
+_weather_sources = {}
+
+def weather_cache_dir():
+    return str(shared_data(alinea.alep)/'weather_cache')
+
+def weather_sources_key():
+    """ Hash of the contents of the sources of derivation of weather, 
+    computed once per process. """
+    if 'key' not in _weather_sources:
+        import sys
+        import hashlib
+        import inspect
+        import alinea.alep.alep_weather
+        key = hashlib.md5(inspect.getsource(get_weather))
+        modules = [alinea.alep.alep_weather, sys.modules[add_notation_dates.__module__],
+                   sys.modules[arvalis_reader.__module__]]
+        for module in modules:
+            key.update(file_md5(inspect.getsourcefile(module) or inspect.getfile(module)))
+        _weather_sources['key'] = key.hexdigest()
+    return _weather_sources['key']
+
+def weather_cache_key(files, **params):
+    """ Hash of content of source files, of sources of derivation and of 
+    parameters of derivation of weather. """
+    import hashlib
+    key = hashlib.md5(str(WEATHER_CACHE_VERSION))
+    key.update(weather_sources_key())
+    for filename in files:
+        with open(filename, 'rb') as f:
+            key.update(f.read())
+    key.update(repr(sorted(params.items())))
+    return key.hexdigest()
+
+def load_cached_weather(key, cache_dir=None, **weather_kwds):
+    """ Get weather saved with given key, None if no valid entry.
+
+    The Weather object is built with 'weather_kwds' (e.g. data_file) as when
+    the weather was derived, its data being read from the cache. 
+    """
+    import cPickle as pickle
+    if cache_dir is None:
+        cache_dir = weather_cache_dir()
+    filename = os.path.join(cache_dir, 'weather_'+key+'.pckl')
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            cached_key, data, rain_events = pickle.load(f)
+    except Exception:
+        return None
+    if cached_key != key:
+        return None
+    weather_kwds['reader'] = lambda data_file: data
+    weather = Weather(**weather_kwds)
+    if rain_events is not None:
+        weather.rain_events = rain_events
+    return weather
+
+def save_cached_weather(weather, key, cache_dir=None):
+    """ Save derived weather data and rain events with given key (skipped if not writable). """
+    import cPickle as pickle
+    if cache_dir is None:
+        cache_dir = weather_cache_dir()
+    filename = os.path.join(cache_dir, 'weather_'+key+'.pckl')
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_filename = filename+'.%d.tmp' % os.getpid()
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump((key, weather.data, getattr(weather, 'rain_events', None)),
+                        f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        pass
+
+def get_weather(start_date="2010-10-15 12:00:00", end_date="2011-08-01 01:00:00",
+                use_cache=True, cache_dir=None, septoria_risks=False, rain_events=False,
+                Tmin=10., Tmax=25., WDmin=10.):
+    """ Get weather data for simulation. 
+    
+    Besides weather variables, wetness and degree days are derived. 
+    If septoria_risks, risks of infection of septoria are also derived with
+    'add_septoria_risk_with_event' (parameters Tmin, Tmax and WDmin, default 
+    values being the ones of this function). If rain_events, rain events (see 
+    'add_rain_dispersal_events') are given as the table 'weather.rain_events'.
+
+    If use_cache, derived weather is saved in cache_dir (default in shared 
+    data of alep) under a key computed from content of source files, sources
+    and parameters of derivation, and loaded from there in next calls.
+    """
+    import copy
     start = datetime.datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')
     if start.year >= 2010:
         filename = 'Boigneville_0109'+str(start.year)+'_3108'+str(start.year+1)+'_h.csv'
         meteo_path = shared_data(alinea.echap, filename)
-        weather = Weather(meteo_path, reader = arvalis_reader)
-        weather.check(['temperature_air', 'PPFD', 'relative_humidity',
-                       'wind_speed', 'rain', 'global_radiation', 'vapor_pressure'])
         notation_dates_file = shared_data(alinea.alep, 'notation_dates/notation_dates_'+str(start.year+1)+'.csv')
-        weather.check(varnames=['notation_dates'], models={'notation_dates':add_notation_dates}, notation_dates_file = notation_dates_file)
+        sources = [meteo_path, notation_dates_file]
+        weather_kwds = dict(data_file=meteo_path, reader=arvalis_reader)
     else:
         start_yr = str(start.year)[2:4]
         end_yr = str(start.year+1)[2:4]
         filename = 'meteo'+ start_yr + '-' + end_yr + '.txt'
         meteo_path = shared_data(alinea.septo3d, filename)
-        weather = Weather(data_file=meteo_path)
+        sources = [meteo_path]
+        weather_kwds = dict(data_file=meteo_path)
+    if use_cache:
+        params = dict(start_date=start_date, base_temp=0., max_temp=30.,
+                      septoria_risks=septoria_risks, rain_events=rain_events)
+        if septoria_risks:
+            params.update(Tmin=Tmin, Tmax=Tmax, WDmin=WDmin)
+        key = weather_cache_key(sources, **params)
+        weather = load_cached_weather(key, cache_dir, **weather_kwds)
+        if weather is not None:
+            return weather
+    weather = Weather(**weather_kwds)
+    if start.year >= 2010:
+        weather.check(['temperature_air', 'PPFD', 'relative_humidity',
+                       'wind_speed', 'rain', 'global_radiation', 'vapor_pressure'])
+        weather.check(varnames=['notation_dates'], models={'notation_dates':add_notation_dates}, notation_dates_file = notation_dates_file)
     weather.check(varnames=['wetness'], models={'wetness':wetness_rapilly})
     weather.check(varnames=['degree_days'], models={'degree_days':linear_degree_days}, start_date=start_date, base_temp=0., max_temp=30.)
     weather.check(varnames=['septo_degree_days'], models={'septo_degree_days':linear_degree_days}, start_date=start_date, base_temp=0., max_temp=30.)
+    if septoria_risks:
+        weather.check(varnames=['septo_infection_risk_with_event'], 
+                      models={'septo_infection_risk_with_event':add_septoria_risk_with_event}, 
+                      wetness_duration_min = WDmin, temp_min = Tmin, temp_max = Tmax)
+    if rain_events:
+        # Rain events are computed on a copy, 'add_rain_dispersal_events' replacing rain
+        events = copy.copy(weather)
+        events.data = weather.data.copy()
+        weather.rain_events = add_rain_dispersal_events(events, return_spells=True)[1]
+    if use_cache:
+        save_cached_weather(weather, key, cache_dir)
     return weather
     
 def add_leaf_dates_to_weather(weather, variety='Tremie12'):
@@ -90,7 +211,8 @@ def count_available_canopies(year, variety, nplants, nsect):
     list_files = os.listdir(filepath)
     start = variety.lower()+'_'+str(int(year))+'_'+\
             str(nplants)+'pl_'+str(nsect)+'sect'
-    return len([f for f in list_files if f.startswith(start)])
+    return len([f for f in list_files if f.startswith(start) and 
+                check_canopy_dir(os.path.join(filepath, f), checksums=False)])
 
 def wheat_path(year, variety, nplants, nsect, rep):
     if rep is None:
@@ -99,34 +221,329 @@ def wheat_path(year, variety, nplants, nsect, rep):
     return filepath+'/'+variety.lower()+'_'+str(int(year))+'_'+\
             str(nplants)+'pl_'+str(nsect)+'sect_rep'+str(rep)
 
-def init_canopy(adel, wheat_dir, rain_and_light=True):
-    if os.path.exists(wheat_dir):
+# Manifest of saved canopies ##################################################
+CANOPY_MANIFEST = 'manifest.json'
+_checked_canopy_dirs = {}
+
+def file_md5(filename):
+    import hashlib
+    key = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), ''):
+            key.update(block)
+    return key.hexdigest()
+
+def read_canopy_manifest(wheat_dir):
+    """ Get manifest of canopies saved in wheat_dir, None if no manifest. """
+    import json
+    filename = os.path.join(wheat_dir, CANOPY_MANIFEST)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+    manifest['iterations'] = {int(it):entry for it, entry in manifest['iterations'].iteritems()}
+    return manifest
+
+def write_canopy_manifest(wheat_dir, manifest):
+    import json
+    filename = os.path.join(wheat_dir, CANOPY_MANIFEST)
+    with open(filename+'.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(filename+'.tmp', filename)
+
+def canopy_file_entry(filename):
+    """ Get checksum, size and time of modification of a saved file for manifest. """
+    stat = os.stat(filename)
+    return {'md5':file_md5(filename), 'size':stat.st_size, 'mtime':stat.st_mtime}
+
+def check_canopy_iteration(wheat_dir, entry, checksums=True):
+    """ Check that files of an iteration in manifest exist and match their checksums.
+    
+    Size and time of modification are checked first: checksums are only computed
+    for files modified since they were recorded.
+    """
+    for name, recorded in entry['files'].iteritems():
+        filename = os.path.join(wheat_dir, name)
+        if not os.path.exists(filename):
+            return False
+        if not checksums:
+            continue
+        if not isinstance(recorded, dict):
+            # Manifests of version 1 only record checksums
+            recorded = {'md5':recorded}
+        stat = os.stat(filename)
+        if recorded.get('size', stat.st_size) != stat.st_size:
+            return False
+        if recorded.get('mtime') != stat.st_mtime and file_md5(filename) != recorded['md5']:
+            return False
+    return True
+
+def check_canopy_dir(wheat_dir, checksums=True):
+    """ Check that canopies saved in wheat_dir are complete and not corrupted.
+    
+    Directories without manifest (saved before manifests) are considered valid.
+    """
+    if not os.path.isdir(wheat_dir):
+        return False
+    manifest = read_canopy_manifest(wheat_dir)
+    if manifest is None:
+        return True
+    if not manifest.get('complete', False):
+        return False
+    if not checksums:
+        return True
+    stamp = os.path.getmtime(os.path.join(wheat_dir, CANOPY_MANIFEST))
+    if _checked_canopy_dirs.get(wheat_dir) != stamp:
+        iterations = manifest['iterations']
+        if not all(it in iterations and check_canopy_iteration(wheat_dir, iterations[it])
+                   for it in range(manifest['nb_iterations'])):
+            return False
+        _checked_canopy_dirs[wheat_dir] = stamp
+    return True
+
+# Cache of interception of rain and light ######################################
+STAR_CACHE_VERSION = 1
+
+def star_cache_dir():
+    return str(shared_data(alinea.alep)/'star_cache')
+
+def geometry_hash(g):
+    """ Hash of the tesselated geometry of the elements of g. """
+    import hashlib
+    from alinea.alep.canopy_archive import mesh_arrays
+    key = hashlib.md5(str(STAR_CACHE_VERSION))
+    geometries = g.property('geometry')
+    for vid in sorted(geometries.keys()):
+        if geometries[vid] is not None:
+            points, indices = mesh_arrays(geometries[vid])
+            key.update(str(vid))
+            key.update(points.tostring())
+            key.update(indices.tostring())
+    return key.hexdigest()
+
+def cached_rain_and_light_star(g, light_sectors='1', domain=None, convUnit=None,
+                               cache_dir=None):
+    """ Run 'rain_and_light_star' on g, or read its results if already computed 
+    for the same geometry and parameters.
+    
+    Properties created or modified by 'rain_and_light_star' are saved in cache_dir 
+    (by default 'star_cache_dir()') under a hash of the geometry of the canopy.
+    """
+    import hashlib
+    import cPickle as pickle
+    if cache_dir is None:
+        cache_dir = star_cache_dir()
+    key = hashlib.md5(geometry_hash(g))
+    key.update(repr((light_sectors, domain, convUnit)))
+    filename = os.path.join(cache_dir, 'star_'+key.hexdigest()+'.pckl')
+    props = g.properties()
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'rb') as f:
+                star = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            star = None
+        if star is not None:
+            for name, values in star.iteritems():
+                g.add_property(name)
+                g.property(name).update(values)
+            return g
+    before = {name:dict(values) for name, values in props.iteritems() if name != 'geometry'}
+    rain_and_light_star(g, light_sectors=light_sectors, domain=domain, convUnit=convUnit)
+    star = {name:dict(values) for name, values in props.iteritems() 
+            if name != 'geometry' and (name not in before or before[name] != values)}
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_filename = filename+'.%d.tmp' % os.getpid()
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(star, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        pass
+    return g
+
+def init_canopy(adel, wheat_dir, rain_and_light=True, disease_store=True,
+                canopy_server=None, light_canopy=False, delta_canopy=False):
+    """ Get the first canopy, loaded if saved in wheat_dir or simulated.
+    
+    If a snapshot archive of wheat_dir exists (see 'archive_canopies'), canopies are 
+    read from it and the next iteration is prefetched during the simulation of diseases:
+    'wheat_is_loaded' is then the prefetcher to give to 'grow_canopy'.
+    If light_canopy is True, the light archive of wheat_dir is used instead if it 
+    exists: canopies are loaded without meshes, leaf elements only carry a summary
+    of their geometry (see 'alinea.alep.architecture.GeometrySummary'). This is 
+    only suited to disease models that do not use meshes (e.g. no caribu nor 
+    popdrops projection during the simulation).
+    If delta_canopy is True, the delta archive of wheat_dir is used instead if it
+    exists: while no leaf element appears nor disappears, 'grow_canopy' updates
+    the properties and geometries of the current canopy in place instead of 
+    loading a new MTG. 
+    
+    If canopies are loaded and disease_store is True, disease properties are kept 
+    in a store outside of the MTG (see 'alinea.alep.disease_store'), bound to each
+    new canopy by 'grow_canopy' instead of moving properties between MTGs.
+    
+    If canopies are not saved and a canopy_server is given (see 'CanopyServer'), 
+    canopies are grown in a separate process during the simulation of diseases:
+    'wheat_is_loaded' is then the server to give to 'grow_canopy'.
+    """
+    light = light_canopy==True and os.path.exists(canopy_archive_path(wheat_dir, light=True))
+    archive_file = canopy_archive_path(wheat_dir, light=light)
+    delta_file = canopy_archive_path(wheat_dir, light=light, delta=True)
+    if delta_canopy==True and os.path.exists(delta_file):
+        wheat_is_loaded = CanopyDeltaReader(delta_file)
+        g, TT = wheat_is_loaded.load(0)
+    elif os.path.exists(archive_file):
+        wheat_is_loaded = CanopyPrefetcher(archive_file)
+        g, TT = wheat_is_loaded.load(0)
+    elif check_canopy_dir(wheat_dir):
         wheat_is_loaded = True
         it_wheat = 0
         g, TT = adel.load(it_wheat, dir=wheat_dir)
+    elif canopy_server is not None:
+        wheat_is_loaded = canopy_server.start()
+        g, TT = wheat_is_loaded.load(0)
     else:
         wheat_is_loaded = False
         g = adel.setup_canopy(age=0.)
         if rain_and_light==True:
-            rain_and_light_star(g, light_sectors = '1', 
-                                domain=adel.domain, convUnit=adel.convUnit)
+            cached_rain_and_light_star(g, light_sectors = '1', 
+                                       domain=adel.domain, convUnit=adel.convUnit)
+    if wheat_is_loaded and disease_store==True:
+        DiseaseStore(g)
     return g, wheat_is_loaded
 
 def grow_canopy(g, adel, canopy_iter, it_wheat,
                 wheat_dir, wheat_is_loaded=True, rain_and_light=True):
     if wheat_is_loaded:
-        newg, TT = adel.load(it_wheat, dir=wheat_dir)
-        move_properties(g, newg)
-        return newg
+        if isinstance(wheat_is_loaded, CanopyDeltaReader):
+            newg, TT = wheat_is_loaded.load(it_wheat, g)
+            if newg is g:
+                # Updated in place: disease properties did not move
+                return g
+        elif isinstance(wheat_is_loaded, (CanopyPrefetcher, CanopyServer)):
+            newg, TT = wheat_is_loaded.load(it_wheat)
+        else:
+            newg, TT = adel.load(it_wheat, dir=wheat_dir)
+        store = get_disease_store(g)
+        if store is None:
+            move_properties(g, newg)
+        else:
+            # Views of disease properties are set aside while moving the other 
+            # properties (e.g. 'senesced_length'): the store is bound to newg
+            props = g.properties()
+            views = {name:props.pop(name) for name in store.names if name in props}
+            try:
+                move_properties(g, newg)
+            finally:
+                props.update(views)
+            store.bind(newg)
+        # Weather of the current step is kept for the new canopy
+        return carry_climate(g, newg)
     else:
-        g = adel.grow(g, canopy_iter.value)
+        newg = adel.grow(g, canopy_iter.value)
         if rain_and_light==True:
-            rain_and_light_star(g, light_sectors = '1', 
-                                domain=adel.domain, convUnit=adel.convUnit)
-        return g
+            cached_rain_and_light_star(newg, light_sectors = '1', 
+                                       domain=adel.domain, convUnit=adel.convUnit)
+        return carry_climate(g, newg)
     
+# Memoization of echap reconstructions ########################################
+ECHAP_CACHE_VERSION = 1
+_echap_reconstructions = {}
+_echap_sources = {}
+
+def echap_sources_key():
+    """ Hash of the contents of the sources of echap reconstructions and of 
+    the size and time of modification of the static data files of echap they 
+    are fitted on, computed once per process. """
+    if 'key' not in _echap_sources:
+        import hashlib
+        import inspect
+        import alinea.echap
+        import alinea.echap.architectural_reconstructions as echap_rec
+        key = hashlib.md5(inspect.getsource(fit_echap_reconstructions))
+        key.update(file_md5(inspect.getsourcefile(echap_rec) or inspect.getfile(echap_rec)))
+        data_dir = str(shared_data(alinea.echap))
+        for root, dirs, files in os.walk(data_dir):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                stat = os.stat(filename)
+                key.update(repr((os.path.relpath(filename, data_dir), 
+                                 stat.st_size, stat.st_mtime)))
+        _echap_sources['key'] = key.hexdigest()
+    return _echap_sources['key']
+
+def echap_reconstructions_key(**params):
+    """ Hash of parameters of fits of echap reconstructions and of the contents of their sources. """
+    import hashlib
+    key = hashlib.md5(str(ECHAP_CACHE_VERSION))
+    key.update(echap_sources_key())
+    key.update(repr(sorted(params.items())))
+    return key.hexdigest()
+
+def echap_reconstructions_cache_dir():
+    return str(shared_data(alinea.alep)/'reconstruction_cache')
+
 def alep_echap_reconstructions(keep_leaves=False, leaf_duration=2.,
-                               single_nff=False, variability=True):
+                               single_nff=False, variability=True, 
+                               use_cache=True, cache_dir=None):
+    """ Get echap reconstructions fitted for alep.
+    
+    If use_cache is True, reconstructions already fitted with the same 
+    parameters are reused from memory or from disk (in cache_dir, by default 
+    'echap_reconstructions_cache_dir()') instead of being fitted again. Each 
+    call returns a new copy of the reconstructions. A cache file that cannot
+    be read back is removed and the reconstructions are fitted again.
+    """
+    import cPickle as pickle
+    if not use_cache:
+        return fit_echap_reconstructions(keep_leaves=keep_leaves, leaf_duration=leaf_duration,
+                                         single_nff=single_nff, variability=variability)
+    key = echap_reconstructions_key(keep_leaves=keep_leaves, leaf_duration=leaf_duration,
+                                    single_nff=single_nff, variability=variability)
+    if key in _echap_reconstructions:
+        return pickle.loads(_echap_reconstructions[key])
+    if cache_dir is None:
+        cache_dir = echap_reconstructions_cache_dir()
+    filename = os.path.join(cache_dir, 'echap_'+key+'.pckl')
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            reconst = pickle.loads(data)
+        except Exception:
+            # Truncated or stale pickle: fit again
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        else:
+            _echap_reconstructions[key] = data
+            return reconst
+    reconst = fit_echap_reconstructions(keep_leaves=keep_leaves, leaf_duration=leaf_duration,
+                                        single_nff=single_nff, variability=variability)
+    try:
+        data = pickle.dumps(reconst, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError):
+        return reconst
+    _echap_reconstructions[key] = data
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_filename = filename+'.%d.tmp' % os.getpid()
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        pass
+    return reconst
+
+def fit_echap_reconstructions(keep_leaves=False, leaf_duration=2.,
+                              single_nff=False, variability=True):
     pars = reconstruction_parameters()
     pars['density_tuning'] = pdict(None)
     pars['density_tuning']['Tremie12'] = 0.85
@@ -292,42 +709,374 @@ def alep_custom_reconstructions(variety='Tremie13', nplants=30,
     return AdelWheat(nplants = nplants, nsect=nsect, devT=devT, stand = stand , 
                     seed=seed, sample='sequence', leaves = leaves, run_adel_pars = adel_pars)
     
+# Cache of custom reconstructions ############################################
+CUSTOM_CACHE_VERSION = 1
+
+class FileLock(object):
+    """ Lock shared between processes, held by the existence of a lock file. """
+    def __init__(self, path, timeout=None, poll=1., stale=None):
+        """ 'timeout': max waiting time (s), 'stale': age (s) of lock file after
+        which its owner is considered dead and the lock is broken. """
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self.stale = stale
+        self.fd = None
+
+    def acquire(self):
+        import time
+        import errno
+        start = time.time()
+        while True:
+            try:
+                self.fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(self.fd, str(os.getpid()))
+                return
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if self.stale is not None and time.time() - os.path.getmtime(self.path) > self.stale:
+                    os.remove(self.path)
+                    continue
+            except OSError:
+                continue
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise IOError('Timeout while waiting for lock '+self.path)
+            time.sleep(self.poll)
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            os.remove(self.path)
+
+    def refresh(self):
+        """ Tell waiting processes that the owner of the lock is alive """
+        if self.fd is not None:
+            os.utime(self.path, None)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+CUSTOM_KWDS = ('tiller_probability', 'proba_main_nff')
+
+def custom_reconstruction_parameters(**kwds):
+    """ Keep among kwds the parameters of 'alep_custom_reconstructions' """
+    import inspect
+    names = inspect.getargspec(alep_custom_reconstructions).args + list(CUSTOM_KWDS)
+    return {k:v for k,v in kwds.iteritems() if k in names}
+
+def custom_canopy_key(start_date, end_date, delay=20., **params):
+    """ Hash of the parameters of a custom reconstruction and of its schedule of growth. """
+    import hashlib
+    key = hashlib.md5(str(CUSTOM_CACHE_VERSION))
+    key.update(repr((start_date, end_date, float(delay))))
+    key.update(repr(sorted(params.items())))
+    return key.hexdigest()
+
+def custom_canopy_dir(key):
+    return str(shared_data(alinea.alep)/'wheat_reconstructions'/('custom_'+key))
+
+def canopy_growth_timing(start_date, end_date, delay=20.):
+    """ Schedule of growth of canopy, every 'delay' degree days """
+    weather = get_weather(start_date=start_date, end_date=end_date)
+    seq = pd.date_range(start=start_date, end=end_date, freq='H')
+    TTmodel = DegreeDayModel(Tbase = 0)
+    every_dd = thermal_time_filter(seq, weather, TTmodel, delay=delay)
+    return CustomIterWithDelays(*time_control(seq, every_dd, weather.data), eval_time='end')
+
+def save_canopy_iterations(adel, wheat_dir, canopy_timing, params=None, resume=True,
+                           on_save=None):
+    """ Simulate canopy with given schedule of growth and save each iteration in wheat_dir.
+    
+    A manifest records the files of each saved iteration (as returned by 
+    'adel.save') with their checksums, sizes and times of modification.
+    If resume is True and a previous build of canopies with the same 'params' 
+    was interrupted, growth starts again from the last valid iteration.
+    If given, 'on_save' is called without arguments after each saved iteration.
+    """
+    import shutil
+    def save(g, it):
+        files = [os.path.basename(f) for f in adel.save(g, it, dir=wheat_dir)]
+        manifest['iterations'][it] = {'files':{f:canopy_file_entry(os.path.join(wheat_dir, f))
+                                               for f in files}}
+        write_canopy_manifest(wheat_dir, manifest)
+        if on_save is not None:
+            on_save()
+    
+    params = params or {}
+    manifest = read_canopy_manifest(wheat_dir) if resume else None
+    if manifest is None or manifest.get('params') != params:
+        if os.path.exists(wheat_dir):
+            shutil.rmtree(wheat_dir)
+        manifest = {'version':2, 'params':params, 'complete':False, 'iterations':{}}
+    if not os.path.exists(wheat_dir):
+        os.makedirs(wheat_dir)
+    last = -1
+    while (last+1 in manifest['iterations'] and 
+           check_canopy_iteration(wheat_dir, manifest['iterations'][last+1])):
+        last += 1
+    manifest['iterations'] = {it:entry for it, entry in manifest['iterations'].iteritems() if it <= last}
+    manifest['complete'] = False
+
+    domain = adel.domain
+    convUnit = adel.convUnit
+    if last >= 0:
+        # Resume from last valid iteration
+        g, TT = adel.load(last, dir=wheat_dir)
+    else:
+        g = adel.setup_canopy(age=0.)
+        cached_rain_and_light_star(g, light_sectors = '1', domain = domain, convUnit = convUnit)
+        save(g, 0)
+    it_wheat = 0
+    for i, canopy_iter in enumerate(canopy_timing):
+        if canopy_iter:
+            it_wheat += 1
+            if it_wheat <= last:
+                continue
+            g = adel.grow(g, canopy_iter.value)
+            cached_rain_and_light_star(g, light_sectors = '1', domain=domain, convUnit=convUnit)
+            save(g, it_wheat)
+    manifest['nb_iterations'] = it_wheat + 1
+    manifest['complete'] = True
+    write_canopy_manifest(wheat_dir, manifest)
+
+def custom_canopy(adel, start_date, end_date, delay=20., archive=False,
+                  lock_timeout=24*3600., lock_stale=3600., **params):
+    """ Get directory of canopies of a custom reconstruction, built if not in cache.
+    
+    Canopies are stored in a directory named after a hash of the parameters 
+    of the reconstruction (variety, number of plants, seed, scales, etc. given 
+    in 'params') and of the schedule of growth. Concurrent processes asking
+    for the same canopy wait for the first one to build it. The builder refreshes
+    its lock at each saved iteration: a lock left untouched for 'lock_stale'
+    seconds belongs to a dead process and is broken.
+    
+    :Parameters:
+     - 'adel' (AdelWheat): Custom reconstruction (see 'alep_custom_reconstructions')
+     - 'start_date', 'end_date' (str): Dates of simulation of growth
+     - 'delay' (float): Degree days between iterations of the canopy
+     - 'archive' (bool): True to also build a snapshot archive of canopies
+     - 'lock_timeout' (float): Max time (s) waiting for another process to build canopies
+     - 'lock_stale' (float): Max time (s) between two saved iterations of the builder
+     - 'params': Parameters of the custom reconstruction (others are ignored)
+     
+    :Returns:
+     - 'wheat_dir' (str): Directory of canopies, to give to 'init_canopy'
+    """
+    params = custom_reconstruction_parameters(**params)
+    wheat_dir = custom_canopy_dir(custom_canopy_key(start_date, end_date, delay, **params))
+    if os.path.exists(wheat_dir):
+        return wheat_dir
+    parent = os.path.dirname(wheat_dir)
+    if not os.path.exists(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            pass
+    with FileLock(wheat_dir+'.lock', timeout=lock_timeout, stale=lock_stale) as lock:
+        # Built by another process while waiting for the lock
+        if os.path.exists(wheat_dir):
+            return wheat_dir
+        canopy_timing = canopy_growth_timing(start_date, end_date, delay)
+        # Resume build interrupted in tmp_dir, if any
+        tmp_dir = wheat_dir+'.tmp'
+        save_canopy_iterations(adel, tmp_dir, canopy_timing, on_save=lock.refresh)
+        if archive==True:
+            archive_canopies(adel, tmp_dir, filename=canopy_archive_path(wheat_dir))
+        os.rename(tmp_dir, wheat_dir)
+    return wheat_dir
+
+def make_canopy_one_rep(year = 2013, variety = 'Tremie13', sowing_date = '10-29',
+                        nplants = 15, nsect = 7, rep=0, delay = 20., archive=False,
+                        light=False, delta=False):
+    """ Simulate and save one canopy, resuming previous build if interrupted. """
+    wheat_dir = wheat_path(year, variety, nplants, nsect, rep)
+    reconst = alep_echap_reconstructions()
+    adel = reconst.get_reconstruction(name=variety, nplants=nplants, nsect=nsect)
+    if not (check_canopy_dir(wheat_dir) and read_canopy_manifest(wheat_dir) is not None):
+        start_date=str(year-1)+"-"+sowing_date+" 12:00:00"
+        end_date=str(year)+"-07-30 00:00:00"
+        canopy_timing = canopy_growth_timing(start_date, end_date, delay)
+        params = dict(year=year, variety=variety, sowing_date=sowing_date,
+                      nplants=nplants, nsect=nsect, rep=rep, delay=delay)
+        save_canopy_iterations(adel, wheat_dir, canopy_timing, params=params)
+    if archive==True and not os.path.exists(canopy_archive_path(wheat_dir)):
+        archive_canopies(adel, wheat_dir)
+    if light==True and not os.path.exists(canopy_archive_path(wheat_dir, light=True)):
+        archive_canopies(adel, wheat_dir, geometry=False)
+    if delta==True:
+        for geometry in ([True, False] if light==True else [True]):
+            if not os.path.exists(canopy_archive_path(wheat_dir, light=not geometry, delta=True)):
+                archive_canopies(adel, wheat_dir, geometry=geometry, delta=True)
+    return wheat_dir
+
+def _make_canopy_one_rep(kwds):
+    return make_canopy_one_rep(**kwds)
+
 def make_canopy(year = 2013, variety = 'Tremie13', sowing_date = '10-29',
-                nplants = 15, nsect = 7, nreps=10, fixed_rep=None, delay = 20.):
-    """ Simulate and save canopy (prior to simulation). """    
-    def make_canopy_one_rep(rep=0):
-        reconst = alep_echap_reconstructions()
-        adel = reconst.get_reconstruction(name=variety, nplants=nplants, nsect=nsect)    
-        domain = adel.domain
-        convUnit = adel.convUnit
+                nplants = 15, nsect = 7, nreps=10, fixed_rep=None, delay = 20.,
+                archive=False, light=False, delta=False, nb_processes=1):
+    """ Simulate and save canopy (prior to simulation). 
+    
+    Canopies already complete are kept, interrupted builds are resumed (see 
+    'save_canopy_iterations'). Replicates are built in a pool of nb_processes
+    processes (None for the number of cpus).
+    If archive is True, the iterations of each canopy are also gathered in a 
+    snapshot archive, read faster by the simulations (see 'init_canopy').
+    If light is True, they are also gathered in a light archive, without meshes.
+    If delta is True, they are also gathered in delta archives, saving only the 
+    changes between iterations (see 'alinea.alep.canopy_archive.CanopyDeltaWriter').
+    """    
+    reps = range(nreps) if fixed_rep is None else [fixed_rep]
+    scenarios = [dict(year=year, variety=variety, sowing_date=sowing_date, nplants=nplants, 
+                      nsect=nsect, rep=rep, delay=delay, archive=archive, 
+                      light=light, delta=delta) for rep in reps]
+    if nb_processes == 1 or len(scenarios) == 1:
+        return map(_make_canopy_one_rep, scenarios)
+    else:
+        from multiprocessing import Pool
+        pool = Pool(nb_processes)
+        try:
+            return pool.map(_make_canopy_one_rep, scenarios)
+        finally:
+            pool.close()
+            pool.join()
+        
+# Pipelined growth of canopy #################################################
+def echap_adel(name='Tremie13', nplants=30, nsect=7, **kwds):
+    """ Get adel model of an echap reconstruction, kwds are given to 'alep_echap_reconstructions' """
+    reconst = alep_echap_reconstructions(**kwds)
+    return reconst.get_reconstruction(name=name, nplants=nplants, nsect=nsect)
+
+def _serve_canopies(make_adel, adel_kwds, start_date, end_date, delay, 
+                    rain_and_light, directory, queue, slots):
+    """ Grow canopy and save each iteration in its own snapshot archive in directory """
+    import traceback
+    from alinea.alep.canopy_archive import CanopyArchive
+    def publish(g, it):
+        slots.acquire()
+        filename = os.path.join(directory, 'canopy_%04d.canopy' % it)
+        CanopyArchive(filename+'.tmp').save(g, it)
+        os.rename(filename+'.tmp', filename)
+        queue.put((it, filename))
+    try:
+        adel = make_adel(**adel_kwds)
+        canopy_timing = canopy_growth_timing(start_date, end_date, delay)
         g = adel.setup_canopy(age=0.)
-        rain_and_light_star(g, light_sectors = '1', domain = domain, convUnit = convUnit)
+        if rain_and_light==True:
+            cached_rain_and_light_star(g, light_sectors = '1', 
+                                       domain=adel.domain, convUnit=adel.convUnit)
         it_wheat = 0
-        wheat_dir = wheat_path(year, variety, nplants, nsect, rep)
-        adel.save(g, it_wheat, dir=wheat_dir)
-        for i, canopy_iter in enumerate(canopy_timing):
+        publish(g, it_wheat)
+        for canopy_iter in canopy_timing:
             if canopy_iter:
                 it_wheat += 1
                 g = adel.grow(g, canopy_iter.value)
-                rain_and_light_star(g, light_sectors = '1', domain=domain, convUnit=convUnit)
-                adel.save(g, it_wheat, dir=wheat_dir)
-                
-    # Manage weather and scheduling
-    start_date=str(year-1)+"-"+sowing_date+" 12:00:00"
-    end_date=str(year)+"-07-30 00:00:00"
-    weather = get_weather(start_date=start_date, end_date=end_date)
-    seq = pandas.date_range(start=start_date, end=end_date, freq='H')
-    TTmodel = DegreeDayModel(Tbase = 0)
-    every_dd = thermal_time_filter(seq, weather, TTmodel, delay=delay)
-    canopy_timing = CustomIterWithDelays(*time_control(seq, every_dd, weather.data), eval_time='end')
+                if rain_and_light==True:
+                    cached_rain_and_light_star(g, light_sectors = '1', 
+                                               domain=adel.domain, convUnit=adel.convUnit)
+                publish(g, it_wheat)
+        queue.put((None, None))
+    except Exception:
+        queue.put((None, traceback.format_exc()))
+
+class CanopyServer(object):
+    """ Grow canopy in a separate process, ahead of the simulation of diseases.
+    
+    The server process builds its own adel model with make_adel(**adel_kwds),
+    grows the canopy every 'delay' degree days between start_date and end_date
+    (as 'canopy_growth_timing') and hands over each iteration through a snapshot 
+    archive (see 'alinea.alep.canopy_archive') written in shared memory if available.
+    At most 'max_ahead' iterations are produced in advance of the simulation.
+    
+    'load(it)' returns (g, TT) as 'AdelWheat.load', TT being None.
+    """
+    def __init__(self, make_adel, adel_kwds, start_date, end_date, delay=20.,
+                 rain_and_light=True, max_ahead=2, directory=None):
+        self.make_adel = make_adel
+        self.adel_kwds = adel_kwds
+        self.start_date = start_date
+        self.end_date = end_date
+        self.delay = delay
+        self.rain_and_light = rain_and_light
+        self.max_ahead = max_ahead
+        self.directory = directory
+        self.process = None
+        self.ready = {}
+        self.finished = False
+
+    def start(self):
+        import tempfile
+        import multiprocessing
+        if self.directory is None:
+            shm = '/dev/shm'
+            self.directory = tempfile.mkdtemp(prefix='alep_canopy_', 
+                                              dir=shm if os.path.isdir(shm) else None)
+        self.queue = multiprocessing.Queue()
+        self.slots = multiprocessing.Semaphore(self.max_ahead)
+        self.process = multiprocessing.Process(target=_serve_canopies,
+                                               args=(self.make_adel, self.adel_kwds,
+                                                     self.start_date, self.end_date,
+                                                     self.delay, self.rain_and_light,
+                                                     self.directory, self.queue, self.slots))
+        self.process.daemon = True
+        self.process.start()
+        return self
+
+    def load(self, it):
+        """ Get iteration 'it' of the canopy, waiting for the server if not ready """
+        import Queue
+        from alinea.alep.canopy_archive import CanopyArchive
+        if self.process is None:
+            self.start()
+        while it not in self.ready:
+            if self.finished:
+                raise KeyError('Iteration %d not grown by canopy server' % it)
+            try:
+                it_ready, filename = self.queue.get(timeout=1.)
+            except Queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('Canopy server stopped unexpectedly')
+                continue
+            if it_ready is None:
+                self.finished = True
+                if filename is not None:
+                    raise RuntimeError('Canopy server failed:\n'+filename)
+            else:
+                self.ready[it_ready] = filename
+        filename = self.ready.pop(it)
+        g, TT = CanopyArchive(filename).load(it)
+        detach_columns(g)
+        os.remove(filename)
+        self.slots.release()
+        return g, TT
+
+    def close(self):
+        """ Stop server and remove its files """
+        import shutil
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        if self.directory is not None and os.path.exists(self.directory):
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+def close_canopy(wheat_is_loaded):
+    """ Stop the canopy server returned by 'init_canopy', if any """
+    if isinstance(wheat_is_loaded, CanopyServer):
+        wheat_is_loaded.close()
 
-    # Simulate and save wheat development
-    if fixed_rep is None:
-        for rep in range(nreps):
-            make_canopy_one_rep(rep=rep)
-    else:
-        make_canopy_one_rep(rep=fixed_rep)
-        
 def get_iter_rep_wheats(year = 2013, variety = 'Tremie13',
                         nplants = 15, nsect = 7, nreps=5):
     nb_can = count_available_canopies(year, variety, nplants, nsect)
@@ -1,9 +1,18 @@
 """
 implements a vine plant model based on topvine lsystem
+
+The axial tree derived at each step is kept with the MTG built from it, so that
+the next step starts from the state of the lsystem instead of converting the MTG
+back with mtg2lpy. Changes of the properties of this MTG are thus not seen by
+the lsystem (see 'Vine.forget_tree'). Disease properties, which are not part of
+the axial tree, are kept in a disease store indexed by the identity of organs in
+topvine (see 'organ_label'), bound to each new MTG.
 """
 
 from openalea.lpy import Lsystem,AxialTree, generateScene
 from openalea.mtg.io import lpy2mtg, mtg2lpy
+from alinea.alep.disease_store import (DiseaseStore, DISEASE_PROPERTIES,
+                                       get_disease_store, stable_label)
 
 import os
 vinedir = os.path.dirname(__file__)
@@ -22,11 +31,44 @@ def run(lsystem, axiom = '', nbstep = -1, parameters = {}):
     if len(parameters) > 0:
         lsystem.context().updateNamespace(parameters)
     return lsystem.iterate(axiom,c_iter,nbstep)
+
+def organ_label(g, vid):
+    """ Get a label of vertex vid that does not change when the vine grows.
+    
+    Internodes, petioles and leaves of topvine are identified by their label, 
+    their plant, their axis and their position on this axis. Other vertices 
+    (canopy, trunks, plants, apices) are identified by 'stable_label'.
+    
+    Parameters
+    ----------
+    g: MTG
+        MTG representing the canopy
+    vid: int
+        Id of the vertex in the MTG
+
+    Returns
+    -------
+    label: tuple
+        e.g. ('lf', 0, (('Ordre', 1), ('R1', None), ('R2', None), ('Tige', 0)), 3)
+    """
+    props = g.get_vertex_property(vid)
+    # Leaves are produced as lf(parameter_set)
+    params = props.get('parameter_set')
+    if params is not None:
+        props = dict((name, getattr(params, name, None)) 
+                     for name in ('ordre', 'posax', 'idp'))
+    ordre, posax = props.get('ordre'), props.get('posax')
+    if not isinstance(ordre, dict) or posax is None:
+        return stable_label(g, vid)
+    return (g.label(vid), props.get('idp'), tuple(sorted(ordre.items())), posax)
     
 class Vine(object):
     
-    def __init__(self, lpy_filename = vinedir + '/topvine.lpy'):
+    def __init__(self, lpy_filename = vinedir + '/topvine.lpy', disease_store=True):
         self.lpy_filename = lpy_filename
+        self.disease_store = disease_store
+        self.g = None
+        self.tree = None
         inter_row = 2.2# m
         inter_plant = 1.1
         self.domain_area = 3 * inter_plant * inter_row
@@ -36,18 +78,56 @@ class Vine(object):
         self.lsys = Lsystem(self.lpy_filename)
         tree = run(self.lsys, nbstep = int(2 + age))
         g = lpy2mtg(tree,self.lsys)
+        if self.disease_store:
+            DiseaseStore(g, label=organ_label)
+        self.g, self.tree = g, tree
         return g
         
+    def axial_tree(self, g):
+        """ Get the axial tree of g, without conversion if g is the last canopy built.
+
+        The tree kept for the last canopy ignores the changes of the properties 
+        of g made since it was built: call 'forget_tree' after changing 
+        properties read by the lsystem.
+        """
+        if g is self.g and self.tree is not None:
+            return self.tree
+        return mtg2lpy(g,self.lsys)
+
+    def forget_tree(self):
+        """ Convert the last canopy built with mtg2lpy on next use of its axial tree """
+        self.tree = None
+        
+    def update_canopy(self, g, tree):
+        """ Build the MTG of the new axial tree and give it the disease state of g """
+        newg = lpy2mtg(tree,self.lsys)
+        store = get_disease_store(g)
+        if store is not None:
+            store.bind(newg)
+        else:
+            labels = dict((organ_label(g, vid), vid) for vid in g.vertices(scale=g.max_scale()))
+            new_labels = dict((organ_label(newg, vid), vid) for vid in newg.vertices(scale=newg.max_scale()))
+            props = g.properties()
+            for name in DISEASE_PROPERTIES:
+                if name in props:
+                    values = props[name]
+                    newg.add_property(name)
+                    newg.property(name).update((new_labels[label], values[vid]) 
+                                               for label, vid in labels.iteritems() 
+                                               if vid in values and label in new_labels)
+        self.g, self.tree = newg, tree
+        return newg
+        
     def grow(self,g,time_control):
         if len(time_control) > 0:
-            axiom = mtg2lpy(g,self.lsys)
+            axiom = self.axial_tree(g)
             #time_control.check('dt',1)
             # /!\ TEMP /!\ ######################################
             dt = 1  
             tree = run(self.lsys,axiom = axiom, nbstep = dt)
             # /!\ TEMP /!\ ######################################
             # tree = run(self.lsys,axiom = axiom, nbstep = time_control.dt)
-            return lpy2mtg(tree,self.lsys)
+            return self.update_canopy(g, tree)
         else :
             return g
         
@@ -57,12 +137,12 @@ class Vine(object):
         return setup_canopy(self.start)
         
     def plot(self,g):
-        tree = mtg2lpy(g,self.lsys)
+        tree = self.axial_tree(g)
         self.lsys.plot(tree)
         return g
         
     def generate_scene(self,g):
-        tree = mtg2lpy(g,self.lsys)
+        tree = self.axial_tree(g)
         self.lsys.sceneInterpretation(tree)
         return generateScene(tree)
         
@@ -5,6 +5,7 @@
 
 # Imports #########################################################################
 import numpy
+from alinea.alep.architecture import get_leaves, climate_array
 
 # Rapilly washing #################################################################
 
@@ -17,39 +18,53 @@ class RapillyWashing:
     Septoria nodorum sur ble'
     
     """       
-    def compute_washing_rate(self, g, global_rain_intensity, label='LeafElement'):
+    def compute_washing_rate(self, g, global_rain_intensity, label='LeafElement',
+                             as_array=False):
         """ Compute the washing rate on each leaf element.
         
-        The washing rate is a function of rain duration and intensity.
+        The washing rate is a function of rain duration and intensity. Leaf
+        properties are read once for the whole canopy and rates are computed
+        for all leaf elements at the same time.
         
         Parameters
         ----------
         g: MTG
             MTG representing the canopy (and the soil).
-            Leaves must know the 'rain_intensity' and the 'rain_duration'
+            Canopy (see set_climate) or leaves must know the 'rain_intensity'
+            and the 'rain_duration'
         global_rain_intensity: float
             Rain intensity over the canopy to trigger washing
         label: str
             Label of the part of the MTG concerned by the calculation
+        as_array: bool
+            True to return the ids of leaf elements and their washing rates
             
         Returns
         -------
         None
             Update directly the MTG
+        (vids, washing_rates): (list, array) if as_array
+            Ids of leaf elements and washing rates in the same order
         """
-        if global_rain_intensity > 0.:
-            vids = [n for n in g if g.label(n).startswith(label)]
-            for v in vids : 
-                leaf = g.node(v)
-                rain_int = leaf.rain_intensity
-                rain_dur = leaf.rain_duration
-                # healthy_area = leaf.healthy_area
-                # leaf.washing_rate = max(0, min(1, rain_int/(healthy_area+rain_int)*rain_dur))
-                area = leaf.area
-                if leaf.geometry!=None:
-                    leaf.washing_rate = max(0, min(1, rain_int/(area+rain_int)*rain_dur))           
-                else:
-                    leaf.washing_rate = 0.
+        vids = get_leaves(g, label=label)
+        washing_rates = numpy.zeros(len(vids))
+        if global_rain_intensity > 0. and len(vids) > 0:
+            areas = g.property('area')
+            geometries = g.property('geometry')
+            rain_int = climate_array(g, 'rain_intensity', vids, 0.)
+            rain_dur = climate_array(g, 'rain_duration', vids, 0.)
+            area = numpy.array([areas.get(v, 0.) for v in vids], dtype=float)
+            has_geometry = numpy.array([geometries.get(v) is not None for v in vids])
+            # healthy_area = leaf.healthy_area
+            # leaf.washing_rate = max(0, min(1, rain_int/(healthy_area+rain_int)*rain_dur))
+            denominator = area + rain_int
+            ratio = numpy.divide(rain_int, denominator, 
+                                 out=numpy.zeros(len(vids)), where=denominator>0.)
+            washing_rates = numpy.where(has_geometry, numpy.clip(ratio*rain_dur, 0., 1.), 0.)
+            g.add_property('washing_rate')
+            g.property('washing_rate').update(zip(vids, washing_rates.tolist()))
+        if as_array:
+            return vids, washing_rates
             
             
     # TODO : Check if the model of Rapilly is properly implemented above.
\ No newline at end of file
@@ -0,0 +1,153 @@
+""" Test models of transport of dispersal units on small canopies """
+
+# Imports #########################################################################
+import numpy
+import pandas
+from openalea.mtg import MTG
+from alinea.alep.fungus import Fungus
+from alinea.alep.architecture import GeometrySummary
+from alinea.alep.dispersal_transport import (TransferMatrixCache, BrownRustDispersal,
+                                             BrownRustLayerDispersal)
+
+# Canopy ##########################################################################
+def canopy(nb_leaves=5, area=10., thickness=1.):
+    """ Build a canopy of leaf elements stacked every 'thickness' """
+    g = MTG()
+    for i in range(nb_leaves):
+        z = i*thickness
+        g.add_component(g.root, label='LeafElement%d'%i, area=area,
+                        geometry=GeometrySummary((0., 0., z), z, z))
+    return g
+
+def rain(intensity=1.):
+    return pandas.DataFrame({'rain':[intensity]*3})
+
+def nb_dus(dlist):
+    return sum(du.nb_dispersal_units for du in dlist)
+
+# Models ##########################################################################
+class FractionTransport:
+    """ Deposit a fixed fraction of emitted DUs on each leaf above the source """
+    def __init__(self, fraction=0.1, wash=False):
+        self.fraction = fraction
+        self.wash = wash
+        self.calls = []
+
+    def disperse(self, g, DU, weather_data=None, **kwds):
+        self.calls.append((dict(DU), self.wash))
+        fungus = Fungus(parameters={'name':'template', 'group_dus':True})
+        leaves = sorted(g.property('label'))
+        deposits = {}
+        for source, nb in DU.iteritems():
+            for vid in leaves:
+                if vid > source:
+                    du = fungus.dispersal_unit()
+                    du.set_nb_dispersal_units(int(round(nb*self.fraction)))
+                    deposits.setdefault(vid, []).append(du)
+        return deposits
+
+class TotalWashing:
+    def compute_washing_rate(self, g, global_rain_intensity, label='LeafElement',
+                             as_array=False):
+        vids = [vid for vid, l in g.property('label').iteritems() if l.startswith(label)]
+        return vids, numpy.ones(len(vids))
+
+def cache(transport, **kwds):
+    fungus = Fungus(parameters={'name':'template', 'group_dus':True})
+    return TransferMatrixCache(transport, fungus, group_dus=True, **kwds)
+
+# Tests ###########################################################################
+def test_cache_mean_deposits():
+    numpy.random.seed(0)
+    g = canopy()
+    transport = FractionTransport(fraction=0.1)
+    cached = cache(transport)
+    totals = {}
+    nb_events = 200
+    for i in range(nb_events):
+        for vid, dlist in cached.disperse(g, {1:1000}, rain()).iteritems():
+            totals[vid] = totals.get(vid, 0) + nb_dus(dlist)
+    # Source probed once
+    assert len(transport.calls) == 1
+    assert set(totals) == set([2, 3, 4, 5])
+    for vid, total in totals.iteritems():
+        assert abs(float(total)/nb_events - 100.) < 3.
+
+def test_cache_deposits_are_drawn():
+    numpy.random.seed(0)
+    g = canopy()
+    cached = cache(FractionTransport(fraction=0.1))
+    draws = set(nb_dus(cached.disperse(g, {1:1000}, rain())[2]) for i in range(20))
+    assert len(draws) > 1
+
+def test_cache_counts_cohorts():
+    numpy.random.seed(0)
+    g = canopy()
+    transport = FractionTransport(fraction=0.25)
+    cached = cache(transport)
+    fungus = Fungus(parameters={'name':'template', 'group_dus':True})
+    cohort = fungus.dispersal_unit()
+    cohort.set_nb_dispersal_units(1000)
+    deposits = cached.disperse(g, {1:[cohort]}, rain())
+    total = sum(nb_dus(dlist) for dlist in deposits.itervalues())
+    assert 900 < total < 1100
+
+def test_cache_reset_on_new_canopy():
+    g = canopy()
+    transport = FractionTransport()
+    cached = cache(transport)
+    cached.disperse(g, {1:100}, rain())
+    cached.disperse(g, {1:100}, rain())
+    assert len(transport.calls) == 1
+    cached.disperse(canopy(), {1:100}, rain())
+    assert len(transport.calls) == 2
+    # New rain regime
+    cached.disperse(cached._canopy, {1:100}, rain(20.))
+    assert len(transport.calls) == 3
+
+def test_cache_washes_on_each_call():
+    g = canopy()
+    transport = FractionTransport(wash=True)
+    try:
+        cache(transport)
+        assert False, 'washing model is required'
+    except ValueError:
+        pass
+    cached = cache(transport, washing_model=TotalWashing())
+    fungus = Fungus(parameters={'name':'template', 'group_dus':True})
+    for i in range(3):
+        du = fungus.dispersal_unit()
+        du.set_nb_dispersal_units(10)
+        g.add_property('dispersal_units')
+        g.property('dispersal_units')[3] = [du]
+        cached.disperse(g, {1:100}, rain())
+        assert not du.is_active
+    # Wrapped model probed once, without washing
+    assert [wash for DU, wash in transport.calls] == [False]
+    assert transport.wash
+
+def mean_deposits(model, g, emissions, nb_events=300):
+    totals = {}
+    for i in range(nb_events):
+        for vid, dlist in model.disperse(g, dict(emissions), domain_area=0.01).iteritems():
+            totals[vid] = totals.get(vid, 0.) + nb_dus(dlist)
+    return {vid:total/nb_events for vid, total in totals.iteritems()}
+
+def test_layer_kernel_as_brown_rust_dispersal():
+    numpy.random.seed(0)
+    g = canopy(nb_leaves=8, area=50., thickness=2.5)
+    fungus = Fungus(parameters={'name':'brown_rust', 'group_dus':True})
+    kwds = dict(fungus=fungus, group_dus=True, domain_area=0.01, layer_thickness=3.)
+    emissions = {2:1000., 7:500.}
+    reference = mean_deposits(BrownRustDispersal(**kwds), g, emissions)
+    kernel = BrownRustLayerDispersal(**kwds)
+    deposits = mean_deposits(kernel, g, emissions)
+    assert set(deposits) == set(reference)
+    # Both models share deposits of a layer between its leaves in the same way
+    for layer, vids in kernel.layers.iteritems():
+        nb_ref = sum(reference.get(vid, 0.) for vid in vids)
+        nb = sum(deposits.get(vid, 0.) for vid in vids)
+        assert abs(nb - nb_ref) < 0.05*nb_ref + 1., (layer, nb, nb_ref)
+    # Kernel computed once for the canopy
+    kernel.disperse(g, emissions)
+    assert kernel._canopy is g
@@ -0,0 +1,58 @@
+""" Test strategies of inoculation on small canopies """
+
+# Imports #########################################################################
+import numpy
+from openalea.mtg import MTG
+from alinea.alep.fungus import Fungus
+from alinea.alep.inoculation import RandomInoculation, InoculationYoungLeaves
+
+# Canopy ##########################################################################
+def canopy(nb_leaves=5):
+    """ Build leaves of increasing age with a stem, the last leaf without area """
+    g = MTG()
+    g.add_component(g.root, label='StemElement', area=1., geometry='stem')
+    for i in range(nb_leaves):
+        area = 0. if i==nb_leaves-1 else 1.
+        g.add_component(g.root, label='LeafElement1', area=area, age=float(i), geometry='leaf')
+    return g
+
+def leaves(g):
+    return sorted(vid for vid, label in g.property('label').iteritems()
+                  if label.startswith('LeafElement'))
+
+def fungus(group_dus):
+    return Fungus(parameters={'name':'fungus', 'group_dus':group_dus})
+
+# Tests ###########################################################################
+def test_random_inoculation():
+    numpy.random.seed(0)
+    g = canopy()
+    dus = [fungus(False).dispersal_unit() for i in range(100)]
+    RandomInoculation().allocate(g, dus)
+    deposits = g.property('dispersal_units')
+    # Leaves without area and other organs receive nothing
+    assert sorted(deposits) == leaves(g)[:-1]
+    assert sum(len(d) for d in deposits.itervalues()) == 100
+    assert all(du.status == 'deposited' for du in dus)
+    lesions = [fungus(False).lesion() for i in range(10)]
+    RandomInoculation().allocate(g, lesions)
+    assert sum(len(l) for l in g.property('lesions').itervalues()) == 10
+
+def test_inoculation_young_leaves():
+    numpy.random.seed(0)
+    g = canopy()
+    # Leaves without age are not young leaves
+    del g.property('age')[leaves(g)[0]]
+    dus = [fungus(True).dispersal_unit() for i in range(100)]
+    InoculationYoungLeaves(age_max=3.).allocate(g, dus)
+    deposits = g.property('dispersal_units')
+    assert sorted(deposits) == leaves(g)[1:3]
+    # Dispersal units of the same leaf form a single cohort
+    assert all(len(d) == 1 for d in deposits.itervalues())
+    assert sum(d[0].nb_dispersal_units for d in deposits.itervalues()) == 100
+    assert sum(len(d[0].position) for d in deposits.itervalues()) == 100
+    # Positions of cohorts are lists of positions, even with a single unit
+    g = canopy(nb_leaves=2)
+    du = fungus(True).dispersal_unit()
+    InoculationYoungLeaves(age_max=3.).allocate(g, [du])
+    assert len(du.position) == 1 and len(du.position[0]) == 2
@@ -0,0 +1,112 @@
+""" Test functions of the protocol between canopy and lesions on small canopies """
+
+# Imports #########################################################################
+import numpy
+from openalea.mtg import MTG
+from alinea.alep.architecture import set_climate
+from alinea.alep.septo3d_v2 import SeptoriaFungus, SeptoError
+from alinea.alep.protocol import (update, sub_steps, deposit,
+                                  coalesce_dispersal_units)
+
+# Canopy ##########################################################################
+def leaf_with_lesions(lesions):
+    g = MTG()
+    vid = g.add_component(g.root, label='LeafElement1', senesced_length=0.)
+    g.add_property('lesions')
+    g.property('lesions')[vid] = lesions
+    return g
+
+class GrantGrowth:
+    """ Give lesions all the growth they demand """
+    def control(self, g, label='LeafElement'):
+        for les in g.property('lesions').itervalues():
+            for lesion in les:
+                if lesion.is_active:
+                    lesion.control_growth(lesion.growth_demand)
+
+def septoria_lesion(**kwds):
+    fungus = SeptoriaFungus()
+    fungus.parameters(rh_effect=False, nb_rings_by_state=1, **kwds)
+    lesion = fungus.lesion()
+    lesion.set_position([[10., 0.]])
+    return lesion
+
+def septoria_dus(nb_dus, group_dus=True):
+    fungus = SeptoriaFungus()
+    fungus.parameters(group_dus=group_dus)
+    dus = []
+    for i in range(nb_dus):
+        du = fungus.dispersal_unit()
+        du.set_position([[10.+i, 0.]])
+        du.set_status('deposited')
+        dus.append(du)
+    return dus
+
+def run_lesion(dt, temperatures, max_ddday=None):
+    lesion = septoria_lesion()
+    g = leaf_with_lesions([lesion])
+    for t in range(0, len(temperatures), dt):
+        set_climate(g, temperature_sequence=temperatures[t:t+dt])
+        update(g, dt, GrantGrowth(), max_ddday=max_ddday)
+    return lesion
+
+# Tests ###########################################################################
+def test_sub_steps_as_hourly_steps():
+    rng = numpy.random.RandomState(0)
+    hours = numpy.arange(24*60)
+    temperatures = list(10 + 8*numpy.sin(hours*2*numpy.pi/24) + rng.normal(0, 2, len(hours)))
+    hourly = run_lesion(1, temperatures)
+    for dt, max_ddday, tolerance in [(24, None, 2e-2), (24, 10., 1e-4), (48, 10., 1e-4)]:
+        lesion = run_lesion(dt, temperatures, max_ddday)
+        assert lesion.status == hourly.status
+        assert abs(lesion.age_tt - hourly.age_tt) < 1e-6
+        assert abs(lesion.surface - hourly.surface) <= tolerance*hourly.surface
+
+def test_sub_steps_with_mutable_fungi():
+    # Lesions of a mutable fungus have the same name but their own stage durations
+    long_stages = septoria_lesion(degree_days_to_chlorosis=220.)
+    short_stages = septoria_lesion(degree_days_to_chlorosis=40.)
+    assert long_stages.fungus.name == short_stages.fungus.name
+    g = leaf_with_lesions([long_stages, short_stages])
+    # 44 degree days in the time step
+    set_climate(g, temperature_sequence=[22.]*48)
+    steps = sub_steps(g, 48)
+    assert len(steps) == 2
+    try:
+        update(g, 48, GrantGrowth())
+    except SeptoError:
+        assert False, 'time step not split for lesions with short stages'
+
+def test_coalesce_dispersal_units():
+    fresh, other, wet_spores, dried, started, dead = septoria_dus(6)
+    wet_spores.set_nb_spores(5.)
+    dried.dry_dt = 2.
+    started.temperature_sequence = [10.]
+    dead.disable()
+    dus = coalesce_dispersal_units([fresh, other, wet_spores, dried, started, dead])
+    # Cohorts differing by their number of spores or dry duration are kept apart
+    assert dus == [fresh, wet_spores, dried, started, dead]
+    assert fresh.nb_dispersal_units == 2
+    assert fresh.position == [[10., 0.], [11., 0.]]
+    assert wet_spores.nb_dispersal_units == 1
+    # Individual dispersal units are never merged
+    dus = septoria_dus(2, group_dus=False)
+    assert coalesce_dispersal_units(dus) == dus
+
+def test_deposit():
+    g = MTG()
+    leaf = g.add_component(g.root, label='LeafElement1')
+    stem = g.add_component(g.root, label='StemElement')
+    first, second, third = septoria_dus(3)
+    deposit(g, {leaf:[first], stem:[second]})
+    assert g.property('dispersal_units') == {leaf:[first]}
+    deposit(g, {leaf:[second, third]})
+    assert g.property('dispersal_units')[leaf] == [first, second, third]
+    # New cohorts merge with the ones already on the leaf
+    g = MTG()
+    leaf = g.add_component(g.root, label='LeafElement1')
+    first, second, third = septoria_dus(3)
+    deposit(g, {leaf:[first]}, coalesce=True)
+    deposit(g, {leaf:[second, third]}, coalesce=True)
+    assert g.property('dispersal_units')[leaf] == [first]
+    assert first.nb_dispersal_units == 3
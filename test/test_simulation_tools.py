@@ -0,0 +1,129 @@
+""" Test tools to run simulations on canopies loaded from disk """
+
+# Imports #########################################################################
+import os
+import shutil
+import tempfile
+from openalea.mtg import MTG
+from alinea.alep.architecture import set_climate, climate_value, climate_array
+from alinea.alep.disease_store import DiseaseStore, StoreProperty
+from alinea.alep.simulation_tools import simulation_tools
+from alinea.alep.simulation_tools.simulation_tools import (grow_canopy, check_canopy_dir,
+                                                           canopy_file_entry,
+                                                           write_canopy_manifest)
+
+# Canopy ##########################################################################
+def canopy(nb_metamers=3, nb_plants=1):
+    """ Build a canopy with the scales of adel, last plant being 'plant1' """
+    g = MTG()
+    for p in range(nb_plants):
+        plant = g.add_component(g.root, label='plant%d'%(nb_plants-p))
+        axis = g.add_component(plant, label='MS')
+        for i in range(nb_metamers):
+            metamer = g.add_component(axis, label='metamer%d'%(i+1))
+            blade = g.add_component(metamer, label='blade')
+            g.add_component(blade, label='LeafElementA1', area=10.)
+    return g
+
+def leaves(g):
+    return sorted(vid for vid, label in g.property('label').iteritems()
+                  if label.startswith('LeafElement'))
+
+class CanopiesOnDisk:
+    """ Load canopies whose vertex ids change between iterations """
+    def load(self, it, dir=None):
+        return canopy(nb_plants=it+1), it*20.
+
+# Tests ###########################################################################
+def test_grow_canopy_with_store():
+    g = canopy()
+    DiseaseStore(g)
+    vids = leaves(g)
+    g.property('lesions')[vids[0]] = ['lesion']
+    g.add_property('senesced_length')
+    g.property('senesced_length')[vids[1]] = 2.
+    newg = grow_canopy(g, CanopiesOnDisk(), None, 1, wheat_dir=None)
+    new_vids = leaves(newg)[-3:]
+    assert new_vids != vids
+    assert isinstance(newg.property('lesions'), StoreProperty)
+    assert dict(newg.property('lesions')) == {new_vids[0]:['lesion']}
+    # Properties outside of the store are carried over
+    assert dict(newg.property('senesced_length')) == {new_vids[1]:2.}
+
+def test_grow_canopy_moves_no_lesion():
+    g = canopy()
+    DiseaseStore(g)
+    lesions = ['lesion']
+    g.property('lesions')[leaves(g)[0]] = lesions
+    moved = []
+    def move_properties(g, newg):
+        moved.extend(g.properties())
+        simulation_tools.move_properties.__wrapped__(g, newg)
+    move_properties.__wrapped__ = simulation_tools.move_properties
+    simulation_tools.move_properties = move_properties
+    try:
+        newg = grow_canopy(g, CanopiesOnDisk(), None, 1, wheat_dir=None)
+    finally:
+        simulation_tools.move_properties = move_properties.__wrapped__
+    # Disease properties stay in the store: lesion lists are neither copied nor moved
+    assert 'lesions' not in moved
+    assert newg.property('lesions')[leaves(newg)[-3]] is lesions
+    assert isinstance(g.property('lesions'), StoreProperty)
+
+def test_grow_canopy_with_climate():
+    g = canopy()
+    set_climate(g, temperature_sequence=[10., 12.], leaf_properties=['rain_intensity'],
+                rain_intensity=2.)
+    # Values asked on leaves are also leaf properties
+    assert g.property('rain_intensity') == {vid:2. for vid in leaves(g)}
+    assert 'temperature_sequence' not in g.properties()
+    newg = grow_canopy(g, CanopiesOnDisk(), None, 1, wheat_dir=None)
+    new_vid = leaves(newg)[-1]
+    assert list(climate_value(newg, 'temperature_sequence', new_vid)) == [10., 12.]
+    assert climate_value(newg, 'rain_intensity', new_vid) == 2.
+
+def test_climate_falls_back_on_leaves():
+    g = canopy()
+    vid = leaves(g)[0]
+    set_climate(g, temperature_sequence=[10., 12.])
+    g.add_property('relative_humidity')
+    g.property('relative_humidity')[vid] = 90.
+    assert climate_value(g, 'relative_humidity', vid) == 90.
+    assert list(climate_array(g, 'relative_humidity', leaves(g))) == [90., 0., 0.]
+    g.climate_context.override(vid, relative_humidity=85.)
+    assert climate_value(g, 'relative_humidity', vid) == 85.
+    assert list(climate_array(g, 'relative_humidity', leaves(g))) == [85., 0., 0.]
+    try:
+        climate_array(g, 'temperature_sequence', leaves(g))
+    except ValueError:
+        pass
+    else:
+        assert False, 'sequences are not values by leaf'
+
+def test_check_canopy_dir():
+    wheat_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(wheat_dir, 'scene0000.bgeom')
+        with open(filename, 'wb') as f:
+            f.write('canopy')
+        os.utime(filename, (1e9, 1e9))
+        write_canopy_manifest(wheat_dir, {'version':2, 'complete':True, 'nb_iterations':1,
+                                          'iterations':{0:{'files':{'scene0000.bgeom':
+                                                                    canopy_file_entry(filename)}}}})
+        assert check_canopy_dir(wheat_dir)
+        # Files of same size and time of modification are not read again
+        stat = os.stat(filename)
+        with open(filename, 'wb') as f:
+            f.write('broken')
+        os.utime(filename, (stat.st_atime, stat.st_mtime))
+        os.utime(os.path.join(wheat_dir, 'manifest.json'), (stat.st_atime, stat.st_mtime + 5))
+        assert check_canopy_dir(wheat_dir)
+        # Modified files are checked against their checksums
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+        os.utime(os.path.join(wheat_dir, 'manifest.json'), (stat.st_atime, stat.st_mtime + 20))
+        assert not check_canopy_dir(wheat_dir)
+        with open(filename, 'wb') as f:
+            f.write('truncated')
+        assert not check_canopy_dir(wheat_dir)
+    finally:
+        shutil.rmtree(wheat_dir)
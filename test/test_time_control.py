@@ -0,0 +1,230 @@
+""" Test filters of evaluation for septoria against the loop versions they replace """
+
+# Imports #########################################################################
+import os
+import numpy
+import pandas
+from alinea.astk.Weather import Weather
+from alinea.alep.alep_weather import wetness_rapilly, linear_degree_days
+from alinea.astk.TimeControl import time_control, IterWithDelays
+from alinea.alep.alep_time_control import (septoria_filter_wetness,
+                                           septoria_filter_ddays,
+                                           evaluation_sequence,
+                                           iter_evaluation_sequence,
+                                           CustomIterWithDelays,
+                                           EventSchedule,
+                                           WeatherWindows)
+
+# Reference versions ##############################################################
+# Copies of septoria_filter_wetness and septoria_filter_ddays as they were before
+# being vectorized, looping on the steps of the sequence. They are kept here as
+# the reference behaviour of the filters.
+def loop_filter_wetness(seq, weather, degree_days=10., base_temp = 0., 
+                        Tmin = 10., Tmax = 30., WDmin = 10., rain_min = 0.2, start_date=None):
+    """ Loop version of septoria_filter_wetness """
+    if not 'septo_infection_risk_with_event' in weather.data.columns:
+        from alinea.alep.alep_weather import add_septoria_risk_with_event
+        weather.check(varnames=['septo_infection_risk_with_event'], 
+                      models={'septo_infection_risk_with_event':add_septoria_risk_with_event}, 
+                      wetness_duration_min = WDmin, temp_min = Tmin, temp_max = Tmax)
+    if not 'septo_degree_days' in weather.data.columns:
+        from alinea.alep.alep_weather import linear_degree_days
+        weather.check(varnames=['septo_degree_days'], models={'septo_degree_days':linear_degree_days}, start_date=start_date, base_temp=base_temp)
+    wetness = weather.data.wetness[seq]
+    temperature = weather.data.temperature_air[seq]
+    rain = weather.data.rain[seq]
+    rain[rain <= rain_min] = 0
+    cond_inf = weather.data.septo_infection_risk_with_event[seq]
+    ddays = weather.data.degree_days[seq].diff()
+    ddays.ix[0] = 0.
+    count_wet = 0.
+    count_rain = 0.
+    count_ddays = 0.
+    df = pandas.Series([False for i in range(len(wetness))], index = wetness.index)
+    for i, row in df.iteritems():
+        if wetness[i] and Tmin <= temperature[i] < Tmax:
+            if count_wet == 0. and i < df.index[-1]-9 and cond_inf[i+9] == True:
+                df[i] = True
+            count_wet += 1.
+        else:
+            if i > df.index[0] and count_wet >= WDmin and cond_inf[i-1] == True:
+                df[i - 1] = True
+            count_wet = 0.
+    
+    for i, row in df.iteritems():
+        if rain[i] > 0:
+            if count_rain == 0.:
+                df[i] = True
+            count_rain += 1
+        else:
+            if count_rain > 0.:
+                df[i] = True
+            count_rain = 0.
+
+    for i, row in df.iteritems():
+        if row == True:
+            count_ddays = 0.
+        count_ddays += ddays[i]
+        if count_ddays >= degree_days and i > df.index[0]:
+            df[i - 1] = True
+            count_ddays = 0.
+    df[df.index[0]] = True
+    return df
+
+def loop_filter_ddays(seq, weather, delay=10., base_temp = 0., 
+                          rain_min = 0.2, start_date=None):
+    """ Loop version of septoria_filter_ddays """
+    if not 'septo_degree_days' in weather.data.columns:
+        from alinea.alep.alep_weather import linear_degree_days
+        weather.check(varnames=['septo_degree_days'], models={'septo_degree_days':linear_degree_days}, start_date=start_date, base_temp=base_temp)
+    rain = weather.data.rain[seq]
+    rain[rain <= rain_min] = 0
+    ddays = weather.data.degree_days[seq].diff()
+    ddays.ix[0] = 0.
+    count_rain = 0.
+    count_ddays = 0.
+    df = pandas.Series([False for i in range(len(ddays))], index = ddays.index)
+    for i, row in df.iteritems():
+        if rain[i] > 0:
+            if count_rain == 0.:
+                df[i] = True
+            count_rain += 1
+        else:
+            if count_rain > 0.:
+                df[i] = True
+            count_rain = 0.
+
+    for i, row in df.iteritems():
+        if row == True:
+            count_ddays = 0.
+        count_ddays += ddays[i]
+        if count_ddays >= delay and i > df.index[0]:
+            df[i - 1] = True
+            count_ddays = 0.
+    df[df.index[0]] = True
+    return df
+
+# Utilities #######################################################################
+def get_test_weather(start_date="2000-10-15 12:00:00"):
+    """ Read weather data bundled with tests """
+    meteo_path = os.path.join(os.path.dirname(__file__), 'meteo01.txt')
+    weather = Weather(data_file=meteo_path)
+    weather.check(varnames=['wetness'], models={'wetness':wetness_rapilly})
+    weather.check(varnames=['degree_days'], models={'degree_days':linear_degree_days},
+                  start_date=start_date, base_temp=0., max_temp=30.)
+    return weather
+
+def check_same_filter(filt, ref):
+    assert (filt.index == ref.index).all()
+    assert (filt.values == ref.values).all()
+
+# Tests ###########################################################################
+def test_filter_ddays():
+    """ Check that septoria_filter_ddays gives the same filter as the loop version. """
+    weather = get_test_weather()
+    seq = weather.data.index
+    for delay in [5., 10., 20.]:
+        for rain_min in [0., 0.2, 1.]:
+            filt = septoria_filter_ddays(seq, weather, delay=delay, rain_min=rain_min)
+            ref = loop_filter_ddays(seq, weather, delay=delay, rain_min=rain_min)
+            check_same_filter(filt, ref)
+
+def test_filter_wetness():
+    """ Check that septoria_filter_wetness gives the same filter as the loop version. """
+    weather = get_test_weather()
+    seq = weather.data.index
+    for degree_days in [5., 10., 20.]:
+        for WDmin in [5., 10.]:
+            filt = septoria_filter_wetness(seq, weather, degree_days=degree_days, WDmin=WDmin)
+            ref = loop_filter_wetness(seq, weather, degree_days=degree_days, WDmin=WDmin)
+            check_same_filter(filt, ref)
+
+def test_filter_on_part_of_sequence():
+    """ Check that filters are the same on a part of the weather sequence. """
+    weather = get_test_weather()
+    seq = pandas.date_range(start="2001-01-01 01:00:00", end="2001-03-01 00:00:00", freq='H')
+    check_same_filter(septoria_filter_ddays(seq, weather), loop_filter_ddays(seq, weather))
+    check_same_filter(septoria_filter_wetness(seq, weather), loop_filter_wetness(seq, weather))
+
+def test_weather_windows_as_timing_values():
+    """ Check that windows of weather give the values of the evaluations of timings. """
+    weather = get_test_weather()
+    seq = pandas.date_range(start="2001-01-01 01:00:00", end="2001-03-01 00:00:00", freq='H')
+    names = ['temperature_air', 'wetness', 'degree_days']
+    timing = CustomIterWithDelays(*time_control(seq, septoria_filter_ddays(seq, weather),
+                                                weather.data), eval_time='end')
+    # Evaluations of the timing in a loop on all steps
+    ref = [(step, ev) for step, ev in zip(range(len(seq)), timing) if ev]
+    windows = WeatherWindows.from_timing(timing, names=names)
+    schedule = list(EventSchedule(septo=timing))
+    assert [step for step, events in schedule] == [step for step, ev in ref]
+    for (step, events), (ref_step, ev) in zip(schedule, ref):
+        evaluation = events['septo']
+        assert evaluation.dt == ev.dt
+        climate = windows.window(evaluation)
+        for name in names:
+            assert (climate[name] == ev.value[name].values).all()
+    # Evaluations of null delay are rejected by both
+    values, delays = list(timing.values), list(timing.delays)
+    values.insert(3, values[3].iloc[:1])
+    delays.insert(3, 0)
+    for timing in [CustomIterWithDelays(values, delays, eval_time='end'),
+                   IterWithDelays(values, delays)]:
+        for compile_timing in [lambda t: WeatherWindows.from_timing(t, names=names),
+                               lambda t: EventSchedule(septo=t)]:
+            try:
+                compile_timing(timing)
+            except ValueError:
+                pass
+            else:
+                assert False, 'null delay not rejected'
+
+def test_evaluation_sequence():
+    """ Check that evaluation filters generated lazily or as arrays are the same. """
+    rng = numpy.random.RandomState(0)
+    delays = rng.randint(0, 10, 50)
+    for eval_time in ['start', 'end']:
+        ref = evaluation_sequence(delays, eval_time)
+        assert len(ref) == delays.sum()
+        assert sum(ref) == (delays > 0).sum()
+        assert list(iter_evaluation_sequence(delays, eval_time)) == ref
+        assert evaluation_sequence(delays, eval_time, as_array=True).tolist() == ref
+        timing = CustomIterWithDelays([None]*len(delays), delays, eval_time=eval_time)
+        assert timing.evaluation_array().tolist() == ref
+        assert [bool(ev) for ev in timing] == ref
+    try:
+        iter_evaluation_sequence(delays, 'middle')
+    except ValueError:
+        pass
+    else:
+        assert False, 'eval_time checked when the generator is created'
+
+def test_event_schedule_as_zipped_timings():
+    """ Check that the schedule gives the evaluations of a loop on zipped timings. """
+    weather = get_test_weather()
+    seq = pandas.date_range(start="2001-01-01 01:00:00", end="2001-03-01 00:00:00", freq='H')
+    every_day = [i%24 == 0 for i in range(len(seq))]
+    # A filter not evaluating the first step gives a shorter timing
+    every_rain = weather.data.rain[seq].values > 0.2
+    every_rain[0] = False
+    canopy = time_control(seq, every_day, weather.data)
+    rain = time_control(seq, every_rain, weather.data)
+    septo = time_control(seq, septoria_filter_ddays(seq, weather), weather.data)
+    def timings():
+        return dict(canopy=IterWithDelays(*canopy), rain=IterWithDelays(*rain),
+                    septo=CustomIterWithDelays(*septo, eval_time='end'))
+    schedule = EventSchedule(**timings())
+    ref = []
+    names, loop = zip(*timings().items())
+    for step, evaluations in enumerate(zip(*loop)):
+        events = {name:ev for name, ev in zip(names, evaluations) if ev}
+        if len(events) > 0:
+            ref.append((step, events))
+    assert schedule.nb_steps < len(seq)
+    assert schedule.nb_steps == step + 1
+    assert [step for step, events in schedule] == [step for step, events in ref]
+    for (step, events), (ref_step, ref_events) in zip(schedule, ref):
+        assert sorted(events) == sorted(ref_events)
+        for name, ev in ref_events.iteritems():
+            assert events[name].value is ev.value
+            assert events[name].dt == ev.dt
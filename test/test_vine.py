@@ -0,0 +1,32 @@
+""" Test the growth of the vine canopy with its disease state """
+
+# Imports #########################################################################
+from alinea.alep.vine import Vine, organ_label
+
+# Utilities #######################################################################
+def leaf_labels(g):
+    """ Ids of leaves of the vine by their label in topvine """
+    return dict((organ_label(g, vid), vid) for vid, label in g.property('label').iteritems()
+                if label == 'lf')
+
+def check_lesions_after_growth(disease_store):
+    vine = Vine(disease_store=disease_store)
+    g = vine.setup_canopy(age=1)
+    leaves = leaf_labels(g)
+    assert len(leaves) > 0
+    label = sorted(leaves)[0]
+    lesions = ['lesion']
+    if 'lesions' not in g.properties():
+        g.add_property('lesions')
+    g.property('lesions')[leaves[label]] = lesions
+    newg = vine.grow(g, [1])
+    assert newg is not g
+    assert vine.g is newg
+    assert newg.property('lesions')[leaf_labels(newg)[label]] is lesions
+
+# Tests ###########################################################################
+def test_lesions_after_growth_with_store():
+    check_lesions_after_growth(disease_store=True)
+
+def test_lesions_after_growth_without_store():
+    check_lesions_after_growth(disease_store=False)
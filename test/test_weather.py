@@ -0,0 +1,139 @@
+""" Test weather utilities of alep against the versions they replace """
+
+# Imports #########################################################################
+import os
+import shutil
+import tempfile
+import numpy
+import pandas
+from datetime import datetime, timedelta
+from alinea.astk.Weather import Weather
+from alinea.alep.alep_weather import (derive_weather, load_weather_batch,
+                                      weather_from_batch, window_sums,
+                                      add_rain_dispersal_events)
+
+# Reference versions ##############################################################
+def loop_window_sums(values, index, before=timedelta(0), after=timedelta(0)):
+    """ Windows as summed row by row by the former add_septoria_efficient_rain 
+    and add_septoria_risk_with_event, before window_sums """
+    df = pandas.Series(values, index=index)
+    return numpy.array([sum(df.ix[date-before:date+after]) for date in index])
+
+def loop_rain_dispersal_events(rain):
+    """ Rain, rain duration and dispersal event columns as computed hour by hour 
+    by the former add_rain_dispersal_events, before rain_spells """
+    max_rain = 0.
+    ind_max = 0.
+    rain_counter = 0.
+    rain_amount = 0.
+    dispersal = numpy.zeros(len(rain))
+    mean_rain = numpy.zeros(len(rain))
+    rain_duration = numpy.zeros(len(rain))
+    for i_line in range(len(rain)):
+        if rain[i_line] > 0.:
+            rain_counter += 1.
+            rain_amount += rain[i_line]
+            if rain[i_line] > max_rain:
+                max_rain = rain[i_line]
+                ind_max = i_line
+        else:
+            if ind_max > 0.:
+                mean_rain[ind_max] = rain_amount/rain_counter
+                rain_duration[ind_max] = rain_counter
+                dispersal[ind_max] = 1
+                max_rain = 0.
+                ind_max = 0.
+                rain_counter = 0.
+                rain_amount = 0.
+    return mean_rain, rain_duration, dispersal
+
+# Utilities #######################################################################
+def weather_file():
+    return os.path.join(os.path.dirname(__file__), 'meteo01.txt')
+
+def write_weather_files(directory):
+    """ Write weather files of two sites, the second one starting later """
+    shutil.copy(weather_file(), os.path.join(directory, 'siteA00-01.txt'))
+    with open(weather_file()) as f:
+        lines = f.readlines()
+    with open(os.path.join(directory, 'siteB00-01.txt'), 'w') as f:
+        f.writelines(lines[:1] + lines[1000:])
+
+class RainOnly:
+    """ Weather with given rain only """
+    def __init__(self, rain):
+        index = pandas.date_range(datetime(2000, 10, 15), periods=len(rain), freq='H')
+        self.data = pandas.DataFrame(dict(temperature_air=numpy.zeros(len(rain)),
+                                          rain=numpy.asarray(rain, dtype=float)),
+                                     index=index)
+
+def check_rain_events(rain):
+    weather, spells = add_rain_dispersal_events(RainOnly(rain), return_spells=True)
+    mean_rain, rain_duration, dispersal = loop_rain_dispersal_events(rain)
+    # Rain of a spell summed by numpy (pairwise), not hour after hour
+    assert numpy.allclose(weather.data['rain'].values, mean_rain, rtol=1e-12, atol=0.)
+    assert (weather.data['rain_duration'].values == rain_duration).all()
+    assert (weather.data['dispersal_event'].values == dispersal).all()
+    assert (spells['dispersal_event'] == weather.data.index[dispersal > 0]).all()
+
+# Tests ###########################################################################
+def test_batch_as_files():
+    """ Check that a batch of weather files is derived as each file alone. """
+    directory = tempfile.mkdtemp()
+    try:
+        write_weather_files(directory)
+        table = load_weather_batch(directory)
+        for site in ['siteA', 'siteB']:
+            weather = Weather(data_file=os.path.join(directory, site+'00-01.txt'))
+            ref = derive_weather(weather.data, datetime(2000, 10, 15, 12))
+            data = weather_from_batch(table, site, 2001).data
+            assert (data.index == ref.index).all()
+            for name in ['wetness', 'septo_infection_risk', 'septo_infection_risk_with_event']:
+                assert (data[name].values == ref[name].values).all(), name
+            assert numpy.allclose(data['degree_days'].values, ref['degree_days'].values)
+    finally:
+        shutil.rmtree(directory)
+
+def test_window_sums():
+    """ Check that window sums are the sums of the rows of each window. """
+    rng = numpy.random.RandomState(0)
+    # Hourly dates with gaps
+    hours = numpy.sort(rng.choice(24*30, 500, replace=False))
+    index = pandas.DatetimeIndex(datetime(2000, 10, 15) + timedelta(hours=int(h)) for h in hours)
+    values = rng.random_sample(len(index))
+    values[rng.random_sample(len(index)) < 0.02] = numpy.nan
+    windows = [(timedelta(0), timedelta(0)),
+               (timedelta(0), timedelta(days=5)),
+               (timedelta(days=4, hours=23), timedelta(hours=1)),
+               # Windows wider than the whole sequence
+               (timedelta(days=40), timedelta(days=40))]
+    for before, after in windows:
+        sums = window_sums(values, index, before=before, after=after)
+        ref = loop_window_sums(values, index, before=before, after=after)
+        assert (numpy.isnan(sums) == numpy.isnan(ref)).all()
+        assert numpy.allclose(sums, ref, equal_nan=True)
+    # Windows do not span several groups
+    groups = numpy.repeat([0, 1], [200, 300])
+    before, after = timedelta(days=2), timedelta(days=3)
+    sums = window_sums(values, index, before=before, after=after, groups=groups)
+    ref = numpy.concatenate([loop_window_sums(values[:200], index[:200], before, after),
+                             loop_window_sums(values[200:], index[200:], before, after)])
+    assert numpy.allclose(sums, ref, equal_nan=True)
+
+def test_rain_dispersal_events():
+    """ Check that rain dispersal events are the ones of the hour by hour version. """
+    check_rain_events(Weather(data_file=weather_file()).data.rain.values)
+    cases = [[], [0.], [1.], [1., 0.], [0., 1., 2., 2., 0., 1.], [0.1]*30 + [0.],
+             # Spell with its max at first hour merged with next spells...
+             [3., 1., 0., 2., 0., 4., 5., 0.], [3., 1., 0., 2., 0., 1., 0., 4., 0.],
+             [2., 0., 1., 0., 5., 5., 0., 3.],
+             # ... and up to the end if none has a higher max
+             [3., 0., 3., 0.], [3., 1., 0., 2.]]
+    for rain in cases:
+        check_rain_events(rain)
+    rng = numpy.random.RandomState(0)
+    for i in range(500):
+        rain = rng.choice([0., 0., 0., 0.1, 0.2, 0.3, 1.7], rng.randint(1, 40))
+        if rng.random_sample() < 0.5:
+            rain[0] = 5.
+        check_rain_events(rain)